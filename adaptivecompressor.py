@@ -0,0 +1,77 @@
+from os.path import splitext
+
+from compressor import Compressor
+from zlibcompressor import ZlibCompressor
+from bz2compressor import BZ2Compressor
+from lzmacompressor import LZMACompressor, lzma
+
+
+# formats which are already compressed
+STORED_EXTENSIONS = ['.zip', '.jar', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar',
+                     '.png', '.jpg', '.jpeg', '.gif', '.webp', '.ogg', '.mp3', '.mp4', '.webm']
+
+
+class AdaptiveCompressor(Compressor):
+    '''Picks a codec for each file.
+
+    Files are matched against extension rules first, otherwise a sample of
+    the file is compressed with each codec. Incompressible files are stored
+    as they are, and of the codecs that do well the first (fastest) one
+    within tolerance of the best is used. The chosen codec is recorded in
+    the manifest so clients decompress each file correctly.
+
+    Manifests and deltas use the default codec.'''
+
+    def __init__(self, codecs=None, default='bz2', rules=None, sample_size=1 << 16, min_saving=0.05, tolerance=0.05):
+        if codecs is None:
+            codecs = [('zlib', ZlibCompressor()), ('bz2', BZ2Compressor())]
+            if lzma is not None:
+                codecs.append(('lzma', LZMACompressor()))
+        self.codecs = [('stored', Compressor())] + list(codecs)
+        self.codec_map = dict(self.codecs)
+        self.default = self.codec_map[default]
+        if rules is None:
+            rules = dict((ext, 'stored') for ext in STORED_EXTENSIONS)
+        self.rules = rules
+        self.sample_size = sample_size
+        self.min_saving = min_saving
+        self.tolerance = tolerance
+
+    def compress(self, contents):
+        return self.default.compress(contents)
+
+    def decompress(self, contents):
+        return self.default.decompress(contents)
+
+    def compressobj(self):
+        return self.default.compressobj()
+
+    def decompressobj(self):
+        return self.default.decompressobj()
+
+    def choose(self, name, sample):
+        rule = self.rules.get(splitext(name)[1].lower())
+        if rule is not None:
+            return rule
+        if not sample:
+            return 'stored'
+
+        sizes = [(codec_name, len(codec.compress(sample))) for codec_name, codec in self.codecs[1:]]
+        best = min(size for codec_name, size in sizes)
+        if best > len(sample) * (1 - self.min_saving):
+            return 'stored'
+        for codec_name, size in sizes:
+            if size <= best * (1 + self.tolerance):
+                return codec_name
+
+    def codec(self, name):
+        if name is None:
+            return self.default
+        try:
+            return self.codec_map[name]
+        except KeyError:
+            raise IOError('unknown codec %r' % name)
+
+    @property
+    def compressed_extension(self):
+        return self.default.compressed_extension
@@ -0,0 +1,162 @@
+import sys
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+
+
+class Future(object):
+    '''The result of a call running in the background.
+
+    This has the same methods as concurrent.futures.Future that callers
+    need: done, result, exception and add_done_callback.'''
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.finished = False
+        self.value = None
+        self.exc_info = None
+        self.callbacks = []
+
+    def done(self):
+        return self.finished
+
+    def result(self, timeout=None):
+        '''Waits for the call to finish and returns its result, or raises the
+        exception it raised.'''
+        self.wait(timeout)
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+    def exception(self, timeout=None):
+        self.wait(timeout)
+        return self.exc_info and self.exc_info[1]
+
+    def add_done_callback(self, callback):
+        '''Calls callback with the future once it is done. Callbacks run in
+        the thread which finished the call, so event loops should hand them
+        on to their own thread.'''
+        with self.condition:
+            if not self.finished:
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout=None):
+        end = timeout is not None and time.time() + timeout
+        with self.condition:
+            while not self.finished:
+                if end is False:
+                    self.condition.wait()
+                elif time.time() < end:
+                    self.condition.wait(end - time.time())
+                else:
+                    raise TimeoutError()
+
+    def set_result(self, value):
+        self.finish(value, None)
+
+    def set_exception_info(self, exc_info):
+        self.finish(None, exc_info)
+
+    def finish(self, value, exc_info):
+        with self.condition:
+            self.value = value
+            self.exc_info = exc_info
+            self.finished = True
+            self.condition.notify_all()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class TimeoutError(Exception):
+    pass
+
+
+class ThreadExecutor(object):
+    '''Runs calls on a pool of threads, returning a Future for each.
+
+    Any executor with the same submit method, such as a
+    concurrent.futures.ThreadPoolExecutor, can be used in its place.'''
+
+    def __init__(self, workers=4):
+        self.pool = ThreadPool(workers)
+
+    def submit(self, function, *args, **kwargs):
+        future = Future()
+        def run():
+            try:
+                value = function(*args, **kwargs)
+            except Exception:
+                future.set_exception_info(sys.exc_info())
+            else:
+                future.set_result(value)
+        self.pool.apply_async(run)
+        return future
+
+    def shutdown(self, wait=True):
+        self.pool.close()
+        if wait:
+            self.pool.join()
+
+
+class AsyncReader(object):
+    '''Wraps a Reader so files are read in the background, each method
+    returning a Future.'''
+
+    def __init__(self, reader, executor):
+        self.reader = reader
+        self.executor = executor
+
+    def get(self, version, name):
+        return self.executor.submit(self.reader.get, version, name)
+
+    def open(self, version, name):
+        return self.executor.submit(self.reader.open, version, name)
+
+    def get_range(self, version, name, ranges):
+        return self.executor.submit(self.reader.get_range, version, name, ranges)
+
+
+class AsyncPatcher(object):
+    '''Runs the client side of a PixiePatch in the background, so it can be
+    driven from an event loop.
+
+    Each method returns a Future. At most workers calls run at once, and each
+    runs on its own thread, so downloading, decompression, hashing and
+    patching never block the caller. One patcher can update many
+    installations at the same time.'''
+
+    def __init__(self, pixiepatch, workers=4, executor=None):
+        self.pixiepatch = pixiepatch
+        self.own_executor = executor is None
+        self.executor = executor or ThreadExecutor(workers)
+        self.reader = AsyncReader(pixiepatch.reader, self.executor)
+
+    def create_client_manifest(self, version, directory):
+        return self.executor.submit(self.pixiepatch.create_client_manifest, version, directory)
+
+    def get_patch_plan(self, client_manifest, target_version):
+        return self.executor.submit(self.pixiepatch.get_patch_plan, client_manifest, target_version)
+
+    def patch(self, directory, patch_plan, jobs=None):
+        return self.executor.submit(self.pixiepatch.patch, directory, patch_plan, jobs)
+
+    def update(self, directory, version, target_version, jobs=None):
+        '''Brings an installation from version up to target_version. The
+        Future's result is the patch plan which was applied, or None if
+        there was nothing to do.'''
+        return self.executor.submit(self.run_update, directory, version, target_version, jobs)
+
+    def run_update(self, directory, version, target_version, jobs):
+        client_manifest = self.pixiepatch.create_client_manifest(version, directory)
+        plan = self.pixiepatch.get_patch_plan(client_manifest, target_version)
+        if plan:
+            self.pixiepatch.patch(directory, plan, jobs)
+        return plan
+
+    def shutdown(self, wait=True):
+        '''Stops the executor, if the patcher made it.'''
+        if self.own_executor:
+            self.executor.shutdown(wait)
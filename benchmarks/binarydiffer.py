@@ -0,0 +1,43 @@
+'''Times BinaryDiffer on files with small edits, half rewritten and wholly
+rewritten, reporting the throughput and delta size of each.
+
+Run from the directory containing the pixiepatch package:
+
+    python -m pixiepatch.benchmarks.binarydiffer [size] [edits]
+'''
+import os
+import sys
+import time
+import random
+
+from pixiepatch.binarydiffer import BinaryDiffer
+
+
+def edited(rand, data, edits):
+    data = bytearray(data)
+    for i in range(edits):
+        pos = rand.randrange(len(data))
+        data[pos:pos + 10] = os.urandom(rand.randint(0, 30))
+    return str(data)
+
+
+def run(size, edits):
+    rand = random.Random(1)
+    source = os.urandom(size)
+    cases = [
+        ('small edits', edited(rand, source, edits)),
+        ('half rewritten', source[:size // 2] + os.urandom(size - size // 2)),
+        ('rewritten', os.urandom(size)),
+    ]
+    differ = BinaryDiffer()
+    for name, target in cases:
+        start = time.time()
+        delta = differ.diff(source, target)
+        elapsed = time.time() - start
+        print '%-16s %8i bytes  %8.3fs  %6.2fMB/s  delta %8i bytes' % (
+            name, len(target), elapsed, len(target) / max(elapsed, 1e-9) / 1e6, len(delta))
+
+
+if __name__ == '__main__':
+    size, edits = [int(arg) for arg in sys.argv[1:]] + [1 << 20, 50][len(sys.argv) - 1:]
+    run(size, edits)
@@ -0,0 +1,370 @@
+'''Times building, planning and applying updates of synthetic distributions.
+
+Run from the directory containing the pixiepatch package:
+
+    python -m pixiepatch.benchmarks.harness --files 2000 --versions 3 \\
+        --latency 0.02 --bandwidth 10e6 --output results.json
+
+and compare two runs with:
+
+    python -m pixiepatch.benchmarks.harness --compare old.json new.json
+'''
+import os
+from os.path import join, exists, dirname
+import sys
+import time
+import random
+import shutil
+import tempfile
+import resource
+import argparse
+import threading
+from zipfile import ZipFile
+import simplejson
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from pixiepatch import PixiePatch, Compressor
+from pixiepatch.reader import Reader, RANGE_GAP, MAX_RANGES, coalesce
+from pixiepatch.bz2compressor import BZ2Compressor
+from pixiepatch.adaptivecompressor import AdaptiveCompressor
+from pixiepatch.binarydiffer import BinaryDiffer
+from pixiepatch.ziphandler import ZIPHandler
+from pixiepatch.metrics import Metrics, ProfilingMetrics
+from pixiepatch.costmodel import DeltaCostModel
+
+
+COMPRESSORS = {'none': Compressor, 'bz2': BZ2Compressor, 'adaptive': AdaptiveCompressor}
+WORDS = ['update', 'patch', 'version', 'manifest', 'archive', 'delta', 'client', 'server', 'file', 'hash']
+PAGE_SIZE = resource.getpagesize()
+
+
+class SimulatedReader(Reader):
+    '''Reads a local distribution as if over a network with the given latency
+    per request and bandwidth in bytes per second. Requests and bytes are
+    counted, even when several patch threads read at once.'''
+
+    def __init__(self, prefix, latency=0, bandwidth=None):
+        self.prefix = prefix
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+
+    def count(self, requests, size):
+        with self.lock:
+            self.requests += requests
+            self.bytes += size
+
+    def get(self, version, name):
+        try:
+            with open(join(self.prefix + version, *name.split('/')), 'rb') as f:
+                contents = f.read()
+        except IOError:
+            time.sleep(self.latency)
+            raise
+        self.count(1, len(contents))
+        time.sleep(self.latency + (len(contents) / float(self.bandwidth) if self.bandwidth else 0))
+        return contents
+
+    def get_range(self, version, name, ranges):
+        # like URLReader, asking for up to MAX_RANGES groups of nearby ranges
+        # in each request
+        pieces = {}
+        groups = coalesce(ranges, RANGE_GAP)
+        with open(join(self.prefix + version, *name.split('/')), 'rb') as f:
+            for i, (start, end, group) in enumerate(groups):
+                f.seek(start)
+                contents = f.read(end - start)
+                if i % MAX_RANGES == 0:
+                    self.count(1, 0)
+                    time.sleep(self.latency)
+                self.count(0, len(contents))
+                time.sleep(len(contents) / float(self.bandwidth) if self.bandwidth else 0)
+                for offset, size in group:
+                    pieces[offset, size] = contents[offset - start:offset - start + size]
+        return [pieces[offset, size] for offset, size in ranges]
+
+
+class Tree(object):
+    '''A synthetic source tree, changed a little for each version.'''
+
+    def __init__(self, rand, options):
+        self.rand = rand
+        self.options = options
+        self.files = {}
+        for i in range(options.files):
+            self.files[self.new_name(i)] = self.new_contents()
+
+    def new_name(self, i):
+        name = 'dir%02i/file%06i' % (i % 50, i)
+        if self.rand.random() < self.options.archive_share:
+            return 'archive%02i.zip/%s' % (i % 10, name)
+        return name
+
+    def new_contents(self):
+        size = int(self.rand.lognormvariate(0, self.options.size_sigma) * self.options.median_size)
+        return self.make_data(size)
+
+    def make_data(self, size):
+        # compressible text mixed with random bytes
+        pieces = []
+        total = 0
+        while total < size:
+            if self.rand.random() < self.options.compressibility:
+                piece = ' '.join(self.rand.choice(WORDS) for i in range(16)) + '\n'
+            else:
+                piece = os.urandom(64)
+            pieces.append(piece)
+            total += len(piece)
+        return ''.join(pieces)[:size]
+
+    def mutate(self):
+        '''Changes, adds and removes a share of the files.'''
+        names = sorted(self.files)
+        for name in self.rand.sample(names, int(len(names) * self.options.change_rate)):
+            action = self.rand.random()
+            contents = self.files[name]
+            if action < 0.8 and contents:
+                # edit a small part of the file
+                start = self.rand.randrange(len(contents))
+                end = min(len(contents), start + self.rand.randrange(1, 256))
+                self.files[name] = contents[:start] + self.make_data(end - start) + contents[end:]
+            elif action < 0.9:
+                del self.files[name]
+            else:
+                self.files[self.new_name(self.rand.randrange(10 ** 6))] = self.new_contents()
+
+    def write(self, directory):
+        archives = {}
+        for name, contents in self.files.items():
+            if '.zip/' in name:
+                archive, member = name.split('/', 1)
+                archives.setdefault(archive, []).append((member, contents))
+                continue
+            path = join(directory, *name.split('/'))
+            if not exists(dirname(path)):
+                os.makedirs(dirname(path))
+            with open(path, 'wb') as f:
+                f.write(contents)
+        for archive, members in archives.items():
+            with ZipFile(join(directory, archive), 'w') as zip:
+                for member, contents in sorted(members):
+                    zip.writestr(member, contents)
+
+
+def current_rss():
+    '''Returns the resident set size of this process and its children, such
+    as build workers, in bytes, or None if it cannot be found. Pages a child
+    shares with this process are counted twice.'''
+    if psutil is not None:
+        process = psutil.Process()
+        total = 0
+        for p in [process] + process.children(recursive=True):
+            try:
+                total += p.memory_info().rss
+            except psutil.Error:
+                # the child has exited
+                pass
+        return total
+    if not exists('/proc/self/stat'):
+        return None
+    total = 0
+    for pid in [os.getpid()] + child_pids():
+        try:
+            with open('/proc/%i/stat' % pid) as f:
+                # the name in brackets may contain spaces
+                fields = f.read().rsplit(')', 1)[1].split()
+        except IOError:
+            continue
+        total += int(fields[21]) * PAGE_SIZE
+    return total
+
+
+def child_pids():
+    '''Returns the pids of this process's children from /proc.'''
+    pids = []
+    for tid in os.listdir('/proc/self/task'):
+        try:
+            with open('/proc/self/task/%s/children' % tid) as f:
+                pids.extend(int(pid) for pid in f.read().split())
+        except IOError:
+            pass
+    return pids
+
+
+class RSSSampler(threading.Thread):
+    '''Samples the resident set size in the background, keeping the peak.
+
+    ru_maxrss is the peak over the whole life of the process, so it cannot
+    give the peak of a single phase.'''
+
+    def __init__(self, interval=0.01):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.peak = current_rss()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        rss = current_rss()
+        if rss is not None:
+            self.peak = max(self.peak, rss)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+        return self.peak
+
+
+def cpu_times():
+    '''Returns the CPU time used by this process and by its children which
+    have exited, such as the workers of a finished build.'''
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def timed(results, phase, function, *args, **kwargs):
+    sampler = RSSSampler()
+    sampler.start()
+    start = time.time()
+    cpu = cpu_times()
+    try:
+        value = function(*args, **kwargs)
+    finally:
+        peak = sampler.stop()
+    results.append({'phase': phase, 'wall': time.time() - start, 'cpu': cpu_times() - cpu, 'peak_rss': peak})
+    return value
+
+
+def make_pixiepatch(options, metrics, reader=None):
+    pp = PixiePatch(compressor=COMPRESSORS[options.compressor](),
+                    differ=BinaryDiffer() if options.differ == 'binary' else None, reader=reader, metrics=metrics,
+                    cost_model=DeltaCostModel(budget=options.diff_budget) if options.cost_model else None)
+    pp.register_archive_handler('.zip', ZIPHandler())
+    return pp
+
+
+def run(options, metrics):
+    rand = random.Random(options.seed)
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        tree = Tree(rand, options)
+        sources = []
+        for i in range(options.versions):
+            if i:
+                tree.mutate()
+            source = join(directory, 'source-%i' % (i + 1))
+            os.makedirs(source)
+            tree.write(source)
+            sources.append(source)
+
+        pp = make_pixiepatch(options, metrics)
+        previous = None
+        for i, source in enumerate(sources):
+            target = join(directory, 'dist-%i' % (i + 1))
+            os.makedirs(target)
+            timed(results, 'make_distribution %i' % (i + 1), pp.make_distribution, str(i + 1), source, target,
+                  previous, jobs=options.jobs, pack_threshold=options.pack_threshold)
+            previous = target
+
+        # update a copy of each older version to the latest
+        latest = str(len(sources))
+        for i, source in enumerate(sources[:-1]):
+            hop = '%i->%s' % (i + 1, latest)
+            client = join(directory, 'client-%i' % (i + 1))
+            shutil.copytree(source, client)
+            reader = SimulatedReader(join(directory, 'dist-'), options.latency, options.bandwidth)
+            pp = make_pixiepatch(options, metrics, reader)
+            manifest = timed(results, 'create_client_manifest ' + hop, pp.create_client_manifest, str(i + 1), client)
+            plan = timed(results, 'get_patch_plan ' + hop, pp.get_patch_plan, manifest, latest)
+            results[-1].update(requests=reader.requests, bytes=reader.bytes, planned_bytes=plan['size'])
+            reader.requests = reader.bytes = 0
+            timed(results, 'patch ' + hop, pp.patch, client, plan, jobs=options.patch_jobs)
+            results[-1].update(requests=reader.requests, bytes=reader.bytes)
+    finally:
+        shutil.rmtree(directory)
+    return {'options': vars(options), 'results': results}
+
+
+def report(run):
+    print '%-28s %9s %9s %10s %8s %12s' % ('phase', 'wall (s)', 'cpu (s)', 'bytes', 'requests', 'peak rss')
+    for result in run['results']:
+        rss = result['peak_rss']
+        print '%-28s %9.3f %9.3f %10s %8s %12s' % (
+            result['phase'], result['wall'], result['cpu'], result.get('bytes', ''), result.get('requests', ''),
+            '-' if rss is None else '%.1fMB' % (rss / 1e6))
+
+
+def compare(old, new):
+    old_results = dict((result['phase'], result) for result in old['results'])
+    print '%-28s %9s %9s %7s %10s %10s' % ('phase', 'old (s)', 'new (s)', 'ratio', 'old bytes', 'new bytes')
+    for result in new['results']:
+        before = old_results.get(result['phase'])
+        if before is None:
+            continue
+        print '%-28s %9.3f %9.3f %6.2fx %10s %10s' % (
+            result['phase'], before['wall'], result['wall'], before['wall'] / max(result['wall'], 1e-9),
+            before.get('bytes', ''), result.get('bytes', ''))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks PixiePatch on synthetic distributions.')
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--median-size', type=int, default=8192, help='median file size in bytes')
+    parser.add_argument('--size-sigma', type=float, default=1.5, help='spread of the log-normal file sizes')
+    parser.add_argument('--change-rate', type=float, default=0.05, help='share of files changed per version')
+    parser.add_argument('--archive-share', type=float, default=0.2, help='share of files inside zip archives')
+    parser.add_argument('--compressibility', type=float, default=0.7, help='share of file data which is text')
+    parser.add_argument('--versions', type=int, default=3)
+    parser.add_argument('--compressor', choices=sorted(COMPRESSORS), default='bz2')
+    parser.add_argument('--differ', choices=['none', 'binary'], default='binary')
+    parser.add_argument('--cost-model', action='store_true', help='skip diffs which are not expected to pay off')
+    parser.add_argument('--diff-budget', type=float, default=None, help='seconds to spend diffing, with --cost-model')
+    parser.add_argument('--pack-threshold', type=int, default=None, help='pack files and deltas up to this size')
+    parser.add_argument('--jobs', type=int, default=None, help='build worker processes')
+    parser.add_argument('--patch-jobs', type=int, default=None, help='patch worker threads')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per request')
+    parser.add_argument('--bandwidth', type=float, default=None, help='bytes per second')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--profile', action='store_true', help='report phases and profile them with cProfile')
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two saved runs')
+    options = parser.parse_args(argv)
+
+    if options.compare:
+        runs = []
+        for name in options.compare:
+            with open(name, 'rb') as f:
+                runs.append(simplejson.loads(f.read()))
+        compare(*runs)
+        return
+
+    metrics = ProfilingMetrics(keep_events=False) if options.profile else Metrics()
+    results = run(options, metrics)
+    report(results)
+    if options.profile:
+        print
+        print metrics.report()
+        print
+        print metrics.stats()
+    if options.output:
+        with open(options.output, 'wb') as f:
+            f.write(simplejson.dumps(results, indent=4, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
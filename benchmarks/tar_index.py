@@ -0,0 +1,82 @@
+'''Compares reading members of a tar archive through TARHandler's index with
+scanning the archive for each member, and walking an archive and reading
+every member, as a build or client manifest does, with opening each member
+on its own.
+
+Run from the directory containing the pixiepatch package:
+
+    python -m pixiepatch.benchmarks.tar_index [members] [member_size] [reads]
+'''
+import os
+import sys
+import time
+import random
+import tarfile
+import tempfile
+import shutil
+from io import BytesIO
+
+from pixiepatch.tarhandler import TARHandler, compression
+
+
+def make_archive(name, members, member_size):
+    with tarfile.open(name, 'w:' + compression(name)) as tar:
+        for i in range(members):
+            info = tarfile.TarInfo('dir/member-%06i' % i)
+            info.size = member_size
+            tar.addfile(info, BytesIO(os.urandom(member_size)))
+
+
+def linear_get(archive, name):
+    '''How a handler without an index reads a member.'''
+    with tarfile.open(archive, 'r:' + compression(archive)) as tar:
+        return tar.extractfile(tar.getmember(name)).read()
+
+
+def run(extension, members, member_size, reads):
+    directory = tempfile.mkdtemp()
+    try:
+        archive = os.path.join(directory, 'archive' + extension)
+        make_archive(archive, members, member_size)
+        names = ['dir/member-%06i' % random.randrange(members) for i in range(reads)]
+
+        start = time.time()
+        for name in names:
+            linear_get(archive, name)
+        linear = time.time() - start
+
+        handler = TARHandler()
+        start = time.time()
+        for name in names:
+            handler.get(archive, name)
+        indexed = time.time() - start
+
+        print '%-8s %6i members  %6i reads  linear %8.3fs  indexed %8.3fs  (%.0fx)' % (
+            extension, members, reads, linear, indexed, linear / max(indexed, 1e-9))
+
+        handler = TARHandler()
+        start = time.time()
+        for info in handler.index(archive).values():
+            with handler.open_member(archive, info) as f:
+                f.read()
+        separate = time.time() - start
+
+        handler = TARHandler()
+        start = time.time()
+        for name, source, mode in handler.walk(archive):
+            if hasattr(source, 'open'):
+                with source.open() as f:
+                    f.read()
+        walked = time.time() - start
+
+        print '%-8s %6i members  walk       separate %8.3fs  walk    %8.3fs  (%.0fx)' % (
+            extension, members, separate, walked, separate / max(walked, 1e-9))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    members, member_size, reads = [int(arg) for arg in sys.argv[1:]] + [2000, 4096, 50][len(sys.argv) - 1:]
+    random.seed(1)
+    for extension in ('.tar', '.tar.gz'):
+        run(extension, members, member_size, reads)
@@ -0,0 +1,358 @@
+import os
+import mmap
+import shutil
+import tempfile
+from io import BytesIO
+from contextlib import contextmanager
+from differ import Differ, DiffError
+from compressor import CHUNK_SIZE
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+MAGIC = 'PXBD'
+COPY = 0
+INSERT = 1
+
+
+class BinaryDiffer(Differ):
+    '''A differ for arbitrary binary files.
+
+    Deltas are a series of copies from the source and inserts of new data.
+    Copies are found using a suffix array of the source, built with NumPy if
+    it is available.'''
+
+    def __init__(self, min_match=12, window=64, use_numpy=True):
+        self.min_match = min_match
+        self.window = window
+        self.use_numpy = use_numpy
+
+    def diff(self, source, target):
+        return self.diff_bounded(source, target, None)
+
+    def diff_bounded(self, source, target, limit):
+        '''Diffs as diff does, raising DiffError as soon as the delta is
+        longer than limit.
+
+        A match of at least 2 * min_match - 1 bytes must cover one of the
+        source's aligned blocks of min_match bytes, so the suffix array is only
+        searched where a block of the source appears in the target. A byte
+        with no such block costs one lookup, which keeps rewritten files
+        quick to diff. Shorter matches are sometimes missed.'''
+        source = bytes(source)
+        target = bytes(target)
+        if self.use_numpy and numpy is not None:
+            sa = numpy_suffix_array(source)
+        else:
+            sa = suffix_array(source)
+        m = self.min_match
+        blocks = {}
+        for i in xrange(len(source) - m, -1, -m):
+            # keep the first of any repeated blocks
+            blocks[source[i:i + m]] = i
+
+        out = bytearray(MAGIC)
+        write_varint(out, len(target))
+        last_end = 0
+        insert_start = 0
+        pos = 0
+        while pos < len(target):
+            block = blocks.get(target[pos:pos + m])
+            if block is None:
+                pos += 1
+                continue
+            # the match may start before the block
+            start = pos
+            while start > insert_start and block > 0 and source[block - 1] == target[start - 1]:
+                start -= 1
+                block -= 1
+            offset, length = block, match_length(source, block, target, start)
+            found_offset, found_length = self.find_match(source, sa, target, start)
+            if found_length > length:
+                offset, length = found_offset, found_length
+            if length < m:
+                pos += 1
+                continue
+            if insert_start < start:
+                write_varint(out, (start - insert_start) << 1 | INSERT)
+                out += target[insert_start:start]
+            write_varint(out, length << 1 | COPY)
+            write_varint(out, zigzag(offset - last_end))
+            last_end = offset + length
+            pos = start + length
+            insert_start = pos
+            if limit is not None and len(out) > limit:
+                raise DiffError()
+        if limit is not None and len(out) + len(target) - insert_start > limit:
+            raise DiffError()
+        if insert_start < len(target):
+            write_varint(out, (len(target) - insert_start) << 1 | INSERT)
+            out += target[insert_start:]
+        return bytes(out)
+
+    def patch(self, source, patch):
+        return ''.join(apply_ops(source, BytesIO(patch)))
+
+    def patch_file(self, source, patch, out):
+        '''Patches a source file, memory mapped if it is on disk, streaming
+        the patch and the result a block at a time.'''
+        with mapped(source) as data:
+            for piece in apply_ops(data, patch):
+                out.write(piece)
+
+    def find_match(self, source, sa, target, pos):
+        '''Returns the offset and length of the longest match in source for
+        target at pos.'''
+        if not sa:
+            return 0, 0
+        # binary search the suffix array on a window of the target, then
+        # measure the full match of the neighbouring suffixes
+        key = target[pos:pos + self.window]
+        lo, hi = 0, len(sa)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if source[sa[mid]:sa[mid] + self.window] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        best_offset, best_length = 0, 0
+        for i in (lo - 1, lo):
+            if 0 <= i < len(sa):
+                length = match_length(source, sa[i], target, pos)
+                if length > best_length:
+                    best_offset, best_length = sa[i], length
+        return best_offset, best_length
+
+    extension = '.bdiff'
+
+
+def apply_ops(source, patch):
+    '''Yields the pieces of the patched file, reading the patch from a file
+    object, and raising DiffError if the patch is not valid for source.
+
+    Long copies and inserts are yielded in pieces of at most CHUNK_SIZE.'''
+    reader = PatchReader(patch)
+    if reader.read(len(MAGIC)) != MAGIC:
+        raise DiffError()
+    target_length = reader.varint()
+    written = 0
+    last_end = 0
+    while not reader.at_end():
+        header = reader.varint()
+        length = header >> 1
+        if header & 1 == INSERT:
+            for pos in xrange(0, length, CHUNK_SIZE):
+                yield reader.read(min(CHUNK_SIZE, length - pos))
+        else:
+            offset = last_end + unzigzag(reader.varint())
+            last_end = offset + length
+            if offset < 0 or last_end > len(source):
+                raise DiffError()
+            for pos in xrange(offset, last_end, CHUNK_SIZE):
+                yield source[pos:min(pos + CHUNK_SIZE, last_end)]
+        written += length
+    if written != target_length:
+        raise DiffError()
+
+
+class PatchReader(object):
+    '''Reads the fields of a patch from a file object a block at a time.'''
+
+    def __init__(self, f, block_size=CHUNK_SIZE):
+        self.f = f
+        self.block_size = block_size
+        self.buffer = ''
+        self.pos = 0
+
+    def at_end(self):
+        if self.pos < len(self.buffer):
+            return False
+        self.buffer = self.f.read(self.block_size)
+        self.pos = 0
+        return not self.buffer
+
+    def read(self, size):
+        '''Returns the next size bytes, raising DiffError if the patch ends
+        first.'''
+        if self.pos + size > len(self.buffer):
+            parts = [self.buffer[self.pos:]]
+            needed = size - len(parts[0])
+            while needed > 0:
+                more = self.f.read(max(needed, self.block_size))
+                if not more:
+                    raise DiffError()
+                parts.append(more)
+                needed -= len(more)
+            self.buffer = ''.join(parts)
+            self.pos = 0
+        data = self.buffer[self.pos:self.pos + size]
+        self.pos += size
+        return data
+
+    def varint(self):
+        value = 0
+        shift = 0
+        while True:
+            if self.at_end():
+                raise DiffError()
+            byte = ord(self.buffer[self.pos])
+            self.pos += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+
+@contextmanager
+def mapped(f):
+    '''Gives the contents of a file object memory mapped. Files which are not
+    on disk, such as archive members, are copied to a temporary file first.'''
+    try:
+        if hasattr(f, 'flush'):
+            f.flush()
+        fileno = f.fileno()
+        os.fstat(fileno)
+    except (AttributeError, IOError, OSError, ValueError):
+        with tempfile.TemporaryFile() as tmp:
+            shutil.copyfileobj(f, tmp, CHUNK_SIZE)
+            tmp.flush()
+            with map_file(tmp.fileno()) as data:
+                yield data
+        return
+    with map_file(fileno) as data:
+        yield data
+
+
+@contextmanager
+def map_file(fileno):
+    # empty files cannot be mapped
+    if not os.fstat(fileno).st_size:
+        yield ''
+        return
+    data = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    try:
+        yield data
+    finally:
+        data.close()
+
+
+def match_length(source, i, target, j):
+    '''Returns the length of the common prefix of source[i:] and target[j:].'''
+    limit = min(len(source) - i, len(target) - j)
+    length = 0
+    step = 32
+    while length < limit:
+        size = min(step, limit - length)
+        if source[i + length:i + length + size] == target[j + length:j + length + size]:
+            length += size
+            step *= 2
+        elif size == 1:
+            break
+        else:
+            step = max(1, size // 2)
+    return length
+
+
+def suffix_array(data, prefix=16):
+    '''Returns the suffix array of data.
+
+    Suffixes are first sorted on their leading bytes, then by prefix doubling
+    which only re-sorts the groups of suffixes that are still tied
+    (Larsson-Sadakane), so most rounds touch little data.'''
+    n = len(data)
+    sa = sorted(xrange(n), key=lambda i: data[i:i + prefix])
+    rank = [0] * n
+    groups = split_groups(sa, rank, 0, [data[i:i + prefix] for i in sa])
+    k = prefix
+    while groups:
+        # rank suffixes by the next k bytes, only updating ranks once every
+        # group has been sorted
+        updates = []
+        for start, end in groups:
+            keys = [rank[i + k] if i + k < n else -1 for i in sa[start:end]]
+            order = sorted(xrange(end - start), key=keys.__getitem__)
+            sa[start:end] = [sa[start + j] for j in order]
+            updates.append((start, [keys[j] for j in order]))
+        groups = []
+        for start, keys in updates:
+            groups.extend(split_groups(sa, rank, start, keys))
+        k *= 2
+    return sa
+
+
+def split_groups(sa, rank, start, keys):
+    '''Ranks sa[start:start + len(keys)] by the start of its run of equal
+    keys and returns the runs which are still tied.'''
+    groups = []
+    group_start = 0
+    for j in xrange(1, len(keys) + 1):
+        if j == len(keys) or keys[j] != keys[group_start]:
+            for i in xrange(group_start, j):
+                rank[sa[start + i]] = start + group_start
+            if j - group_start > 1:
+                groups.append((start + group_start, start + j))
+            group_start = j
+    return groups
+
+
+def numpy_suffix_array(data):
+    '''Returns the suffix array of data.
+
+    This is the same algorithm as suffix_array, vectorised with NumPy.'''
+    n = len(data)
+    if not n:
+        return []
+    # start from the leading 7 bytes of each suffix packed into an integer,
+    # as byte + 1 so the end of the data sorts before any byte
+    padded = numpy.zeros(n + 6, dtype=numpy.uint64)
+    padded[:n] = numpy.frombuffer(data, dtype=numpy.uint8)
+    padded[:n] += 1
+    key = numpy.zeros(n, dtype=numpy.uint64)
+    for i in range(7):
+        key = (key << numpy.uint64(9)) | padded[i:i + n]
+    sa = numpy.argsort(key)
+    rank = numpy.empty(n, dtype=numpy.int64)
+    positions = numpy.arange(n)
+    unsorted = numpy_split_groups(sa, rank, positions, key[sa], key[sa])
+    k = 7
+    while unsorted.size:
+        # re-sort the tied groups by the rank of the suffix k bytes on; the
+        # groups keep their places as they are ordered by their start
+        suffixes = sa[unsorted]
+        group = rank[suffixes]
+        after = suffixes + k
+        second = numpy.where(after < n, rank[numpy.minimum(after, n - 1)], -1)
+        order = numpy.lexsort((second, group))
+        sa[unsorted] = suffixes[order]
+        unsorted = numpy_split_groups(sa, rank, unsorted, group[order], second[order])
+        k *= 2
+    return sa.tolist()
+
+
+def numpy_split_groups(sa, rank, positions, first, second):
+    '''Ranks the suffixes at positions of sa by the start of their run of
+    equal keys and returns the positions which are still tied.'''
+    start = numpy.empty(len(positions), dtype=bool)
+    start[0] = True
+    start[1:] = (first[1:] != first[:-1]) | (second[1:] != second[:-1])
+    group = numpy.cumsum(start) - 1
+    rank[sa[positions]] = positions[start][group]
+    return positions[numpy.bincount(group)[group] > 1]
+
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def zigzag(value):
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
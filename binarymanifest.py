@@ -0,0 +1,130 @@
+import struct
+from binascii import hexlify, unhexlify
+from collections import Mapping
+import simplejson
+
+
+MAGIC = 'PXBM'
+FORMAT_VERSION = 1
+
+# magic, format version, entry count, string table size, extras size,
+# manifest extras size, version string size
+HEADER = struct.Struct('<4sIIIIII')
+# path offset, path size, hash, dlsize, mode, extras offset, extras size
+RECORD = struct.Struct('<II32sQiII')
+
+NO_MODE = -1
+
+
+def dumps(manifest):
+    '''Encodes a manifest in the binary format.
+
+    Entries are fixed size records sorted by path, with binary hashes,
+    offsets into a table of paths and compact JSON for any other fields.'''
+    files = manifest['files']
+    names = sorted(files, key=utf8)
+    records = []
+    strings = []
+    extras = []
+    string_size = 0
+    extras_size = 0
+    for name in names:
+        entry = files[name]
+        path = utf8(name)
+        extra = dict((key, value) for key, value in entry.items()
+                     if key not in ('hash', 'dlsize', 'mode') and not (key == 'delta' and value is None))
+        extra = extra and simplejson.dumps(extra, sort_keys=True, separators=(',', ':')) or ''
+        mode = entry.get('mode')
+        records.append(RECORD.pack(string_size, len(path), unhexlify(entry['hash']), entry.get('dlsize', 0),
+                                   NO_MODE if mode is None else mode, extras_size, len(extra)))
+        strings.append(path)
+        extras.append(extra)
+        string_size += len(path)
+        extras_size += len(extra)
+
+    others = dict((key, value) for key, value in manifest.items() if key not in ('version', 'files'))
+    others = others and simplejson.dumps(others, sort_keys=True, separators=(',', ':')) or ''
+    version = utf8(manifest['version'])
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, len(names), string_size, extras_size, len(others), len(version))
+    return ''.join([header, version, others] + records + strings + extras)
+
+
+def loads(message):
+    '''Decodes a binary manifest. The files are not decoded until used.'''
+    try:
+        magic, format_version, count, string_size, extras_size, others_size, version_size = HEADER.unpack_from(message)
+    except struct.error:
+        raise ValueError('truncated manifest')
+    if magic != MAGIC or format_version != FORMAT_VERSION:
+        raise ValueError('not a binary manifest')
+    pos = HEADER.size
+    version = message[pos:pos + version_size].decode('utf-8')
+    pos += version_size
+    manifest = others_size and simplejson.loads(message[pos:pos + others_size]) or {}
+    pos += others_size
+    if len(message) != pos + count * RECORD.size + string_size + extras_size:
+        raise ValueError('truncated manifest')
+    manifest['version'] = version
+    manifest['files'] = BinaryFiles(message, pos, count, pos + count * RECORD.size,
+                                    pos + count * RECORD.size + string_size)
+    return manifest
+
+
+def utf8(name):
+    '''Returns a name as UTF-8. Names read from disk are already UTF-8 byte
+    strings, those read from JSON are unicode.'''
+    return name.encode('utf-8') if isinstance(name, unicode) else name
+
+
+def is_binary(message):
+    return message[:len(MAGIC)] == MAGIC
+
+
+class BinaryFiles(Mapping):
+    '''The files of a binary manifest, looked up by binary search.'''
+
+    def __init__(self, message, records, count, strings, extras):
+        self.message = message
+        self.records = records
+        self.count = count
+        self.strings = strings
+        self.extras = extras
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield self.path(i).decode('utf-8')
+
+    def __getitem__(self, name):
+        path = utf8(name)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.path(mid) < path:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.count or self.path(lo) != path:
+            raise KeyError(name)
+        return self.entry(lo)
+
+    def iteritems(self):
+        '''Yields (name, entry) pairs in path order.'''
+        for i in xrange(self.count):
+            yield self.path(i).decode('utf-8'), self.entry(i)
+
+    def path(self, i):
+        offset, size = struct.unpack_from('<II', self.message, self.records + i * RECORD.size)
+        return self.message[self.strings + offset:self.strings + offset + size]
+
+    def entry(self, i):
+        offset, size, hash, dlsize, mode, extra_offset, extra_size = RECORD.unpack_from(self.message, self.records + i * RECORD.size)
+        entry = {'hash': hexlify(hash), 'dlsize': dlsize, 'delta': None}
+        if mode != NO_MODE:
+            entry['mode'] = mode
+        if extra_size:
+            start = self.extras + extra_offset
+            entry.update(simplejson.loads(self.message[start:start + extra_size]))
+        return entry
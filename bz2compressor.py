@@ -3,10 +3,32 @@ import bz2
 from compressor import Compressor
 
 class BZ2Compressor(Compressor):
+    def __init__(self, level=9):
+        self.level = level
+
     def compress(self, contents):
-        return bz2.compress(contents)
+        return bz2.compress(contents, self.level)
 
     def decompress(self, contents):
         return bz2.decompress(contents)
 
+    def compressobj(self):
+        return bz2.BZ2Compressor(self.level)
+
+    def decompressobj(self):
+        return BZ2Decompressor()
+
     compressed_extension = '.bz2'
+
+
+class BZ2Decompressor(object):
+    '''bz2.BZ2Decompressor with the flush() the other incremental codecs have.'''
+
+    def __init__(self):
+        self.decompressor = bz2.BZ2Decompressor()
+
+    def decompress(self, data):
+        return self.decompressor.decompress(data)
+
+    def flush(self):
+        return ''
@@ -0,0 +1,109 @@
+import hashlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# a fixed table of random values for the gear hash, derived so it is the same
+# everywhere
+GEAR = [int(hashlib.sha256(chr(i)).hexdigest()[:8], 16) for i in range(256)]
+WINDOW = 32
+
+
+class Chunker(object):
+    '''Splits files into content-defined chunks.
+
+    Chunk boundaries are chosen where a rolling gear hash of the last 32
+    bytes matches a mask, so an edit only changes the chunks around it and
+    the rest of the file splits the same way as before.'''
+
+    def __init__(self, min_size=1 << 11, avg_size=1 << 13, max_size=1 << 16, min_file_size=1 << 20, use_numpy=True):
+        if min_size < WINDOW or not min_size <= avg_size <= max_size:
+            raise ValueError('chunk sizes must satisfy %i <= min_size <= avg_size <= max_size' % WINDOW)
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.min_file_size = min_file_size
+        self.use_numpy = use_numpy
+        bits = max(avg_size.bit_length() - 1, 1)
+        # use the high bits of the hash, which depend on the whole window
+        self.mask = ((1 << bits) - 1) << (32 - bits)
+
+    def applies(self, size):
+        '''Returns True if files of this size should be chunked.'''
+        return size is not None and size >= self.min_file_size
+
+    def params(self):
+        return [self.min_size, self.avg_size, self.max_size]
+
+    def chunks(self, f, buffer_size=1 << 22):
+        '''Yields the chunks of a file object.'''
+        buffer_size = max(buffer_size, 2 * self.max_size)
+        data = ''
+        eof = False
+        while not eof or data:
+            if not eof:
+                more = f.read(buffer_size - len(data))
+                if more:
+                    data += more
+                else:
+                    eof = True
+                if len(data) < buffer_size and not eof:
+                    continue
+            start = 0
+            for end in self.boundaries(data, eof):
+                yield data[start:end]
+                start = end
+            data = data[start:]
+            if eof and data:
+                yield data
+                data = ''
+
+    def boundaries(self, data, final):
+        '''Returns the ends of the chunks in data. Unless final, the last chunk
+        is left out as it may continue past the end of data.'''
+        if self.use_numpy and numpy is not None:
+            candidates = self.numpy_candidates(data)
+        else:
+            candidates = None
+        ends = []
+        start = 0
+        while len(data) - start > (0 if final else self.max_size):
+            end = self.find_end(data, start, candidates)
+            if end is None:
+                break
+            ends.append(end)
+            start = end
+        return ends
+
+    def find_end(self, data, start, candidates):
+        limit = min(start + self.max_size, len(data))
+        first = start + self.min_size
+        if first > limit:
+            return limit
+        if candidates is not None:
+            i = numpy.searchsorted(candidates, first - 1)
+            if i < len(candidates) and candidates[i] < limit:
+                return int(candidates[i]) + 1
+            return limit
+        mask = self.mask
+        h = 0
+        for i in xrange(first - WINDOW, limit):
+            h = ((h << 1) + GEAR[ord(data[i])]) & 0xffffffff
+            if i >= first - 1 and not h & mask:
+                return i + 1
+        return limit
+
+    def numpy_candidates(self, data):
+        '''Returns every position in data where the gear hash matches the
+        mask.'''
+        n = len(data)
+        if n < WINDOW:
+            return numpy.zeros(0, dtype=numpy.int64)
+        values = numpy.array(GEAR, dtype=numpy.uint32)[numpy.frombuffer(data, dtype=numpy.uint8)]
+        h = numpy.zeros(n - WINDOW + 1, dtype=numpy.uint32)
+        for j in range(WINDOW):
+            h += values[WINDOW - 1 - j:n - j] << numpy.uint32(j)
+        return numpy.flatnonzero((h & numpy.uint32(self.mask)) == 0) + (WINDOW - 1)
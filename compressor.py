@@ -1,3 +1,6 @@
+CHUNK_SIZE = 1 << 16
+
+
 class Compressor(object):
     '''A file compression interface.'''
 
@@ -7,6 +10,43 @@ class Compressor(object):
     def decompress(self, contents):
         return contents
 
+    def compressobj(self):
+        '''Returns an incremental compressor with compress() and flush().
+
+        Compressors that only override compress() get one that buffers the
+        whole input.'''
+        if type(self).compress == Compressor.compress:
+            return PassThrough()
+        return Buffered(self.compress)
+
+    def decompressobj(self):
+        '''Returns an incremental decompressor with decompress() and flush().'''
+        if type(self).decompress == Compressor.decompress:
+            return PassThrough()
+        return Buffered(self.decompress)
+
+    def compress_file(self, src, dst, chunk_size=CHUNK_SIZE):
+        '''Compresses file object src into dst and returns the bytes written.'''
+        codec = self.compressobj()
+        return copy_stream(src, dst, codec.compress, codec.flush, chunk_size)
+
+    def decompress_file(self, src, dst, chunk_size=CHUNK_SIZE):
+        '''Decompresses file object src into dst and returns the bytes written.'''
+        codec = self.decompressobj()
+        return copy_stream(src, dst, codec.decompress, codec.flush, chunk_size)
+
+    def choose(self, name, sample):
+        '''Picks the codec to compress a file with, given its name and its
+        first sample_size bytes.
+
+        Returns a codec name to record in the file's manifest entry, or None
+        to use this compressor.'''
+        return None
+
+    def codec(self, name):
+        '''Returns the compressor for a codec name returned by choose().'''
+        return self
+
     def add_extension(self, filename):
         return filename + self.compressed_extension
 
@@ -15,3 +55,55 @@ class Compressor(object):
             return filename[:-len(self.compressed_extension)]
 
     compressed_extension = ''
+    sample_size = 0
+
+
+class PassThrough(object):
+    '''An incremental codec which returns its input unchanged.'''
+
+    def compress(self, data):
+        return data
+
+    decompress = compress
+
+    def flush(self):
+        return ''
+
+
+class Buffered(object):
+    '''An incremental codec which collects its input and converts it on flush.'''
+
+    def __init__(self, convert):
+        self.convert = convert
+        self.parts = []
+
+    def compress(self, data):
+        self.parts.append(data)
+        return ''
+
+    decompress = compress
+
+    def flush(self):
+        contents = ''.join(self.parts)
+        self.parts = []
+        return self.convert(contents)
+
+
+def copy_stream(src, dst, convert, flush, chunk_size=CHUNK_SIZE):
+    '''Copies src to dst a chunk at a time through an incremental codec.
+
+    Returns the number of bytes written.'''
+    written = 0
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            break
+        out = convert(chunk)
+        if out:
+            dst.write(out)
+            written += len(out)
+    out = flush()
+    if out:
+        dst.write(out)
+        written += len(out)
+    return written
@@ -0,0 +1,80 @@
+import time
+import multiprocessing
+
+
+class DeltaCostModel(object):
+    '''Predicts whether diffing two versions of a file is worth the time.
+
+    Blocks are sampled from the new version and looked for among the blocks of
+    the old one. The share found estimates how much of the new version a delta
+    can copy, and so how big the delta will be compared to the whole file.
+    Files over max_size are never diffed, and once budget seconds have been
+    spent diffing no more deltas are made.
+
+    The time spent is shared with the worker processes of a parallel build,
+    so the budget covers the whole build, and it is reset by reset(), which
+    make_distribution calls.'''
+
+    def __init__(self, min_saving=0.2, max_size=64 << 20, budget=None, block_size=32, samples=64):
+        self.min_saving = min_saving
+        self.max_size = max_size
+        self.budget = budget
+        self.block_size = block_size
+        self.samples = samples
+        self.reset()
+
+    def reset(self):
+        '''Starts the budget again.'''
+        self.spent = multiprocessing.Value('d', 0.0)
+
+    def allows(self, size):
+        '''Returns False if a file of this size should not be diffed at all.'''
+        if self.budget is not None and self.spent.value >= self.budget:
+            return False
+        return size is None or self.max_size is None or size <= self.max_size
+
+    def similarity(self, source, target):
+        '''Returns the estimated share of target which can be copied from
+        source.'''
+        b = self.block_size
+        count = min(self.samples, len(target) // (2 * b))
+        if not count or len(source) < b:
+            return 0.0
+        # a sample is found if some block of the source starts within it, so
+        # only the source's aligned blocks need to be hashed
+        step = (len(target) - 2 * b) // max(count - 1, 1)
+        windows = {}
+        for i in xrange(count):
+            start = i * step
+            for j in xrange(start, start + b):
+                windows.setdefault(target[j:j + b], []).append(i)
+        found = set()
+        for i in xrange(0, len(source) - b + 1, b):
+            samples = windows.get(source[i:i + b])
+            if samples:
+                found.update(samples)
+                if len(found) == count:
+                    break
+        return len(found) / float(count)
+
+    def predict(self, source, target, full_size):
+        '''Returns the estimated size of a delta, given the size of the whole
+        file as it would be downloaded.'''
+        return int((1 - self.similarity(source, target)) * full_size)
+
+    def worthwhile(self, source, target, full_size):
+        '''Returns True if a delta is expected to save at least min_saving of
+        the whole file.'''
+        if len(target) < 2 * self.block_size * self.samples:
+            # small files are cheap to diff, and too small to sample well
+            return True
+        return self.predict(source, target, full_size) < full_size * (1 - self.min_saving)
+
+    def timed(self, diff, *args):
+        '''Calls diff, counting the time taken against the budget.'''
+        start = time.time()
+        try:
+            return diff(*args)
+        finally:
+            with self.spent.get_lock():
+                self.spent.value += time.time() - start
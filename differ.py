@@ -8,9 +8,30 @@ class Differ(object):
     def diff(self, source, target):
         raise DiffError()
 
+    def diff_bounded(self, source, target, limit):
+        '''Returns the diff of source and target, or raises DiffError if it
+        would be longer than limit. Differs which can give up early should
+        override this, by default the whole diff is made.'''
+        diff = self.diff(source, target)
+        if limit is not None and len(diff) > limit:
+            raise DiffError()
+        return diff
+
     def patch(self, source, patch):
         raise DiffError()
 
+    def diff_file(self, source, target, out):
+        '''Writes the diff of file objects source and target to out. Differs
+        which can work without loading both files should override this, by
+        default they are read with diff.'''
+        out.write(self.diff(source.read(), target.read()))
+
+    def patch_file(self, source, patch, out):
+        '''Writes source patched with patch to out, all file objects.
+        Differs which can work without loading the files should override
+        this, by default they are read with patch.'''
+        out.write(self.patch(source.read(), patch.read()))
+
     def add_extension(self, filename):
         return filename + self.extension
 
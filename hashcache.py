@@ -0,0 +1,88 @@
+import os
+from os.path import abspath, dirname, exists
+import tempfile
+import threading
+import simplejson
+
+
+class HashCache(object):
+    '''A persistent cache of file hashes.
+
+    Entries are keyed by path and a fingerprint of the file (e.g. its size,
+    modification time and inode) so files that have not changed do not need
+    to be read again. A cache can be shared by several threads.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.RLock()
+        if exists(filename):
+            with open(filename, 'rb') as f:
+                try:
+                    self.entries = simplejson.loads(f.read())['files']
+                except (ValueError, KeyError, TypeError):
+                    # a damaged cache is rebuilt from scratch
+                    self.entries = {}
+
+    def lookup(self, name, fingerprint):
+        '''Returns the (hash, mode) recorded for a file, or None if the file
+        is unknown or has changed.'''
+        entry = self.entries.get(abspath(name))
+        if entry and entry[0] == list(fingerprint):
+            return entry[1], entry[2]
+
+    def lookup_chunks(self, name, fingerprint, params):
+        '''Returns the chunk hashes recorded for a file split with a chunker
+        of these params, or None.'''
+        entry = self.entries.get(abspath(name))
+        if entry and entry[0] == list(fingerprint) and len(entry) > 3 and entry[3][0] == list(params):
+            return entry[3][1]
+
+    def update(self, name, fingerprint, hash, mode=None, chunks=None):
+        '''Records the hash of a file, and optionally its chunks as a pair of
+        chunker params and chunk hashes. Chunks recorded before are kept if
+        the file has not changed.'''
+        entry = [list(fingerprint), hash, mode]
+        key = abspath(name)
+        with self.lock:
+            old = self.entries.get(key)
+            if chunks is not None:
+                entry.append([list(chunks[0]), list(chunks[1])])
+            elif old and old[:2] == entry[:2] and len(old) > 3:
+                entry.append(old[3])
+            if old != entry:
+                self.entries[key] = entry
+                self.dirty = True
+
+    def discard(self, name):
+        with self.lock:
+            if self.entries.pop(abspath(name), None) is not None:
+                self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if self.dirty:
+                self.write()
+
+    def write(self):
+        directory = dirname(abspath(self.filename))
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(simplejson.dumps({'version': 1, 'files': self.entries}))
+            if os.name == 'nt' and exists(self.filename):
+                os.unlink(self.filename)
+            os.rename(tmp, self.filename)
+        except:
+            os.unlink(tmp)
+            raise
+        self.dirty = False
+
+
+def stat_fingerprint(st):
+    '''Returns the cache fingerprint of a file from its stat result.'''
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return st.st_size, mtime_ns, st.st_ino
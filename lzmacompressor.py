@@ -0,0 +1,45 @@
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+from compressor import Compressor
+
+class LZMACompressor(Compressor):
+    '''An xz compressor, which needs the lzma module (backports.lzma on
+    Python 2).'''
+
+    def __init__(self, preset=6):
+        if lzma is None:
+            raise ImportError('LZMACompressor requires the lzma module')
+        self.preset = preset
+
+    def compress(self, contents):
+        return lzma.compress(contents, preset=self.preset)
+
+    def decompress(self, contents):
+        return lzma.decompress(contents)
+
+    def compressobj(self):
+        return lzma.LZMACompressor(preset=self.preset)
+
+    def decompressobj(self):
+        return LZMADecompressor()
+
+    compressed_extension = '.xz'
+
+
+class LZMADecompressor(object):
+    '''lzma.LZMADecompressor with the flush() the other incremental codecs have.'''
+
+    def __init__(self):
+        self.decompressor = lzma.LZMADecompressor()
+
+    def decompress(self, data):
+        return self.decompressor.decompress(data)
+
+    def flush(self):
+        return ''
@@ -0,0 +1,71 @@
+import os
+from os.path import join, exists
+import hashlib
+import tempfile
+import threading
+
+
+class ManifestCache(object):
+    '''A persistent cache of verified manifests.
+
+    Versions never change once published, so a manifest is only downloaded
+    and verified once. The cache is kept under max_bytes by removing the
+    least recently used entries.'''
+
+    def __init__(self, directory, max_bytes=64 << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if not exists(directory):
+            os.makedirs(directory)
+
+    def filename(self, key):
+        return join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        '''Returns the cached contents for key, or None.'''
+        name = self.filename(key)
+        with self.lock:
+            try:
+                with open(name, 'rb') as f:
+                    contents = f.read()
+                # the modification time records when an entry was last used
+                os.utime(name, None)
+            except (IOError, OSError):
+                return None
+        return contents
+
+    def put(self, key, contents):
+        name = self.filename(key)
+        with self.lock:
+            fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(contents)
+                if os.name == 'nt' and exists(name):
+                    os.unlink(name)
+                os.rename(tmp, name)
+            except:
+                os.unlink(tmp)
+                raise
+            self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.listdir(self.directory):
+            if entry.startswith('.'):
+                continue
+            try:
+                st = os.stat(join(self.directory, entry))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, entry, st.st_size))
+        total = sum(size for mtime, entry, size in entries)
+        for mtime, entry, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(join(self.directory, entry))
+            except OSError:
+                pass
+            total -= size
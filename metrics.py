@@ -0,0 +1,175 @@
+import os
+import time
+import threading
+import cProfile
+import pstats
+from StringIO import StringIO
+
+
+# ratios reported by RecordingMetrics.summary, as (name, numerator, denominator)
+RATIOS = [
+    ('build.compression', 'build.bytes_out', 'build.bytes_in'),
+    ('build.delta_hit_rate', 'build.deltas', 'build.changed'),
+    ('plan.delta_hit_rate', 'plan.deltas', 'plan.changed'),
+]
+
+
+class Metrics(object):
+    '''The metrics interface, which does nothing.
+
+    PixiePatch times its phases with phase(), adds to counters with count()
+    and reports what happens to each file with event(). Subclasses can
+    record these, or forward them elsewhere.'''
+
+    def phase(self, name):
+        '''Returns a context manager timing a phase.'''
+        return NULL_PHASE
+
+    def count(self, name, value=1):
+        pass
+
+    def event(self, name, **fields):
+        pass
+
+
+class NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+
+NULL_PHASE = NullPhase()
+
+
+class Phase(object):
+    '''Times a phase in wall and CPU time.'''
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.metrics.enter(self.name)
+        self.wall = time.time()
+        self.cpu = cpu_time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.metrics.exit(self.name, time.time() - self.wall, cpu_time() - self.cpu)
+
+
+class RecordingMetrics(Metrics):
+    '''Records phase times, counters and events in memory.
+
+    Phases are totalled by name, so a phase which runs in several threads at
+    once counts each thread's time. CPU time is the whole process's.'''
+
+    def __init__(self, keep_events=True):
+        self.keep_events = keep_events
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.counters = {}
+        self.events = []
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def enter(self, name):
+        pass
+
+    def exit(self, name, wall, cpu):
+        with self.lock:
+            totals = self.phases.setdefault(name, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += wall
+            totals[2] += cpu
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def event(self, name, **fields):
+        if self.keep_events:
+            with self.lock:
+                self.events.append((time.time(), name, fields))
+
+    def summary(self):
+        '''Returns the phases, counters and ratios recorded so far.'''
+        with self.lock:
+            phases = dict((name, {'calls': calls, 'wall': wall, 'cpu': cpu})
+                          for name, (calls, wall, cpu) in self.phases.items())
+            counters = dict(self.counters)
+        ratios = {}
+        for name, numerator, denominator in RATIOS:
+            if counters.get(denominator):
+                ratios[name] = counters.get(numerator, 0) / float(counters[denominator])
+        return {'phases': phases, 'counters': counters, 'ratios': ratios}
+
+    def report(self):
+        '''Returns the summary as text.'''
+        summary = self.summary()
+        lines = ['%-24s %8s %10s %10s' % ('phase', 'calls', 'wall (s)', 'cpu (s)')]
+        for name, phase in sorted(summary['phases'].items()):
+            lines.append('%-24s %8i %10.3f %10.3f' % (name, phase['calls'], phase['wall'], phase['cpu']))
+        for name, value in sorted(summary['counters'].items()):
+            lines.append('%-24s %8i' % (name, value))
+        for name, value in sorted(summary['ratios'].items()):
+            lines.append('%-24s %8.3f' % (name, value))
+        return '\n'.join(lines)
+
+
+class ProfilingMetrics(RecordingMetrics):
+    '''Records like RecordingMetrics, and also runs cProfile during phases.
+
+    cProfile only follows the thread which enables it, so only the first
+    thread to start a phase is profiled until its outermost phase ends.'''
+
+    def __init__(self, keep_events=True):
+        RecordingMetrics.__init__(self, keep_events)
+        self.profile = cProfile.Profile()
+        self.owner = None
+        self.depth = 0
+
+    def enter(self, name):
+        thread = threading.current_thread()
+        with self.lock:
+            if self.owner is None:
+                self.owner = thread
+                self.profile.enable()
+            if self.owner is thread:
+                self.depth += 1
+
+    def exit(self, name, wall, cpu):
+        with self.lock:
+            if self.owner is threading.current_thread():
+                self.depth -= 1
+                if not self.depth:
+                    self.profile.disable()
+                    self.owner = None
+        RecordingMetrics.exit(self, name, wall, cpu)
+
+    def stats(self, sort='cumulative', limit=30):
+        '''Returns the hottest functions profiled so far as text.'''
+        out = StringIO()
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+
+def timed_iter(metrics, name, iterable):
+    '''Yields from iterable, timing each step as a phase.'''
+    iterator = iter(iterable)
+    while True:
+        with metrics.phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
@@ -0,0 +1,100 @@
+import threading
+from os.path import join
+
+
+# packs are started afresh once they reach this size
+PACK_SIZE = 1 << 22
+
+
+def pack_name(i):
+    return 'pack-%03i' % i
+
+
+class PackWriter(object):
+    '''Appends files to the numbered pack files of a distribution.'''
+
+    def __init__(self, directory, pack_size=PACK_SIZE):
+        self.directory = directory
+        self.pack_size = pack_size
+        self.count = 0
+        self.f = None
+        self.offset = 0
+
+    def add(self, filename):
+        '''Appends a file to the current pack and returns its location as
+        [pack name, offset, size].'''
+        if self.f is None or self.offset >= self.pack_size:
+            self.close()
+            self.f = open(join(self.directory, pack_name(self.count)), 'wb')
+            self.count += 1
+            self.offset = 0
+        with open(filename, 'rb') as f:
+            contents = f.read()
+        self.f.write(contents)
+        location = [pack_name(self.count - 1), self.offset, len(contents)]
+        self.offset += len(contents)
+        return location
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class PackFetcher(object):
+    '''Reads members of pack files for a patch.
+
+    The first time a member of a pack is read, every member of that pack the
+    patch needs is fetched with one Reader.get_range call, and each is kept
+    until it has been read.'''
+
+    def __init__(self, reader, wanted, metrics):
+        self.reader = reader
+        self.wanted = wanted
+        self.metrics = metrics
+        self.fetched = {}
+        self.lock = threading.Lock()
+        self.locks = {}
+
+    def get(self, version, pack, offset, size):
+        key = version, pack
+        with self.lock:
+            lock = self.locks.setdefault(key, threading.Lock())
+        with lock:
+            members = self.fetched.get(key)
+            if members is None:
+                members = self.fetched[key] = self.fetch(version, pack, self.wanted.get(key, ()))
+            contents = members.pop((offset, size), None)
+        if contents is None:
+            # read again, or not listed when the patch began
+            contents = self.fetch(version, pack, [(offset, size)])[offset, size]
+        return contents
+
+    def fetch(self, version, pack, ranges):
+        ranges = sorted(set(ranges))
+        with self.metrics.phase('pack.fetch'):
+            contents = self.reader.get_range(version, pack, ranges)
+        self.metrics.count('download.requests')
+        self.metrics.count('download.bytes', sum(size for offset, size in ranges))
+        return dict(zip(ranges, contents))
+
+
+def wanted_members(manifest, patch_plan):
+    '''Returns the pack members a patch plan needs, as sets of (offset, size)
+    keyed by (version, pack name).'''
+    wanted = {}
+    for name in patch_plan['download']:
+        location = manifest['files'][name].get('pack')
+        if location:
+            wanted.setdefault((manifest['version'], location[0]), set()).add(tuple(location[1:]))
+    for name, chain in patch_plan['patch']:
+        for step in chain:
+            if isinstance(step, dict) and 'pack' in step and 'blob' not in step:
+                wanted.setdefault((step['version'], step['pack'][0]), set()).add(tuple(step['pack'][1:]))
+    return wanted
@@ -1,119 +1,221 @@
 import os
-from os import stat, unlink, walk, makedirs, sep
-from os.path import join, dirname, exists, relpath
+from os import stat, unlink, makedirs, sep
+from os.path import join, dirname, exists
 import shutil
 import simplejson
 import hashlib
 import re
+from heapq import heappush, heappop
+import tempfile
+from io import BytesIO
+from contextlib import closing
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import threading
 
-from compressor import Compressor
+from compressor import Compressor, CHUNK_SIZE, copy_stream
 from signer import Signer, VerificationError
 from differ import Differ, DiffError
 from reader import Reader
+from hashcache import stat_fingerprint
+from chunker import Chunker
+import binarymanifest
+from scanner import IgnoreMatcher, HandlerIndex, scan
+from shardedmanifest import SHARD_DIR, ShardedFiles, make_shards, tree_hashes, within
+from metrics import Metrics, timed_iter
+from packfile import PackWriter, PackFetcher, wanted_members
+
+
+# the blob store is read as if it were a version of its own
+BLOB_VERSION = 'blobs'
+# how many previous versions a manifest lists, so clients can prefetch them
+HISTORY_LENGTH = 32
+PREFETCH_THREADS = 8
 
 
 class PixiePatch(object):
-    def __init__(self, compressor=None, differ=None, signer=None, reader=None):
+    def __init__(self, compressor=None, differ=None, signer=None, reader=None, hash_cache=None, chunker=None, manifest_cache=None, metrics=None, cost_model=None):
         self.compressor = compressor or Compressor()
         self.differ = differ or Differ()
         self.signer = signer or Signer()
         self.reader = reader or Reader()
+        self.hash_cache = hash_cache
+        self.chunker = chunker
+        self.manifest_cache = manifest_cache
+        self.metrics = metrics or Metrics()
+        self.cost_model = cost_model
         self.archive_handlers = {}
         self.ignore = []
+        self.__handler_index = None
+        self.__ignore_matcher = None
 
     def register_archive_handler(self, extension, handler):
         self.archive_handlers[extension] = handler
+        self.__handler_index = None
 
     def register_ignore_pattern(self, pattern):
         if isinstance(pattern, basestring):
             pattern = re.compile(pattern)
         self.ignore.append(pattern)
+        self.__ignore_matcher = None
+
+    def make_distribution(self, version, source_dir, target_dir, previous_target_dir=None, jobs=None, blob_dir=None, delta_bases=(), manifest_format='json', pack_threshold=None):
+        if self.chunker and not blob_dir:
+            raise ValueError('chunked files are stored in the blob store, so a blob_dir is required')
+        if manifest_format not in ('json', 'binary', 'sharded'):
+            raise ValueError('unknown manifest format %r' % (manifest_format,))
 
-    def make_distribution(self, version, source_dir, target_dir, previous_target_dir=None):
-        previous_manifest = None
+        previous_files = {}
+        history = []
         if previous_target_dir:
-            with open(join(previous_target_dir, self.compressor.add_extension('manifest')), 'rb') as f:
-                previous_manifest = self.parse_manifest(f.read())
+            previous = self.read_manifest(join(previous_target_dir, self.compressor.add_extension('manifest')))
+            previous_files = previous['files']
+            history = ([previous['version']] + previous.get('history', []))[:HISTORY_LENGTH]
+        base_files = [(base_dir, self.read_manifest(join(base_dir, self.compressor.add_extension('manifest')))['files'])
+                      for base_dir in delta_bases if base_dir != previous_target_dir]
+
+        if self.cost_model is not None:
+            self.cost_model.reset()
+        builder = FileBuilder(self.compressor, self.differ, version, target_dir, previous_target_dir, blob_dir, self.chunker, self.metrics, self.cost_model)
+        sources = {}
+        sizes = {}
+        def tasks():
+            for rel_name, source, mode in timed_iter(self.metrics, 'scan', self.__walk(source_dir)):
+                name = netpath(rel_name)
+                if self.hash_cache is not None and getattr(source, 'fingerprint', None) is not None:
+                    # only these can be cached, and other sources may hold
+                    # open temporary files
+                    sources[name] = source
+                sizes[name] = getattr(source, 'size', None)
+                bases = [(base_dir, files.get(name)) for base_dir, files in base_files]
+                yield rel_name, source, mode, previous_files.get(name), self.__cached_hash(source), bases
 
         entries = {}
-        for rel_name, contents, mode in self.__walk(source_dir):
-            hash = hashlib.sha256(contents).hexdigest()
-            dest_name = self.compressor.add_extension(join(target_dir, rel_name))
-            delta_name = self.differ.add_extension(join(target_dir, rel_name))
-            ensure_dir(dirname(dest_name))
-
-            linked = False
-            delta = None
-            compressed = None
-
-            if previous_manifest:
-                previous_name = self.compressor.add_extension(join(previous_target_dir, rel_name))
-                last = previous_manifest['files'].get(rel_name)
-                if last and last['hash'] == hash:
-                    # file not changed
-                    if exists(dest_name):
-                        unlink(dest_name)
-                    link(previous_name, dest_name)
-                    linked = True
-                    compressed_size = stat(dest_name).st_size
-                    delta = last['delta']
-                elif last:
-                    # create a diff
-                    try:
-                        with open(previous_name, 'rb') as f:
-                            previous_contents = self.compressor.decompress(f.read())
-                        delta_contents = self.compressor.compress(self.differ.diff(previous_contents, contents))
-                        size = len(delta_contents)
-
-                        compressed = self.compressor.compress(contents)
-                        if size < len(compressed):
-                            with open(delta_name, 'wb') as f:
-                                f.write(delta_contents)
-                            delta = {'version': version, 'size': size, 'old_hash': last['hash'], 'old_version': last['delta'] and last['delta']['version']}
-                    except DiffError:
-                        pass
-
-                
-            if not linked:
-                if compressed is None:
-                    compressed = self.compressor.compress(contents)
-                compressed_size = len(compressed)
-                with open(dest_name, 'wb') as f:
-                    f.write(compressed)
-
-                if delta and delta['size'] >= compressed_size:
-                    delta = None
-
-            entry = {'hash': hash, 'dlsize': compressed_size, 'delta': delta}
-            if mode is not None:
-                entry['mode'] = mode
-            entries[netpath(rel_name)] = entry
+        def built(name, entry):
+            entries[name] = entry
+            self.__record_build(name, entry, previous_files.get(name), sizes.pop(name))
+
+        if jobs and jobs > 1:
+            pool = Pool(jobs, _init_worker, (builder,))
+            try:
+                for name, entry in pool.imap_unordered(_build_file, tasks(), 16):
+                    built(name, entry)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for task in tasks():
+                built(*builder.build(*task))
+
+        if self.hash_cache is not None:
+            for name, source in sources.items():
+                self.__cache_hash(source, entries[name]['hash'], entries[name].get('mode'))
+            self.hash_cache.save()
+
+        if pack_threshold is not None:
+            with self.metrics.phase('pack'):
+                self.__pack(entries, version, target_dir, pack_threshold)
 
         manifest = {}
         manifest['version'] = version
         manifest['files'] = entries
-        manifest = simplejson.dumps(manifest, sort_keys=True, indent=4) + '\n'
+        if history:
+            manifest['history'] = history
+        if self.chunker:
+            manifest['chunker'] = self.chunker.params()
+        with self.metrics.phase('manifest.write'):
+            if manifest_format == 'sharded':
+                # only the root is signed, the shards are verified by their digests
+                manifest['root'], shards = make_shards(manifest.pop('files'))
+                ensure_dir(join(target_dir, SHARD_DIR))
+                for digest, shard in shards.items():
+                    with open(join(target_dir, SHARD_DIR, self.compressor.add_extension(digest)), 'wb') as f:
+                        f.write(self.compressor.compress(shard))
+                manifest = simplejson.dumps(manifest, sort_keys=True, indent=4) + '\n'
+            elif manifest_format == 'binary':
+                manifest = binarymanifest.dumps(manifest)
+            else:
+                manifest = simplejson.dumps(manifest, sort_keys=True, indent=4) + '\n'
 
-        with open(join(target_dir, self.compressor.add_extension('manifest')), 'wb') as f:
-            f.write(self.compressor.compress(self.signer.sign(manifest)))
+            with open(join(target_dir, self.compressor.add_extension('manifest')), 'wb') as f:
+                f.write(self.compressor.compress(self.signer.sign(manifest)))
 
         with open(join(target_dir, 'version'), 'wb') as f:
             f.write(version + '\n')
 
-    def parse_manifest(self, manifest):
+    def __pack(self, entries, version, target_dir, threshold):
+        '''Copies the small files and deltas of a version into pack files, so
+        clients can fetch many of them with one request. The files are also
+        left where they are.'''
+        with PackWriter(target_dir) as packs:
+            for name in sorted(entries):
+                entry = entries[name]
+                if 'blob' in entry or 'chunks' in entry:
+                    continue
+                if entry['dlsize'] <= threshold:
+                    codec = self.compressor.codec(entry.get('codec'))
+                    entry['pack'] = packs.add(codec.add_extension(join(target_dir, hostpath(name))))
+                # deltas kept from earlier versions are already packed there
+                for delta in [entry['delta']] + entry.get('deltas', []):
+                    if delta and delta['version'] == version and 'blob' not in delta and delta['size'] <= threshold:
+                        if 'file' in delta:
+                            delta['pack'] = packs.add(join(target_dir, hostpath(delta['file'])))
+                        else:
+                            delta['pack'] = packs.add(self.differ.add_extension(join(target_dir, hostpath(name))))
+
+    def parse_manifest(self, manifest, get_shard=None):
+        '''Verifies and decodes a manifest. get_shard is called with the name
+        of a shard to read it if the manifest is sharded.'''
         decomp = self.compressor.decompress(manifest)
-        message = self.signer.verify(decomp)
-        return simplejson.loads(message)
+        return self.__decode_manifest(self.signer.verify(decomp), get_shard)
+
+    def __decode_manifest(self, message, get_shard):
+        if binarymanifest.is_binary(message):
+            return binarymanifest.loads(message)
+        manifest = simplejson.loads(message)
+        if 'root' in manifest:
+            def load(digest):
+                shard = self.compressor.decompress(get_shard(SHARD_DIR + '/' + self.compressor.add_extension(digest)))
+                if hashlib.sha256(shard).hexdigest() != digest:
+                    raise VerificationError()
+                return simplejson.loads(shard)
+            manifest['files'] = ShardedFiles(manifest['root'], load)
+        return manifest
 
     def read_manifest(self, filename):
+        def get_shard(name):
+            with open(join(dirname(filename), hostpath(name)), 'rb') as f:
+                return f.read()
         with open(filename, 'rb') as f:
-            return self.parse_manifest(f.read())
+            return self.parse_manifest(f.read(), get_shard)
 
     def create_client_manifest(self, version, source_dir):
         entries = {}
-        for rel_name, contents, mode in self.__walk(source_dir):
-            hash = hashlib.sha256(contents).hexdigest()
+        for rel_name, source, mode in timed_iter(self.metrics, 'scan', self.__walk(source_dir)):
+            chunked = self.chunker and self.chunker.applies(getattr(source, 'size', None))
+            hash = self.__cached_hash(source)
+            chunks = hash and chunked and self.__cached_chunks(source)
+            if hash is None or (chunked and chunks is None):
+                if chunked:
+                    # hash and chunk in one pass
+                    with self.metrics.phase('chunk'), source.open() as f:
+                        reader = HashingReader(f)
+                        chunks = [hashlib.sha256(chunk).hexdigest() for chunk in self.chunker.chunks(reader)]
+                        hash = reader.hexdigest()
+                    self.__cache_hash(source, hash, mode, (self.chunker.params(), chunks))
+                else:
+                    with self.metrics.phase('hash'), source.open() as f:
+                        hash = hash_file(f)
+                    self.__cache_hash(source, hash, mode)
+                self.metrics.count('hash.bytes', getattr(source, 'size', None) or 0)
+            else:
+                self.metrics.count('hash.cached')
             entries[netpath(rel_name)] = {'hash': hash}
+            if chunked:
+                entries[netpath(rel_name)]['chunks'] = chunks
+        if self.hash_cache is not None:
+            self.hash_cache.save()
 
         manifest = {}
         manifest['version'] = version
@@ -125,15 +227,58 @@ class PixiePatch(object):
         def get_manifest(version):
             if version in manifests:
                 return manifests[version]
+            message = self.__cached_manifest('version/' + version)
+            if message is None:
+                try:
+                    contents = self.__get(version, self.compressor.add_extension('manifest'), 'manifest.fetch')
+                except IOError:
+                    return
+                with self.metrics.phase('manifest.verify'):
+                    message = self.signer.verify(self.compressor.decompress(contents))
+                self.__cache_manifest('version/' + version, message)
+            with self.metrics.phase('manifest.parse'):
+                manifests[version] = self.__decode_manifest(message, lambda name: get_shard(version, name))
+            return manifests[version]
+
+        def get_shard(version, name):
+            # shards are named by their digest, which is checked on every load
+            contents = self.__cached_manifest('shard/' + name)
+            if contents is None:
+                contents = self.__get(version, name, 'manifest.fetch')
+                self.__cache_manifest('shard/' + name, contents)
+            return contents
+
+        def get_entry(version, name):
+            '''Returns a file's entry in an older version, or None if that
+            version cannot be read.'''
+            manifest = get_manifest(version)
+            if not manifest:
+                return None
             try:
-                contents = self.reader.get(version, self.compressor.add_extension('manifest'))
+                return manifest['files'].get(name)
             except IOError:
+                # a shard is missing, so the version is as good as missing
+                manifests[version] = None
+                return None
+
+        prefetched = []
+        def prefetch():
+            '''Fetches the manifests of the versions since the client's
+            together, rather than one by one as delta chains need them.'''
+            if prefetched:
                 return
-            contents = self.compressor.decompress(contents)
-            contents = self.signer.verify(contents)
-            contents = simplejson.loads(contents)
-            manifests[version] = contents
-            return contents
+            prefetched.append(True)
+            history = target_manifest.get('history', [])
+            if client_manifest['version'] in history:
+                history = history[:history.index(client_manifest['version'])]
+            pending = [version for version in history if version not in manifests]
+            if len(pending) > 1:
+                pool = ThreadPool(min(len(pending), PREFETCH_THREADS))
+                try:
+                    pool.map(get_manifest, pending)
+                finally:
+                    pool.close()
+                    pool.join()
 
         if client_manifest['version'] == target_version:
             return
@@ -142,44 +287,51 @@ class PixiePatch(object):
         if not target_manifest:
             raise IOError()
 
-        local = set(client_manifest['files'].keys())
-        remote = set(target_manifest['files'].keys())
+        if isinstance(target_manifest['files'], ShardedFiles):
+            # only compare the directories which differ from the client's
+            trees = tree_hashes(dict((name, entry['hash']) for name, entry in client_manifest['files'].items()))
+            remote, same = target_manifest['files'].changed(trees)
+            remote = set(remote)
+            local = set(name for name in client_manifest['files'] if not within(name, same))
+        else:
+            local = set(client_manifest['files'].keys())
+            remote = set(target_manifest['files'].keys())
         local_only = local.difference(remote)
         remote_only = remote.difference(local)
         common = local.intersection(remote)
 
         delete = list(local_only)
-        download = list(remote_only)
+        download = []
         patch = []
-        size = sum([target_manifest['files'][file]['dlsize'] for file in remote_only])
+        chunked = []
+        size = 0
+
+        for name in remote_only:
+            remote = target_manifest['files'][name]
+            if 'chunks' in remote:
+                chunked.append(name)
+            else:
+                download.append(name)
+            size += remote['dlsize']
 
         for name in common:
             local = client_manifest['files'][name]
             remote = target_manifest['files'][name]
-            if local['hash'] != remote['hash']:
-                chain = []
-                if remote['delta']:
-                    delta = remote['delta']
-                    # chain patches if required
-                    old_manifest = target_manifest
-                    chain = [delta['version']]
-                    chain_size = delta['size']
-                    while delta['old_hash'] != local['hash']:
-                        m = delta['old_version'] and get_manifest(delta['old_version'])
-                        if m and name in m['files'] and m['files'][name].get('delta'):
-                            delta = m['files'][name].get('delta')
-                            chain.insert(0, delta['version'])
-                            chain_size += delta['size']
-
-                            # give up on deltas if they are bigger than the whole
-                            # file
-                            if chain_size >= remote['dlsize']:
-                                chain = []
-                                break
-                        else:
-                            chain = []
-                            break
-                    
+            if local['hash'] != remote['hash'] and 'chunks' in remote:
+                # only fetch the chunks which are not in the local file
+                chunked.append(name)
+                if 'chunks' in local:
+                    have = set(local['chunks'])
+                    needed = dict((chunk[0], chunk[2]) for chunk in remote['chunks'] if chunk[0] not in have)
+                    size += sum(needed.values())
+                else:
+                    size += remote['dlsize']
+            elif local['hash'] != remote['hash']:
+                prefetch()
+                with self.metrics.phase('plan.delta_chain'):
+                    chain, chain_size = self.__delta_chain(name, local['hash'], remote, get_entry)
+                self.metrics.count('plan.changed')
+                self.metrics.count('plan.deltas', bool(chain))
                 if chain:
                     patch.append((name, chain))
                     size += chain_size
@@ -187,77 +339,789 @@ class PixiePatch(object):
                     download.append(name)
                     size += remote['dlsize']
 
-        return {'delete': delete, 'download': download, 'patch': patch, 'size': size, 'manifest': target_manifest}
+        for name, value in [('delete', len(delete)), ('download', len(download)), ('patch', len(patch)),
+                            ('chunked', len(chunked)), ('bytes', size)]:
+            self.metrics.count('plan.' + name, value)
+        return {'delete': delete, 'download': download, 'patch': patch, 'chunked': chunked, 'size': size, 'manifest': target_manifest}
+
+    def __delta_chain(self, name, local_hash, remote, get_entry):
+        '''Finds the cheapest series of deltas which turns the local file into
+        the remote one, preferring fewer bytes and then fewer patches.
+
+        Returns the chain and its size, or an empty chain if downloading the
+        whole file is cheaper.'''
+        # search back from the remote file; each node is a version of the file
+        # along with the manifest entry which describes how it can be made
+        queue = [(0, 0, 0, remote['hash'], remote, [])]
+        counter = 1
+        visited = set()
+        while queue:
+            size, steps, _, hash, entry, chain = heappop(queue)
+            if hash == local_hash:
+                return chain, size
+            if hash in visited:
+                continue
+            visited.add(hash)
+
+            for delta in [entry['delta']] + entry.get('deltas', []):
+                # give up on deltas if they are bigger than the whole file
+                if not delta or size + delta['size'] >= remote['dlsize'] or delta['old_hash'] in visited:
+                    continue
+                old_entry = None
+                if delta['old_hash'] != local_hash:
+                    old_entry = delta['old_version'] and get_entry(delta['old_version'], name)
+                    if not old_entry or old_entry['hash'] != delta['old_hash']:
+                        continue
+                heappush(queue, (size + delta['size'], steps + 1, counter, delta['old_hash'], old_entry, [chain_link(delta)] + chain))
+                counter += 1
+        return [], 0
+
+    def patch(self, directory, patch_plan, jobs=None):
+        '''Applies a patch plan to directory.
 
-    def patch(self, directory, patch_plan):
+        With jobs > 1, files are downloaded, decompressed, patched and
+        verified by that many threads while earlier files are written. Only
+        a few files per thread are held in memory, and writes happen one at a
+        time.
+
+        Changes to archives whose handler has an update method are collected
+        and applied with one call per archive once every file is ready. Until
+        then they wait in closed files in a spool directory, so patching many
+        members does not hold many files open.'''
         manifest = patch_plan['manifest']
-        version = manifest['version']
+        batches = {}
+        spool_dir = tempfile.mkdtemp()
+        try:
+            self.__patch(directory, patch_plan, manifest, batches, spool_dir, jobs)
+            for archive, (handler, changes, modes) in batches.items():
+                with self.metrics.phase('archive.update'):
+                    handler.update(archive, changes, modes)
+                self.metrics.count('archive.updates')
+        finally:
+            for handler, changes, modes in batches.values():
+                for f in changes.values():
+                    if f is not None:
+                        f.close()
+            shutil.rmtree(spool_dir, ignore_errors=True)
+
+        if self.hash_cache is not None:
+            self.hash_cache.save()
+
+    def __patch(self, directory, patch_plan, manifest, batches, spool_dir, jobs):
+        def batch(handler, archive):
+            if archive is not None and hasattr(handler, 'update'):
+                return batches.setdefault(archive, (handler, {}, {}))
 
         # delete entries
         for name in patch_plan['delete']:
             handler, archive, member = self.__get_file_handler(directory, hostpath(name))
-            handler.delete(archive, member)
+            self.metrics.event('patch.file', file=name, action='delete')
+            pending = batch(handler, archive)
+            if pending is not None:
+                pending[1][member] = None
+                continue
+            with self.metrics.phase('write'):
+                handler.delete(archive, member)
+            if self.hash_cache is not None and archive is None:
+                self.hash_cache.discard(member)
 
-        # download new entries
-        for name in patch_plan['download']:
-            contents = self.reader.get(version, self.compressor.add_extension(name))
-            contents = self.compressor.decompress(contents)
-            if hashlib.sha256(contents).hexdigest() != manifest['files'][name]['hash']:
-                raise VerificationError()
-            handler, archive, member = self.__get_file_handler(directory, hostpath(name))
-            handler.set(archive, member, contents, manifest['files'][name].get('mode'))
+        packs = PackFetcher(self.reader, wanted_members(manifest, patch_plan), self.metrics)
+        tasks = [(self.__download, name, (packs,)) for name in patch_plan['download']]
+        tasks += [(self.__apply_patches, name, (chain, packs)) for name, chain in patch_plan['patch']]
+        tasks += [(self.__assemble_chunks, name, ()) for name in patch_plan.get('chunked', ())]
 
-        # download patches
-        for name, versions in patch_plan['patch']:
+        # reads and writes of an archive must not overlap
+        targets = {}
+        locks = {}
+        for step, name, args in tasks:
             handler, archive, member = self.__get_file_handler(directory, hostpath(name))
-            contents = handler.get(archive, member)
+            targets[name] = handler, archive, member, locks.setdefault(archive, threading.Lock())
 
-            for v in versions:
-                patch = self.reader.get(v, self.differ.add_extension(name))
-                patch = self.compressor.decompress(patch)
-                contents = self.differ.patch(contents, patch)
+        def run(task):
+            step, name, args = task
+            handler, archive, member, lock = targets[name]
+            return name, step(manifest, name, handler, archive, member, lock, *args)
+
+        steps = {self.__download: 'download', self.__apply_patches: 'patch', self.__assemble_chunks: 'chunked'}
+        actions = dict((name, steps[step]) for step, name, args in tasks)
+
+        spooled_files = []
+        def write(name, f):
+            handler, archive, member, lock = targets[name]
+            entry = manifest['files'][name]
+            self.metrics.count('patch.files')
+            self.metrics.event('patch.file', file=name, action=actions[name])
+            pending = batch(handler, archive)
+            if pending is not None:
+                spooled = join(spool_dir, str(len(spooled_files)))
+                try:
+                    with self.metrics.phase('write'), open(spooled, 'wb') as out:
+                        shutil.copyfileobj(f, out, CHUNK_SIZE)
+                finally:
+                    f.close()
+                spooled_files.append(spooled)
+                pending[1][member] = SpooledFile(spooled)
+                pending[2][member] = entry.get('mode')
+                return
+            try:
+                with self.metrics.phase('write'), lock:
+                    set_file(handler, archive, member, f, entry.get('mode'))
+            finally:
+                f.close()
+            self.__written(archive, member, entry)
 
-            if hashlib.sha256(contents).hexdigest() != manifest['files'][name]['hash']:
+        if jobs and jobs > 1 and len(tasks) > 1:
+            # bound the number of files fetched but not yet written
+            slots = threading.Semaphore(2 * jobs)
+            stopped = []
+            def bounded():
+                for task in tasks:
+                    slots.acquire()
+                    if stopped:
+                        return
+                    yield task
+            pool = ThreadPool(jobs)
+            try:
+                for name, f in pool.imap_unordered(run, bounded()):
+                    write(name, f)
+                    slots.release()
+                pool.close()
+            finally:
+                stopped.append(True)
+                slots.release()
+                pool.terminate()
+                pool.join()
+        else:
+            for task in tasks:
+                write(*run(task))
+
+    def __download(self, manifest, name, handler, archive, member, lock, packs):
+        '''Streams a file through decompression and hashing into a temporary
+        file.'''
+        entry = manifest['files'][name]
+        codec = self.compressor.codec(entry.get('codec'))
+        blob = entry.get('blob')
+        out = tempfile.TemporaryFile()
+        try:
+            # decompression and hashing happen as the file is read
+            with self.metrics.phase('download'):
+                if blob:
+                    src = self.reader.open(BLOB_VERSION, blob)
+                elif 'pack' in entry:
+                    src = BytesIO(packs.get(manifest['version'], *entry['pack']))
+                else:
+                    src = self.reader.open(manifest['version'], codec.add_extension(name))
+                with closing(src):
+                    dst = HashingWriter(out)
+                    d = codec.decompressobj()
+                    copy_stream(src, dst, d.decompress, d.flush)
+            if 'pack' not in entry:
+                self.metrics.count('download.requests')
+                self.metrics.count('download.bytes', entry['dlsize'])
+            if dst.hexdigest() != entry['hash']:
                 raise VerificationError()
-            handler.set(archive, member, contents, manifest['files'][name].get('mode'))
+            out.seek(0)
+        except:
+            out.close()
+            raise
+        return out
 
-    def __walk(self, source_dir):
-        for root, dirs, files in walk(source_dir):
-            for file in files:
-                name = join(root, file)
-                rel_name = relpath(name, source_dir)
-
-                for ext, handler in self.archive_handlers.items():
-                    if name.endswith(ext):
-                        for member, contents, mode in handler.walk(name):
-                            member_name = join(rel_name, member)
-                            if not self.__ignore(member_name):
-                                yield member_name, contents, mode
-                        break
+    def __apply_patches(self, manifest, name, handler, archive, member, lock, chain, packs):
+        '''Applies a chain of deltas through temporary files, so no version of
+        the file is held in memory, and hashes the final version as it is
+        written.'''
+        with self.metrics.phase('read'), lock:
+            source = open_file(handler, archive, member)
+        try:
+            for i, step in enumerate(chain):
+                out = tempfile.TemporaryFile()
+                try:
+                    dst = HashingWriter(out) if i == len(chain) - 1 else out
+                    with closing(self.__open_patch(step, name, packs)) as patch, tempfile.TemporaryFile() as delta:
+                        with self.metrics.phase('patch'):
+                            self.compressor.decompress_file(patch, delta)
+                            delta.seek(0)
+                            self.differ.patch_file(source, delta, dst)
+                    out.seek(0)
+                except:
+                    out.close()
+                    raise
+                source.close()
+                source = out
+
+            if dst.hexdigest() != manifest['files'][name]['hash']:
+                raise VerificationError()
+        except:
+            source.close()
+            raise
+        return source
+
+    def __open_patch(self, step, name, packs):
+        if isinstance(step, dict) and 'blob' in step:
+            version, filename = BLOB_VERSION, step['blob']
+        elif isinstance(step, dict) and 'pack' in step:
+            return BytesIO(packs.get(step['version'], *step['pack']))
+        elif isinstance(step, dict):
+            version, filename = step['version'], step['file']
+        else:
+            version, filename = step, self.differ.add_extension(name)
+        with self.metrics.phase('download'):
+            f = self.reader.open(version, filename)
+        self.metrics.count('download.requests')
+        return ReadCounter(f, lambda size: self.metrics.count('download.bytes', size))
+
+    def __assemble_chunks(self, manifest, name, handler, archive, member, lock):
+        '''Builds a chunked file from the chunks of the local file and
+        downloaded ones.
+
+        Chunks are indexed by where they are in the local file, or in the new
+        file if they were downloaded, and read back from there when used, so
+        only one chunk is held in memory at a time.'''
+        entry = manifest['files'][name]
+        try:
+            with self.metrics.phase('read'), lock:
+                old = open_file(handler, archive, member)
+        except (IOError, KeyError):
+            old = None
+
+        out = tempfile.TemporaryFile()
+        try:
+            locations = {}
+            if old is not None:
+                old = seekable_file(old)
+                offset = 0
+                for chunk in Chunker(*manifest['chunker']).chunks(old):
+                    locations.setdefault(hashlib.sha256(chunk).hexdigest(), (old, offset, len(chunk)))
+                    offset += len(chunk)
+
+            dst = HashingWriter(out)
+            for chunk_hash, chunk_size, chunk_dlsize in entry['chunks']:
+                location = locations.get(chunk_hash)
+                if location is None:
+                    chunk = self.__get(BLOB_VERSION, self.compressor.add_extension(blob_name(chunk_hash)))
+                    chunk = self.compressor.decompress(chunk)
+                    if hashlib.sha256(chunk).hexdigest() != chunk_hash:
+                        raise VerificationError()
+                    locations[chunk_hash] = out, out.tell(), len(chunk)
                 else:
-                    if not self.__ignore(rel_name):
-                        with open(name, 'rb') as f:
-                            contents = f.read()
-                        yield rel_name, contents, stat(name).st_mode
+                    f, offset, size = location
+                    f.seek(offset)
+                    chunk = f.read(size)
+                    # carry on writing at the end
+                    out.seek(0, os.SEEK_END)
+                dst.write(chunk)
+
+            if dst.hexdigest() != entry['hash']:
+                raise VerificationError()
+            out.seek(0)
+        except:
+            out.close()
+            raise
+        finally:
+            if old is not None:
+                old.close()
+        return out
+
+    def __get(self, version, name, phase='download'):
+        with self.metrics.phase(phase):
+            contents = self.reader.get(version, name)
+        self.metrics.count('download.requests')
+        self.metrics.count('download.bytes', len(contents))
+        return contents
+
+    def __walk(self, source_dir):
+        return scan(source_dir, self.__handlers(), self.__ignore())
+
+    def __cached_manifest(self, key):
+        if self.manifest_cache is not None:
+            return self.manifest_cache.get(key)
+
+    def __cache_manifest(self, key, contents):
+        if self.manifest_cache is not None:
+            self.manifest_cache.put(key, contents)
 
-    def __ignore(self, name):
-        for pattern in self.ignore:
-            if pattern.match(name):
-                return True
-        return False
+    def __cached_hash(self, source):
+        fingerprint = getattr(source, 'fingerprint', None)
+        if self.hash_cache is None or fingerprint is None:
+            return None
+        cached = self.hash_cache.lookup(getattr(source, 'cache_name', source.name), fingerprint)
+        return cached and cached[0]
+
+    def __cached_chunks(self, source):
+        # only called once the hash was found in the cache
+        return self.hash_cache.lookup_chunks(getattr(source, 'cache_name', source.name), source.fingerprint,
+                                             self.chunker.params())
+
+    def __cache_hash(self, source, hash, mode, chunks=None):
+        fingerprint = getattr(source, 'fingerprint', None)
+        if self.hash_cache is not None and fingerprint is not None:
+            self.hash_cache.update(getattr(source, 'cache_name', source.name), fingerprint, hash, mode, chunks)
+
+    def __written(self, archive, name, entry):
+        # files written by patch() are known to match the manifest
+        if self.hash_cache is not None and archive is None:
+            st = stat(name)
+            self.hash_cache.update(name, stat_fingerprint(st), entry['hash'], st.st_mode)
+
+    def __record_build(self, name, entry, last, size):
+        # unchanged files keep the deltas of the previous version
+        changed = bool(last) and last['hash'] != entry['hash']
+        delta = changed and bool(entry['delta'] or entry.get('deltas'))
+        self.metrics.count('build.files')
+        if size is not None:
+            self.metrics.count('build.bytes_in', size)
+        self.metrics.count('build.bytes_out', entry['dlsize'])
+        self.metrics.count('build.changed', changed)
+        self.metrics.count('build.deltas', delta)
+        self.metrics.event('build.file', file=name, size=size, dlsize=entry['dlsize'], changed=changed, delta=delta)
+
+    def __ignore(self):
+        if self.__ignore_matcher is None:
+            self.__ignore_matcher = IgnoreMatcher(self.ignore)
+        return self.__ignore_matcher
+
+    def __handlers(self):
+        if self.__handler_index is None:
+            self.__handler_index = HandlerIndex(self.archive_handlers)
+        return self.__handler_index
 
     def __get_file_handler(self, directory, name):
         parts = name.split(sep)
-        for i, part in enumerate(parts):
-            for ext, handler in self.archive_handlers.items():
-                if part.endswith(ext):
-                    return handler, join(directory, *parts[:i+1]), join(*parts[i+1:])
+        handlers = self.__handlers()
+        for i, part in enumerate(parts[:-1]):
+            handler = handlers.find(part)
+            if handler is not None:
+                return handler, join(directory, *parts[:i+1]), join(*parts[i+1:])
         return DummyHandler(), None, join(directory, name)
 
 
+class FileBuilder(object):
+    '''Builds the distribution files and manifest entry for a single file.
+
+    This holds everything needed to process one file independently of the
+    others so it can be shared with worker processes. Worker processes do not
+    report phases to metrics.'''
+
+    def __init__(self, compressor, differ, version, target_dir, previous_target_dir=None, blob_dir=None, chunker=None, metrics=None, cost_model=None):
+        self.compressor = compressor
+        self.differ = differ
+        self.version = version
+        self.target_dir = target_dir
+        self.previous_target_dir = previous_target_dir
+        self.blob_dir = blob_dir
+        self.chunker = chunker
+        self.metrics = metrics or Metrics()
+        self.cost_model = cost_model
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['metrics'] = Metrics()
+        return state
+
+    def build(self, rel_name, source, mode, last=None, hash=None, bases=()):
+        if self.chunker and self.chunker.applies(getattr(source, 'size', None)):
+            entry = self.build_chunked(source, last, hash)
+            bases = ()
+        elif self.blob_dir:
+            entry = self.build_blob(rel_name, source, last, hash)
+        else:
+            entry = self.build_file(rel_name, source, last, hash)
+
+        if last and last['hash'] == entry['hash']:
+            if last.get('deltas'):
+                entry['deltas'] = last['deltas']
+        elif bases:
+            deltas = self.base_deltas(rel_name, source, entry, last, bases)
+            if deltas:
+                entry['deltas'] = deltas
+
+        if mode is not None:
+            entry['mode'] = mode
+        return netpath(rel_name), entry
+
+    def build_file(self, rel_name, source, last, hash):
+        if last:
+            if hash is None:
+                with self.metrics.phase('hash'), source.open() as f:
+                    hash = hash_file(f)
+
+            if last['hash'] == hash and 'blob' not in last:
+                # file not changed
+                codec = self.compressor.codec(last.get('codec'))
+                previous_name = codec.add_extension(join(self.previous_target_dir, rel_name))
+                dest_name = codec.add_extension(join(self.target_dir, rel_name))
+                ensure_dir(dirname(dest_name))
+                if exists(dest_name):
+                    unlink(dest_name)
+                link(previous_name, dest_name)
+                return codec_entry({'hash': hash, 'dlsize': stat(dest_name).st_size, 'delta': last['delta']}, last.get('codec'))
+
+        codec_name, codec = self.choose_codec(rel_name, source)
+        dest_name = codec.add_extension(join(self.target_dir, rel_name))
+        ensure_dir(dirname(dest_name))
+        with self.metrics.phase('compress'), source.open() as f:
+            reader = HashingReader(f)
+            with open(dest_name, 'wb') as out:
+                compressed_size = codec.compress_file(reader, out)
+        hash = reader.hexdigest()
+
+        delta = None
+        delta_contents = self.make_delta(rel_name, source, self.previous_target_dir, last, compressed_size)
+        if delta_contents is not None:
+            with open(self.differ.add_extension(join(self.target_dir, rel_name)), 'wb') as f:
+                f.write(delta_contents)
+            delta = self.delta_entry(last, len(delta_contents))
+
+        return codec_entry({'hash': hash, 'dlsize': compressed_size, 'delta': delta}, codec_name)
+
+    def build_blob(self, rel_name, source, last, hash):
+        if hash is None:
+            with self.metrics.phase('hash'), source.open() as f:
+                hash = hash_file(f)
+
+        if last and last['hash'] == hash and 'blob' in last:
+            # file not changed, the blob is shared with the previous version
+            return codec_entry({'hash': hash, 'dlsize': last['dlsize'], 'delta': last['delta'], 'blob': last['blob']}, last.get('codec'))
+
+        codec_name, codec = self.choose_codec(rel_name, source)
+        blob = codec.add_extension(blob_name(hash))
+        blob_file = join(self.blob_dir, hostpath(blob))
+        if not exists(blob_file):
+            with self.metrics.phase('compress'), source.open() as f:
+                write_atomic(blob_file, lambda out: codec.compress_file(f, out))
+        compressed_size = stat(blob_file).st_size
+
+        delta = None
+        if last and last['hash'] != hash:
+            delta = self.delta_blob(rel_name, source, self.previous_target_dir, last, hash, compressed_size)
+
+        return codec_entry({'hash': hash, 'dlsize': compressed_size, 'delta': delta, 'blob': blob}, codec_name)
+
+    def choose_codec(self, rel_name, source):
+        '''Returns the codec name to record for a file and its compressor.'''
+        sample = ''
+        if self.compressor.sample_size:
+            with source.open() as f:
+                sample = f.read(self.compressor.sample_size)
+        codec_name = self.compressor.choose(netpath(rel_name), sample)
+        return codec_name, self.compressor.codec(codec_name)
+
+    def build_chunked(self, source, last, hash):
+        if last and last['hash'] == hash and 'chunks' in last:
+            # file not changed
+            return {'hash': hash, 'dlsize': last['dlsize'], 'delta': None, 'chunks': last['chunks']}
+
+        chunks = []
+        dlsizes = {}
+        with source.open() as f:
+            reader = HashingReader(f)
+            for chunk in self.chunker.chunks(reader):
+                chunk_hash = hashlib.sha256(chunk).hexdigest()
+                blob_file = join(self.blob_dir, hostpath(self.compressor.add_extension(blob_name(chunk_hash))))
+                if not exists(blob_file):
+                    with self.metrics.phase('compress'):
+                        write_atomic(blob_file, lambda out: out.write(self.compressor.compress(chunk)))
+                dlsizes[chunk_hash] = stat(blob_file).st_size
+                chunks.append([chunk_hash, len(chunk), dlsizes[chunk_hash]])
+        return {'hash': reader.hexdigest(), 'dlsize': sum(dlsizes.values()), 'delta': None, 'chunks': chunks}
+
+    def base_deltas(self, rel_name, source, entry, last, bases):
+        '''Makes deltas to a changed file from older distributions, so clients
+        with those versions can patch in one step.'''
+        deltas = []
+        seen = set([entry['hash']])
+        if last:
+            seen.add(last['hash'])
+        for base_dir, base in bases:
+            if not base or base['hash'] in seen:
+                continue
+            seen.add(base['hash'])
+            if self.blob_dir:
+                delta = self.delta_blob(rel_name, source, base_dir, base, entry['hash'], entry['dlsize'])
+            else:
+                delta_name = self.differ.add_extension('%s.%s' % (netpath(rel_name), base['hash'][:16]))
+                delta_contents = self.make_delta(rel_name, source, base_dir, base, entry['dlsize'])
+                delta = None
+                if delta_contents is not None:
+                    with open(join(self.target_dir, hostpath(delta_name)), 'wb') as f:
+                        f.write(delta_contents)
+                    delta = self.delta_entry(base, len(delta_contents))
+                    delta['file'] = delta_name
+            if delta:
+                deltas.append(delta)
+        return deltas
+
+    def delta_blob(self, rel_name, source, base_dir, base, hash, limit):
+        '''Returns the entry of a delta stored in the blob store, making the
+        delta if it is not there already.'''
+        delta_blob = self.compressor.add_extension(self.differ.add_extension(blob_name(base['hash'] + '-' + hash)))
+        delta_file = join(self.blob_dir, hostpath(delta_blob))
+        if exists(delta_file):
+            size = stat(delta_file).st_size
+        else:
+            delta_contents = self.make_delta(rel_name, source, base_dir, base, limit)
+            if delta_contents is None:
+                return None
+            size = len(delta_contents)
+            write_atomic(delta_file, lambda out: out.write(delta_contents))
+        if size < limit:
+            delta = self.delta_entry(base, size)
+            delta['blob'] = delta_blob
+            return delta
+
+    def make_delta(self, rel_name, source, base_dir, base, limit):
+        '''Returns the compressed delta from the base version of a file, or
+        None if no delta smaller than limit can be made.'''
+        # the base Differ cannot diff, so avoid loading both versions for it
+        if not base or type(self.differ).diff == Differ.diff:
+            return None
+        if self.cost_model and not self.cost_model.allows(getattr(source, 'size', None)):
+            self.metrics.count('diff.skipped')
+            return None
+        codec = self.compressor.codec(base.get('codec'))
+        if 'blob' in base:
+            if not self.blob_dir:
+                return None
+            base_name = join(self.blob_dir, hostpath(base['blob']))
+        else:
+            base_name = codec.add_extension(join(base_dir, rel_name))
+        try:
+            with self.metrics.phase('diff'):
+                with open(base_name, 'rb') as f:
+                    base_contents = codec.decompress(f.read())
+                with source.open() as f:
+                    contents = f.read()
+                # limit is compressed, so bound the delta by the uncompressed
+                # file, as a longer delta is not expected to compress smaller
+                if self.cost_model is None:
+                    delta = self.differ.diff_bounded(base_contents, contents, len(contents))
+                elif self.cost_model.worthwhile(base_contents, contents, limit):
+                    delta = self.cost_model.timed(self.differ.diff_bounded, base_contents, contents, len(contents))
+                else:
+                    self.metrics.count('diff.skipped')
+                    return None
+                delta_contents = self.compressor.compress(delta)
+        except DiffError:
+            return None
+        if len(delta_contents) < limit:
+            return delta_contents
+
+    def delta_entry(self, base, size):
+        return {'version': self.version, 'size': size, 'old_hash': base['hash'], 'old_version': base['delta'] and base['delta']['version']}
+
+
+# the builder used by pool workers, set once per process by _init_worker
+_worker_builder = None
+
+def _init_worker(builder):
+    global _worker_builder
+    _worker_builder = builder
+
+def _build_file(task):
+    return _worker_builder.build(*task)
+
+
+class FileSource(object):
+    '''A file to be read from disk when needed.'''
+
+    def __init__(self, name, fingerprint=None, size=None):
+        self.name = name
+        self.fingerprint = fingerprint
+        self.size = size
+
+    def open(self):
+        return open(self.name, 'rb')
+
+
+class StringSource(object):
+    '''File contents which are already in memory.'''
+
+    def __init__(self, contents):
+        self.contents = contents
+        self.size = len(contents)
+
+    def open(self):
+        return BytesIO(self.contents)
+
+
+class HashingReader(object):
+    '''Wraps a file object and hashes everything read through it.'''
+
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.hash.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+class SpooledFile(object):
+    '''A file on disk which is only opened once it is read, and is closed
+    again when it has been read to the end.'''
+
+    def __init__(self, name):
+        self.name = name
+        self.f = None
+        self.finished = False
+
+    def read(self, size=-1):
+        if self.finished:
+            return ''
+        if self.f is None:
+            self.f = open(self.name, 'rb')
+        data = self.f.read(size)
+        if not data or size < 0:
+            self.finished = True
+            self.close()
+        return data
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+class ReadCounter(object):
+    '''Wraps a file object and reports the number of bytes read through it.'''
+
+    def __init__(self, f, report):
+        self.f = f
+        self.report = report
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.report(len(data))
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+class HashingWriter(object):
+    '''Wraps a file object and hashes everything written through it.'''
+
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        self.f.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def set_file(handler, archive, name, f, mode=None):
+    '''Writes the contents of a file object with a handler, streaming it if
+    the handler has set_file.'''
+    if hasattr(handler, 'set_file'):
+        handler.set_file(archive, name, f, mode)
+    else:
+        handler.set(archive, name, f.read(), mode)
+
+
+def open_file(handler, archive, name):
+    '''Returns a file object reading a file with a handler, which opens the
+    file directly if the handler has open.'''
+    if hasattr(handler, 'open'):
+        return handler.open(archive, name)
+    return BytesIO(handler.get(archive, name))
+
+
+def seekable_file(f):
+    '''Returns f if it is a file on disk, otherwise a temporary copy of it.
+    Either way, the file returned is closed by the caller.'''
+    try:
+        os.fstat(f.fileno())
+        return f
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+    copy = tempfile.TemporaryFile()
+    try:
+        shutil.copyfileobj(f, copy, CHUNK_SIZE)
+        copy.seek(0)
+    except:
+        copy.close()
+        raise
+    finally:
+        f.close()
+    return copy
+
+
+def hash_file(f, chunk_size=CHUNK_SIZE):
+    '''Returns the SHA-256 hex digest of a file object, read in chunks.'''
+    hash = hashlib.sha256()
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return hash.hexdigest()
+        hash.update(chunk)
+
+
+def choose_delta_bases(history, count, exponential=False):
+    '''Picks distributions to use as delta_bases from a list of earlier
+    distributions, newest first.
+
+    Either the last count distributions are used, or count distributions
+    spaced exponentially back through the history (1, 2, 4, 8... versions
+    before the previous one).'''
+    if not exponential:
+        return history[:count]
+    return [history[(1 << i) - 1] for i in range(count) if (1 << i) - 1 < len(history)]
+
+
+def codec_entry(entry, codec_name):
+    '''Records the codec a file was compressed with in its entry.'''
+    if codec_name is not None:
+        entry['codec'] = codec_name
+    return entry
+
+
+def chain_link(delta):
+    '''Returns how a patch plan refers to a delta.
+
+    Deltas stored under the file's own name are named by their version, other
+    deltas (e.g. in the blob store or a pack) by their delta entry.'''
+    if 'blob' in delta or 'file' in delta or 'pack' in delta:
+        return delta
+    return delta['version']
+
+
+def blob_name(hash):
+    '''Returns the name a blob is stored under in the blob store.'''
+    return hash[:2] + '/' + hash
+
+
+def write_atomic(name, write):
+    '''Creates a file by calling write with a temporary file and renaming it
+    into place, so concurrent builds never see a partial file.'''
+    ensure_dir(dirname(name))
+    fd, tmp = tempfile.mkstemp(dir=dirname(name))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        if os.name == 'nt' and exists(name):
+            unlink(name)
+        os.rename(tmp, name)
+    except:
+        unlink(tmp)
+        raise
+
+
 def ensure_dir(name):
     if name and not exists(name):
-        makedirs(name)
+        try:
+            makedirs(name)
+        except OSError:
+            # another build worker may have created it first
+            if not exists(name):
+                raise
 
 
 class DummyHandler(object):
@@ -265,10 +1129,16 @@ class DummyHandler(object):
         with open(name, 'rb') as f:
             return f.read()
 
+    def open(self, archive, name):
+        return open(name, 'rb')
+
     def set(self, archive, name, contents, mode=None):
+        self.set_file(archive, name, BytesIO(contents), mode)
+
+    def set_file(self, archive, name, f, mode=None):
         ensure_dir(dirname(name))
-        with open(name, 'wb') as f:
-            f.write(contents)
+        with open(name, 'wb') as out:
+            shutil.copyfileobj(f, out, CHUNK_SIZE)
         if mode is not None:
             os.chmod(name, mode)
 
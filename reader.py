@@ -1,39 +1,335 @@
+import os
+from os.path import join, exists, getsize
 import urllib2
+import httplib
+import socket
+import threading
+import time
+import hashlib
+import re
+import shutil
+import tempfile
+from io import BytesIO
+from urlparse import urlsplit
+
+from metrics import Metrics
+
+
+CHUNK_SIZE = 1 << 16
+# ranges closer than this are fetched as one, and at most MAX_RANGES are
+# asked for in one request
+RANGE_GAP = 1 << 10
+MAX_RANGES = 100
 
 
 class Reader(object):
     def get(self, version, name):
         raise IOError()
 
+    def open(self, version, name):
+        '''Returns a file object to read a file from. Readers which can
+        stream files should override this, by default the whole file is
+        read with get.'''
+        return BytesIO(self.get(version, name))
+
+    def get_range(self, version, name, ranges):
+        '''Returns the contents of each (offset, size) range of a file.
+        Readers which can read part of a file should override this, by
+        default the whole file is read with get.'''
+        contents = self.get(version, name)
+        return [contents[offset:offset + size] for offset, size in ranges]
+
 
 class URLReader(Reader):
-    def __init__(self, prefix='', format_string=None, chunk_size=None, report_callback=None):
+    def __init__(self, prefix='', format_string=None, chunk_size=None, report_callback=None,
+                 pool_size=4, timeout=30, retries=3, backoff=0.5, partial_dir=None, metrics=None, range_gap=RANGE_GAP):
         self.prefix = prefix
         self.format_string = format_string
         self.chunk_size = chunk_size
         self.report_callback = report_callback
+        self.metrics = metrics or Metrics()
+        self.range_gap = range_gap
+        self.pool = ConnectionPool(pool_size, timeout, retries, backoff, self.metrics)
+        self.partial_dir = partial_dir
+        self.partial_locks = {}
+        self.lock = threading.Lock()
+        if partial_dir and not exists(partial_dir):
+            os.makedirs(partial_dir)
+
+    def url(self, version, name):
+        if self.format_string:
+            return self.format_string.format(version=version, name=name)
+        return self.prefix + version + '/' + name
 
     def get(self, version, name):
+        out = BytesIO()
+        self.fetch(version, name, out)
+        return out.getvalue()
+
+    def open(self, version, name):
+        '''Downloads a file into a temporary file, which is returned.'''
+        out = tempfile.TemporaryFile()
         try:
-            if self.format_string:
-                url = self.format_string.format(version=version, name=name)
+            self.fetch(version, name, out)
+            out.seek(0)
+        except:
+            out.close()
+            raise
+        return out
+
+    def get_range(self, version, name, ranges):
+        '''Fetches ranges of an HTTP file with multiple range requests, each
+        asking for up to MAX_RANGES groups of nearby ranges.
+
+        Servers which send fewer ranges than were asked for are asked again
+        for the rest, and servers which send the whole file are sliced.'''
+        url = self.url(version, name)
+        if not url.startswith(('http:', 'https:')):
+            return Reader.get_range(self, version, name, ranges)
+        pieces = {}
+        pending = []
+        for start, end, group in coalesce(ranges, self.range_gap):
+            if start == end:
+                pieces.update((r, '') for r in group)
             else:
-                url = self.prefix + version + '/' + name
+                pending.append((start, end, group))
+        while pending:
+            header = 'bytes=' + ','.join('%i-%i' % (start, end - 1) for start, end, group in pending[:MAX_RANGES])
+            parts = self.pool.get(url, lambda response: self.read_ranges(url, response), {'Range': header},
+                                  statuses=(200, 206))
+            remaining = []
+            for start, end, group in pending:
+                for part_start, contents in parts:
+                    if part_start <= start and end <= part_start + len(contents):
+                        for offset, size in group:
+                            pieces[offset, size] = contents[offset - part_start:offset - part_start + size]
+                        break
+                else:
+                    remaining.append((start, end, group))
+            if len(remaining) == len(pending):
+                raise IOError('%s: requested ranges not sent' % url)
+            pending = remaining
+        return [pieces[offset, size] for offset, size in ranges]
+
+    def read_ranges(self, url, response):
+        '''Returns the (offset, contents) parts of a response to a range
+        request.'''
+        out = BytesIO()
+        self.copy(response, out)
+        body = out.getvalue()
+        if response.status == 200:
+            return [(0, body)]
+        content_type = response.getheader('content-type', '')
+        match = re.match(r'multipart/byteranges;\s*boundary="?([^";]+)"?', content_type, re.I)
+        if match:
+            return parse_byteranges(body, match.group(1))
+        match = re.match(r'bytes (\d+)-(\d+)/', response.getheader('content-range', ''))
+        if not match or int(match.group(2)) + 1 - int(match.group(1)) != len(body):
+            raise httplib.HTTPException('%s: unexpected range' % url)
+        return [(int(match.group(1)), body)]
 
+    def fetch(self, version, name, out):
+        url = self.url(version, name)
+        if url.startswith(('http:', 'https:')):
+            if self.partial_dir:
+                return self.fetch_resumable(version, name, url, out)
+            def read(response):
+                # start again if this is a retry
+                out.seek(0)
+                out.truncate()
+                self.copy(response, out)
+            return self.pool.get(url, read)
+        try:
             with urlopen(url) as f:
-                if self.chunk_size and self.report_callback:
-                    contents = ''
-                    while True:
-                        some = f.read(self.chunk_size)
-                        if len(some) < 1:
-                            return contents
-                        self.report_callback(len(some))
-                        contents += some
-                else:
-                    return f.read()
+                self.copy(f, out)
         except urllib2.URLError:
             raise IOError()
 
+    def copy(self, f, out):
+        while True:
+            some = f.read(self.chunk_size or CHUNK_SIZE)
+            if not some:
+                break
+            out.write(some)
+            self.metrics.count('reader.bytes', len(some))
+            if self.report_callback:
+                self.report_callback(len(some))
+        # httplib returns short reads rather than failing
+        if getattr(f, 'length', None):
+            raise httplib.IncompleteRead('', f.length)
+
+    def fetch_resumable(self, version, name, url, out):
+        '''Downloads url to out through the partial download store, continuing
+        from whatever an earlier failed attempt left there.'''
+        partial = join(self.partial_dir, hashlib.sha1(('%s\0%s' % (version, name)).encode('utf-8')).hexdigest())
+        validator = partial + '.validator'
+
+        def headers():
+            # only resume if the server can tell us the file has not changed
+            if exists(partial) and exists(validator) and getsize(partial):
+                with open(validator, 'rb') as f:
+                    return {'Range': 'bytes=%i-' % getsize(partial), 'If-Range': f.read()}
+            return {}
+
+        def read(response):
+            if response.status == 416:
+                # the partial file is no use, so start again
+                response.read()
+                os.unlink(partial)
+                raise httplib.HTTPException('range not satisfiable')
+            if response.status == 206:
+                match = re.match(r'bytes (\d+)-', response.getheader('content-range', ''))
+                if not match or int(match.group(1)) != getsize(partial):
+                    os.unlink(partial)
+                    raise httplib.HTTPException('unexpected range')
+                self.metrics.count('http.resumed')
+                mode = 'ab'
+            else:
+                mode = 'wb'
+                etag = response.getheader('etag')
+                if etag and etag.startswith('W/'):
+                    etag = None
+                tag = etag or response.getheader('last-modified')
+                if tag:
+                    with open(validator, 'wb') as f:
+                        f.write(tag)
+                elif exists(validator):
+                    os.unlink(validator)
+            with open(partial, mode) as f:
+                self.copy(response, f)
+
+        # the same file may be wanted by several threads at once
+        with self.lock:
+            lock = self.partial_locks.setdefault(partial, threading.Lock())
+        with lock:
+            self.pool.get(url, read, headers, statuses=(200, 206, 416))
+            with open(partial, 'rb') as f:
+                shutil.copyfileobj(f, out, CHUNK_SIZE)
+            os.unlink(partial)
+            if exists(validator):
+                os.unlink(validator)
+
+
+def parse_byteranges(body, boundary):
+    '''Returns the (offset, contents) parts of a multipart/byteranges body.'''
+    parts = []
+    delimiter = '--' + boundary
+    pos = 0
+    while True:
+        pos = body.find(delimiter, pos)
+        if pos < 0 or body.startswith('--', pos + len(delimiter)):
+            return parts
+        header_end = body.find('\r\n\r\n', pos)
+        match = re.search(r'content-range:\s*bytes (\d+)-(\d+)', body[pos:header_end], re.I)
+        if header_end < 0 or not match:
+            raise httplib.HTTPException('bad multipart response')
+        start = header_end + 4
+        size = int(match.group(2)) + 1 - int(match.group(1))
+        if len(body) < start + size:
+            raise httplib.HTTPException('bad multipart response')
+        parts.append((int(match.group(1)), body[start:start + size]))
+        pos = start + size
+
+
+def coalesce(ranges, gap):
+    '''Groups (offset, size) ranges which are less than gap bytes apart.
+
+    Returns a list of (start, end, ranges) for each group.'''
+    groups = []
+    for offset, size in sorted(set(ranges)):
+        if groups and offset - groups[-1][1] < gap:
+            groups[-1][1] = max(groups[-1][1], offset + size)
+            groups[-1][2].append((offset, size))
+        else:
+            groups.append([offset, offset + size, [(offset, size)]])
+    return [tuple(group) for group in groups]
+
+
+class ConnectionPool(object):
+    '''Persistent HTTP/1.1 connections, shared by the threads of a reader.
+
+    At most pool_size connections are made to each host. Failed requests are
+    retried after waiting backoff, doubling each time, and requests on a kept
+    alive connection which the server has since closed are retried at once.'''
+
+    def __init__(self, pool_size=4, timeout=30, retries=3, backoff=0.5, metrics=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.metrics = metrics or Metrics()
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.slots = {}
+
+    def get(self, url, read, headers=None, statuses=(200,)):
+        '''Requests url and returns read(response).
+
+        headers may be a function, called before each attempt. Raises IOError
+        if the server does not respond with one of statuses.'''
+        parts = urlsplit(url)
+        key = parts.scheme, parts.netloc
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        attempt = 0
+        while True:
+            conn, reused = self.acquire(key)
+            keep = False
+            self.metrics.count('http.requests')
+            try:
+                conn.request('GET', path, headers=(headers() if callable(headers) else headers) or {})
+                response = conn.getresponse()
+                if response.status not in statuses:
+                    response.read()
+                    keep = not response.will_close
+                    if response.status < 500:
+                        raise IOError('%s: HTTP %i' % (url, response.status))
+                    # the server answered, so the connection was not stale
+                    reused = False
+                    raise httplib.HTTPException('HTTP %i' % response.status)
+                contents = read(response)
+                keep = not response.will_close
+                return contents
+            except (socket.error, httplib.HTTPException) as e:
+                if not reused:
+                    if attempt >= self.retries:
+                        raise IOError('%s: request failed' % url)
+                    self.metrics.count('http.retries')
+                    self.metrics.event('http.retry', url=url, error=str(e) or type(e).__name__, attempt=attempt + 1)
+                    time.sleep(self.backoff * 2 ** attempt)
+                    attempt += 1
+            finally:
+                self.release(key, conn, keep)
+
+    def acquire(self, key):
+        '''Returns a connection to the host, and whether it was used before.'''
+        with self.lock:
+            slots = self.slots.setdefault(key, threading.Semaphore(self.pool_size))
+        slots.acquire()
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if idle:
+                return idle.pop(), True
+        scheme, netloc = key
+        self.metrics.count('http.connections')
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout), False
+        return httplib.HTTPConnection(netloc, timeout=self.timeout), False
+
+    def release(self, key, conn, keep):
+        if keep:
+            with self.lock:
+                self.idle[key].append(conn)
+        else:
+            conn.close()
+        self.slots[key].release()
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+                del idle[:]
+
 
 class urlopen(object):
     def __init__(self, *args, **kwargs):
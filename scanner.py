@@ -0,0 +1,126 @@
+import os
+from os.path import join
+import re
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from hashcache import stat_fingerprint
+
+
+# patterns using these may stop matching when more text follows what they
+# matched, so a directory they match cannot be skipped
+ASSERTIONS = re.compile(r'\$|\\[ZbB]|\(\?[=!<]')
+BACKREFERENCES = re.compile(r'\\[1-9]|\(\?P[=<]')
+
+
+class IgnoreMatcher(object):
+    '''Matches paths against a list of ignore patterns.
+
+    Patterns are combined into a single regular expression where possible,
+    which is much faster than trying each one in turn.'''
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        flags = set(pattern.flags for pattern in self.patterns)
+        if len(self.patterns) > 1 and len(flags) == 1 and \
+                not any(BACKREFERENCES.search(pattern.pattern) for pattern in self.patterns):
+            # group numbers change when patterns are combined, so patterns
+            # which refer to their groups are tried separately
+            self.combined = [re.compile('|'.join('(?:%s)' % pattern.pattern for pattern in self.patterns), flags.pop())]
+        else:
+            self.combined = self.patterns
+        self.prefix = [pattern for pattern in self.patterns if not ASSERTIONS.search(pattern.pattern)]
+
+    def __nonzero__(self):
+        return bool(self.patterns)
+
+    def match(self, name):
+        for pattern in self.combined:
+            if pattern.match(name):
+                return True
+        return False
+
+    def prunes(self, directory):
+        '''Returns True if every path in directory is ignored.'''
+        name = directory + os.sep
+        for pattern in self.prefix:
+            if pattern.match(name):
+                return True
+        return False
+
+
+class HandlerIndex(object):
+    '''Archive handlers indexed by extension, preferring the longest.'''
+
+    def __init__(self, handlers):
+        self.handlers = dict(handlers)
+        self.lengths = sorted(set(len(ext) for ext in self.handlers), reverse=True)
+
+    def find(self, name):
+        '''Returns the handler for a file name, or None.'''
+        for length in self.lengths:
+            handler = self.handlers.get(name[-length:])
+            if handler is not None:
+                return handler
+        return None
+
+
+def entries(directory):
+    '''Yields the name, whether it is a directory to descend into, and a
+    function returning the stat of each entry in directory.
+
+    Like os.walk, symbolic links to directories are not followed, and they
+    are not files either, so they are left out.'''
+    if scandir is not None:
+        for entry in scandir(directory):
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    yield entry.name, True, entry.stat
+            else:
+                yield entry.name, False, entry.stat
+    else:
+        for name in os.listdir(directory):
+            path = join(directory, name)
+            if os.path.isdir(path):
+                if not os.path.islink(path):
+                    yield name, True, lambda path=path: os.stat(path)
+            else:
+                yield name, False, lambda path=path: os.stat(path)
+
+
+def scan(source_dir, handlers, ignore):
+    '''Yields (rel_name, source, mode) for every file below source_dir, and
+    for every member of the archives handlers can open.
+
+    Directories which ignore matches entirely are never read.'''
+    from pixiepatch import FileSource, StringSource
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        subdirs = []
+        for name, is_dir, stat in entries(join(source_dir, rel_dir) if rel_dir else source_dir):
+            rel_name = join(rel_dir, name) if rel_dir else name
+            if is_dir:
+                if not (ignore and ignore.prunes(rel_name)):
+                    subdirs.append(rel_name)
+                continue
+
+            handler = handlers.find(name)
+            if handler is not None:
+                for member, contents, mode in handler.walk(join(source_dir, rel_name)):
+                    member_name = join(rel_name, member)
+                    if not (ignore and ignore.match(member_name)):
+                        if not hasattr(contents, 'open'):
+                            contents = StringSource(contents)
+                        yield member_name, contents, mode
+            elif not (ignore and ignore.match(rel_name)):
+                st = stat()
+                yield rel_name, FileSource(join(source_dir, rel_name), stat_fingerprint(st), st.st_size), st.st_mode
+        # visit directories in the order os.walk would
+        stack.extend(reversed(subdirs))
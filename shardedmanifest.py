@@ -0,0 +1,145 @@
+import hashlib
+import posixpath
+from collections import Mapping
+import simplejson
+
+from binarymanifest import utf8
+
+
+# shards are stored in the version directory, named by their digest
+SHARD_DIR = 'manifest.d'
+
+
+def directories(names):
+    '''Returns the files and subdirectories directly in each directory.'''
+    dirs = {'': ([], [])}
+    for name in names:
+        parent = posixpath.dirname(name)
+        if parent not in dirs:
+            dirs[parent] = ([], [])
+            # link the new directory into its parents
+            child = parent
+            while child:
+                parent = posixpath.dirname(child)
+                known = parent in dirs
+                dirs.setdefault(parent, ([], []))[1].append(child)
+                if known:
+                    break
+                child = parent
+        dirs[posixpath.dirname(name)][0].append(name)
+    return dirs
+
+
+def deepest_first(dirs):
+    return sorted(dirs, key=lambda d: d.count('/') + 1 if d else 0, reverse=True)
+
+
+def tree_line(name, hash):
+    return '%s\0%s\n' % (utf8(name), str(hash))
+
+
+def tree_hashes(files):
+    '''Returns the tree hash of every directory given the hash of every file.
+
+    A tree hash covers the names and hashes of everything below the directory,
+    so clients can compute them from their own files.'''
+    dirs = directories(files)
+    trees = {}
+    for d in deepest_first(dirs):
+        names, subdirs = dirs[d]
+        lines = [tree_line(posixpath.basename(name), files[name]) for name in names]
+        lines += [tree_line(posixpath.basename(subdir) + '/', trees[subdir]) for subdir in subdirs]
+        trees[d] = hashlib.sha256(''.join(sorted(lines))).hexdigest()
+    return trees
+
+
+def make_shards(files):
+    '''Splits manifest entries into a shard per directory.
+
+    Returns the root's tree hash and shard digest, and the shards by digest.
+    Each shard holds the entries of its files and the tree hash and digest of
+    its subdirectories, so verifying the root verifies every shard.'''
+    dirs = directories(files)
+    trees = tree_hashes(dict((name, entry['hash']) for name, entry in files.items()))
+    nodes = {}
+    shards = {}
+    for d in deepest_first(dirs):
+        names, subdirs = dirs[d]
+        shard = {'files': dict((name, files[name]) for name in names),
+                 'dirs': dict((subdir, nodes[subdir]) for subdir in subdirs)}
+        message = simplejson.dumps(shard, sort_keys=True, separators=(',', ':'))
+        digest = hashlib.sha256(message).hexdigest()
+        shards[digest] = message
+        nodes[d] = [trees[d], digest]
+    return nodes[''], shards
+
+
+def within(name, dirs):
+    '''Returns True if name is below any of dirs.'''
+    parent = name
+    while parent:
+        parent = posixpath.dirname(parent)
+        if parent in dirs:
+            return True
+    return False
+
+
+class ShardedFiles(Mapping):
+    '''The files of a sharded manifest. Shards are loaded as they are needed
+    by load, which is given a shard's digest.'''
+
+    def __init__(self, root, load):
+        self.root = root
+        self.load = load
+        self.shards = {}
+
+    def shard(self, digest):
+        if digest not in self.shards:
+            self.shards[digest] = self.load(digest)
+        return self.shards[digest]
+
+    def __getitem__(self, name):
+        if isinstance(name, str):
+            # shards are JSON, so their names are unicode
+            name = name.decode('utf-8')
+        # walk down the directories leading to the file
+        parents = []
+        parent = posixpath.dirname(name)
+        while parent:
+            parents.append(parent)
+            parent = posixpath.dirname(parent)
+        shard = self.shard(self.root[1])
+        for parent in reversed(parents):
+            if parent not in shard['dirs']:
+                raise KeyError(name)
+            shard = self.shard(shard['dirs'][parent][1])
+        return shard['files'][name]
+
+    def __iter__(self):
+        stack = [self.root]
+        while stack:
+            shard = self.shard(stack.pop()[1])
+            for name in shard['files']:
+                yield name
+            stack.extend(shard['dirs'].values())
+
+    def __len__(self):
+        return sum(1 for name in self)
+
+    def changed(self, trees):
+        '''Returns the files in directories whose tree hash differs from the
+        one in trees, and the directories which are the same.
+
+        Shards below an unchanged directory are never loaded.'''
+        names = []
+        same = set()
+        stack = [('', self.root)]
+        while stack:
+            d, (tree, digest) = stack.pop()
+            if trees.get(d) == tree:
+                same.add(d)
+                continue
+            shard = self.shard(digest)
+            names.extend(shard['files'])
+            stack.extend(shard['dirs'].items())
+        return names, same
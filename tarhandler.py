@@ -0,0 +1,262 @@
+import os
+import copy
+import time
+import tarfile
+import tempfile
+import shutil
+import threading
+from io import BytesIO
+from collections import OrderedDict
+from pixiepatch import netpath
+from hashcache import stat_fingerprint
+from compressor import CHUNK_SIZE
+
+
+COMPRESSIONS = [('.tar.gz', 'gz'), ('.tgz', 'gz'), ('.tar.bz2', 'bz2'), ('.tbz2', 'bz2'), ('.tar', '')]
+# members of compressed archives up to this size are read into memory during
+# a walk, larger ones are copied to a temporary file
+SPOOL_SIZE = 1 << 20
+
+
+class TARHandler(object):
+    '''A handler for tar archives, optionally compressed with gzip or bzip2.
+
+    The position of every member is indexed the first time an archive is
+    used, and the index is kept until the archive changes, so reading a
+    member of an uncompressed archive is a seek and a read.'''
+
+    def __init__(self):
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # copies in other processes make their own indexes
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def walk(self, archive):
+        if compression(archive):
+            return self.walk_compressed(archive)
+        return ((info.name, TARMember(self, archive, info), info.mode)
+                for info in self.index(archive).values() if info.isfile())
+
+    def walk_compressed(self, archive):
+        '''Walks a compressed archive in one pass, as reaching a member
+        means decompressing everything before it. Each member is read as it
+        is passed, so it can be read again without going back, and the
+        archive is indexed on the way.'''
+        fingerprint = stat_fingerprint(os.stat(archive))
+        members = OrderedDict()
+        with tarfile.open(archive, 'r|' + compression(archive)) as tar:
+            for info in tar:
+                members[info.name] = info
+                if not info.isfile():
+                    continue
+                f = tar.extractfile(info)
+                if info.size <= SPOOL_SIZE:
+                    source = f.read()
+                else:
+                    spool = tempfile.TemporaryFile()
+                    shutil.copyfileobj(f, spool, CHUNK_SIZE)
+                    source = SpooledMember(self, archive, info, spool)
+                yield info.name, source, info.mode
+        with self.lock:
+            self.indexes[archive] = fingerprint, members
+
+    def get(self, archive, name):
+        with self.open(archive, name) as f:
+            return f.read()
+
+    def open(self, archive, name):
+        '''Returns a file object reading a member.'''
+        info = self.index(archive).get(netpath(name))
+        if info is None or not info.isfile():
+            raise KeyError(name)
+        return self.open_member(archive, info)
+
+    def set(self, archive, name, contents, mode=None):
+        self.update(archive, {name: BytesIO(str(contents))}, {name: mode})
+
+    def set_file(self, archive, name, f, mode=None):
+        self.update(archive, {name: f}, {name: mode})
+
+    def delete(self, archive, name):
+        self.update(archive, {name: None})
+
+    def index(self, archive):
+        '''Returns the members of an archive by name, in archive order.'''
+        fingerprint = stat_fingerprint(os.stat(archive))
+        with self.lock:
+            cached = self.indexes.get(archive)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+        members = OrderedDict()
+        with tarfile.open(archive, 'r:' + compression(archive)) as tar:
+            for info in tar:
+                members[info.name] = info
+        with self.lock:
+            self.indexes[archive] = fingerprint, members
+        return members
+
+    def open_member(self, archive, info):
+        '''Returns a file object reading a member.'''
+        if not compression(archive):
+            f = open(archive, 'rb')
+            f.seek(info.offset_data)
+            return MemberFile(f, info.size)
+        tar = tarfile.open(archive, 'r:' + compression(archive))
+        try:
+            return MemberFile(tar.extractfile(info), info.size, tar)
+        except:
+            tar.close()
+            raise
+
+    def update(self, archive, changes, modes=None):
+        '''Applies several changes to an archive in one rewrite.
+
+        changes maps member names to file objects with their new contents, or
+        to None to delete them, and modes optionally gives the new members'
+        modes. Replaced members keep their other attributes.'''
+        changes = dict((netpath(name), f) for name, f in changes.items())
+        modes = dict((netpath(name), mode) for name, mode in (modes or {}).items())
+        d = os.path.dirname(archive)
+        if d and not os.path.exists(d):
+            os.makedirs(d)
+        mode = compression(archive)
+
+        fd, tmp = tempfile.mkstemp(dir=d or None)
+        os.close(fd)
+        try:
+            with tarfile.open(tmp, 'w:' + mode) as new_tar:
+                if os.path.exists(archive):
+                    with tarfile.open(archive, 'r:' + mode) as old_tar:
+                        for info in old_tar:
+                            if info.name not in changes:
+                                f = old_tar.extractfile(info) if info.isfile() else None
+                                new_tar.addfile(info, f)
+                            elif changes[info.name] is not None:
+                                add_member(new_tar, info.name, changes.pop(info.name), modes.get(info.name), info)
+                for name, f in sorted(changes.items()):
+                    if f is not None:
+                        add_member(new_tar, name, f, modes.get(name))
+            if os.name == 'nt' and os.path.exists(archive):
+                os.unlink(archive)
+            os.rename(tmp, archive)
+        except:
+            os.unlink(tmp)
+            raise
+        with self.lock:
+            self.indexes.pop(archive, None)
+
+
+def compression(archive):
+    for ext, mode in COMPRESSIONS:
+        if archive.endswith(ext):
+            return mode
+    return ''
+
+
+def add_member(tar, name, f, mode=None, old_info=None):
+    '''Adds a member from a file object, keeping the attributes of the member
+    it replaces.'''
+    with tempfile.TemporaryFile() as tmp:
+        shutil.copyfileobj(f, tmp, CHUNK_SIZE)
+        if old_info is None:
+            info = tarfile.TarInfo(name)
+            info.mode = 0644
+        else:
+            info = copy.copy(old_info)
+        if mode is not None:
+            info.mode = mode & 07777
+        info.size = tmp.tell()
+        info.mtime = int(time.time())
+        tmp.seek(0)
+        tar.addfile(info, tmp)
+
+
+class TARMember(object):
+    '''An archive member which is read when needed.'''
+
+    def __init__(self, handler, archive, info):
+        self.handler = handler
+        self.archive = archive
+        self.name = info.name
+        self.info = info
+        self.size = info.size
+
+    def open(self):
+        return self.handler.open_member(self.archive, self.info)
+
+
+class SpooledMember(TARMember):
+    '''An archive member which was copied to a temporary file during a walk.
+
+    Copies sent to other processes read the member from the archive.'''
+
+    def __init__(self, handler, archive, info, spool):
+        TARMember.__init__(self, handler, archive, info)
+        self.spool = spool
+        self.spool_lock = threading.Lock()
+
+    def open(self):
+        return SpoolReader(self.spool, self.spool_lock)
+
+    def __reduce__(self):
+        return TARMember, (self.handler, self.archive, self.info)
+
+
+class SpoolReader(object):
+    '''Reads a file shared with other readers, each keeping its own
+    position.'''
+
+    def __init__(self, f, lock):
+        self.f = f
+        self.lock = lock
+        self.pos = 0
+
+    def read(self, size=-1):
+        with self.lock:
+            self.f.seek(self.pos)
+            data = self.f.read(size)
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class MemberFile(object):
+    '''Reads at most size bytes from a file, closing it (and an archive) when
+    done.'''
+
+    def __init__(self, f, size, tar=None):
+        self.f = f
+        self.remaining = size
+        self.tar = tar
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+        if self.tar is not None:
+            self.tar.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
@@ -0,0 +1,46 @@
+import threading
+
+from nose.tools import *
+
+from pixiepatch.asyncpatch import Future, ThreadExecutor, TimeoutError
+
+
+class TestFuture(object):
+    def setUp(self):
+        self.executor = ThreadExecutor(2)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_result(self):
+        future = self.executor.submit(lambda a, b=0: a + b, 1, b=2)
+        assert_equal(future.result(5), 3)
+        assert future.done()
+        assert_equal(future.exception(), None)
+
+    def test_exception(self):
+        def fail():
+            raise KeyError('missing')
+        future = self.executor.submit(fail)
+        assert_raises(KeyError, future.result, 5)
+        assert isinstance(future.exception(), KeyError)
+
+    def test_callbacks(self):
+        release = threading.Event()
+        future = self.executor.submit(release.wait, 5)
+        assert_raises(TimeoutError, future.result, 0.01)
+        done = []
+        future.add_done_callback(done.append)
+        assert_equal(done, [])
+        release.set()
+        future.result(5)
+        assert_equal(done, [future])
+        # callbacks added later are called at once
+        future.add_done_callback(done.append)
+        assert_equal(done, [future, future])
+
+    def test_set(self):
+        future = Future()
+        assert not future.done()
+        future.set_result('done')
+        assert_equal(future.result(), 'done')
@@ -0,0 +1,37 @@
+import random
+from StringIO import StringIO
+
+from nose.tools import *
+
+from pixiepatch.chunker import Chunker
+
+
+class TestChunker(object):
+    def setUp(self):
+        rand = random.Random(1)
+        self.data = ''.join(chr(rand.randrange(256)) for i in range(100000)) + '\0' * 5000
+
+    def chunks(self, data, **kwargs):
+        chunker = Chunker(min_size=64, avg_size=512, max_size=2048, **kwargs)
+        return list(chunker.chunks(StringIO(data), buffer_size=4096))
+
+    def test_sizes(self):
+        chunks = self.chunks(self.data)
+        assert_equal(''.join(chunks), self.data)
+        for chunk in chunks[:-1]:
+            assert 64 <= len(chunk) <= 2048
+
+    def test_implementations_agree(self):
+        assert_equal(self.chunks(self.data, use_numpy=False), self.chunks(self.data, use_numpy=True))
+
+    def test_locality(self):
+        before = set(self.chunks(self.data))
+        after = self.chunks(self.data[:50000] + 'edit' + self.data[50000:])
+        assert len([chunk for chunk in after if chunk not in before]) <= 2
+
+    def test_empty(self):
+        assert_equal(self.chunks(''), [])
+
+    @raises(ValueError)
+    def test_invalid_sizes(self):
+        Chunker(min_size=1024, avg_size=512)
@@ -0,0 +1,53 @@
+import time
+import random
+import multiprocessing
+
+from nose.tools import *
+
+from pixiepatch.costmodel import DeltaCostModel
+
+
+def random_bytes(rand, size):
+    return ''.join(chr(rand.randrange(256)) for i in xrange(size))
+
+
+class TestDeltaCostModel(object):
+    def setUp(self):
+        self.rand = random.Random(1)
+        self.source = random_bytes(self.rand, 20000)
+        self.model = DeltaCostModel()
+
+    def test_similarity(self):
+        assert_equal(self.model.similarity(self.source, self.source), 1.0)
+        # an insertion shifts the rest of the file, which is still found
+        shifted = self.source[:5000] + 'inserted' + self.source[5000:]
+        assert self.model.similarity(self.source, shifted) > 0.9
+        half = self.source[:10000] + random_bytes(self.rand, 10000)
+        assert 0.3 < self.model.similarity(self.source, half) < 0.7
+        assert_equal(self.model.similarity(self.source, random_bytes(self.rand, 20000)), 0.0)
+        assert_equal(self.model.similarity('', self.source), 0.0)
+
+    def test_worthwhile(self):
+        assert self.model.worthwhile(self.source, self.source[:-100] + 'changed', 20000)
+        assert not self.model.worthwhile(self.source, random_bytes(self.rand, 20000), 20000)
+        # small files are always diffed
+        assert self.model.worthwhile(self.source, 'small', 5)
+
+    def test_limits(self):
+        model = DeltaCostModel(max_size=1000, budget=0.01)
+        assert model.allows(None)
+        assert model.allows(1000)
+        assert not model.allows(1001)
+        assert_equal(model.timed(lambda a, b: a + b, 'a', 'b'), 'ab')
+        model.spent.value = 0.01
+        assert not model.allows(10)
+        model.reset()
+        assert model.allows(10)
+
+    def test_shared_budget(self):
+        # time spent in worker processes counts against the same budget
+        model = DeltaCostModel(budget=1)
+        process = multiprocessing.Process(target=model.timed, args=(time.sleep, 0.05))
+        process.start()
+        process.join()
+        assert model.spent.value >= 0.05
@@ -0,0 +1,143 @@
+import os
+import random
+import tempfile
+from io import BytesIO
+
+from nose.tools import *
+
+from pixiepatch import *
+from pixiepatch.binarydiffer import BinaryDiffer, PatchReader, suffix_array, numpy_suffix_array, numpy
+
+
+def naive_suffix_array(data):
+    return sorted(range(len(data)), key=lambda i: data[i:])
+
+
+class TestSuffixArray(object):
+    def check(self, build):
+        random.seed(1)
+        for data in ['', 'a', 'banana', '\0' * 100 + 'ab' * 50, os.urandom(1000)]:
+            assert build(data) == naive_suffix_array(data)
+        for n in [10, 100, 1000]:
+            for alphabet in ['ab', 'a\0', '\xff\0']:
+                data = ''.join(random.choice(alphabet) for i in range(n))
+                assert build(data) == naive_suffix_array(data)
+
+    def test_python(self):
+        self.check(suffix_array)
+
+    def test_numpy(self):
+        if numpy is None:
+            return
+        self.check(numpy_suffix_array)
+
+
+class TestBinaryDiffer(object):
+    def setUp(self):
+        random.seed(2)
+        self.differ = BinaryDiffer()
+
+    def round_trip(self, source, target):
+        patch = self.differ.diff(source, target)
+        assert self.differ.patch(source, patch) == target
+        return patch
+
+    def test_edge_cases(self):
+        self.round_trip('', '')
+        self.round_trip('abc', '')
+        self.round_trip('', 'abc')
+        self.round_trip('same' * 10, 'same' * 10)
+
+    def test_binary(self):
+        source = os.urandom(20000) + '\0' * 5000 + os.urandom(20000)
+        target = bytearray(source)
+        for i in range(20):
+            pos = random.randrange(len(target))
+            target[pos:pos + 10] = os.urandom(random.randint(0, 30))
+        target = str(target)
+        patch = self.round_trip(source, target)
+        assert len(patch) < len(target) / 10
+
+    def test_without_numpy(self):
+        source = os.urandom(5000)
+        target = source[2000:] + 'new' + source[:2000]
+        differ = BinaryDiffer(use_numpy=False)
+        assert differ.patch(source, differ.diff(source, target)) == target
+
+    @raises(DiffError)
+    def test_invalid(self):
+        self.differ.patch('abc', 'not a patch')
+
+    @raises(DiffError)
+    def test_wrong_source(self):
+        patch = self.differ.diff('a' * 100, 'a' * 200)
+        self.differ.patch('a' * 10, patch)
+
+    def test_rewritten(self):
+        # nothing in common, so everything is inserted
+        source = os.urandom(200000)
+        target = os.urandom(200000)
+        patch = self.round_trip(source, target)
+        assert len(patch) < len(target) + 20
+
+    def test_bounded(self):
+        source = os.urandom(20000)
+        target = source[:10000] + os.urandom(5000) + source[10000:]
+        patch = self.differ.diff_bounded(source, target, len(target))
+        assert_equal(self.differ.patch(source, patch), target)
+        assert_raises(DiffError, self.differ.diff_bounded, source, target, 1000)
+        assert_raises(DiffError, self.differ.diff_bounded, source, os.urandom(20000), 20000)
+
+    def patch_file(self, source, patch):
+        out = BytesIO()
+        self.differ.patch_file(source, BytesIO(patch), out)
+        return out.getvalue()
+
+    def test_patch_file(self):
+        source = os.urandom(300000)
+        target = source[100000:] + os.urandom(100000) + source[:100000]
+        patch = self.differ.diff(source, target)
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(source)
+            assert self.patch_file(f, patch) == target
+        # not on disk, so copied first
+        assert self.patch_file(BytesIO(source), patch) == target
+        with tempfile.TemporaryFile() as f:
+            assert self.patch_file(f, self.differ.diff('', 'abc')) == 'abc'
+
+    @raises(DiffError)
+    def test_patch_file_truncated(self):
+        source = os.urandom(1000)
+        patch = self.differ.diff(source, source + 'more')
+        self.patch_file(BytesIO(source), patch[:-2])
+
+    def test_patch_reader(self):
+        reader = PatchReader(BytesIO('abcdefghij'), block_size=3)
+        assert reader.read(2) == 'ab'
+        assert reader.read(5) == 'cdefg'
+        assert not reader.at_end()
+        assert reader.read(3) == 'hij'
+        assert reader.at_end()
+
+
+class ReplacingDiffer(Differ):
+    def diff(self, source, target):
+        return target
+
+    def patch(self, source, patch):
+        return patch
+
+
+class TestDefaultDiffer(object):
+    def test_files(self):
+        differ = ReplacingDiffer()
+        patch = BytesIO()
+        differ.diff_file(BytesIO('old'), BytesIO('new'), patch)
+        out = BytesIO()
+        differ.patch_file(BytesIO('old'), BytesIO(patch.getvalue()), out)
+        assert out.getvalue() == 'new'
+
+    def test_bounded(self):
+        differ = ReplacingDiffer()
+        assert_equal(differ.diff_bounded('old', 'new', 3), 'new')
+        assert_raises(DiffError, differ.diff_bounded, 'old', 'new', 2)
@@ -1,3 +1,4 @@
+import os
 from os import mkdir, stat
 from os.path import join, exists
 import tempfile
@@ -5,12 +6,15 @@ import shutil
 import sys
 import hashlib
 import bz2
+from StringIO import StringIO
 from zipfile import ZipFile
 from nose.tools import *
 
 from pixiepatch import *
 from pixiepatch.bz2compressor import BZ2Compressor
 from pixiepatch.ziphandler import ZIPHandler
+from pixiepatch.zlibcompressor import ZlibCompressor
+from pixiepatch.adaptivecompressor import AdaptiveCompressor
 
 
 class Base(object):
@@ -170,6 +174,69 @@ class TestCompressor(Base):
         assert manifest['files']['a']['dlsize'] == file_size
 
 
+class TestAdaptiveCompressor(Base):
+    def setUp(self):
+        Base.setUp(self)
+        with open(join(self.sources[0], 'a.png'), 'wb') as f:
+            f.write('test\n' * 100)
+        with open(join(self.sources[0], 'random'), 'wb') as f:
+            f.write(os.urandom(5000))
+        with open(join(self.sources[0], 'text'), 'wb') as f:
+            f.write(''.join(['line %i\n' % i for i in range(1000)]))
+        self.pp = PixiePatch(compressor=AdaptiveCompressor())
+        self.pp.make_distribution('1', self.sources[0], self.dists[0])
+
+    def test_codecs(self):
+        manifest = self.pp.read_manifest(join(self.dists[0], 'manifest.bz2'))
+        files = manifest['files']
+        assert_equal(files['a.png']['codec'], 'stored')
+        assert_equal(files['random']['codec'], 'stored')
+        assert files['text']['codec'] in ('zlib', 'bz2', 'lzma')
+
+        assert exists(join(self.dists[0], 'a.png'))
+        assert_equal(stat(join(self.dists[0], 'random')).st_size, 5000)
+        codec = self.pp.compressor.codec(files['text']['codec'])
+        with open(codec.add_extension(join(self.dists[0], 'text')), 'rb') as f:
+            assert_equal(codec.decompress(f.read()), ''.join(['line %i\n' % i for i in range(1000)]))
+
+    def test_levels(self):
+        compressor = AdaptiveCompressor(codecs=[('zlib', ZlibCompressor(1)), ('bz2', BZ2Compressor(1))], default='zlib')
+        assert_equal(compressor.compressed_extension, '.zlib')
+        assert_equal(compressor.choose('a.ogg', ''), 'stored')
+        assert_equal(compressor.choose('a', 'a' * 1000), 'zlib')
+
+
+class UpperCompressor(Compressor):
+    def compress(self, contents):
+        return contents.upper()
+
+    def decompress(self, contents):
+        return contents.lower()
+
+
+class TestStreamingCompressor(object):
+    def check_round_trip(self, compressor):
+        contents = ''.join(['line %i\n' % i for i in range(20000)])
+        compressed = StringIO()
+        size = compressor.compress_file(StringIO(contents), compressed, chunk_size=1000)
+        assert size == len(compressed.getvalue())
+        assert compressor.decompress(compressed.getvalue()) == contents
+
+        decompressed = StringIO()
+        compressed.seek(0)
+        compressor.decompress_file(compressed, decompressed, chunk_size=1000)
+        assert decompressed.getvalue() == contents
+
+    def test_plain(self):
+        self.check_round_trip(Compressor())
+
+    def test_bz2(self):
+        self.check_round_trip(BZ2Compressor())
+
+    def test_buffered(self):
+        self.check_round_trip(UpperCompressor())
+
+
 class TestZipHandler(Base):
     def setUp(self):
         Base.setUp(self)
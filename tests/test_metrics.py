@@ -0,0 +1,62 @@
+import threading
+
+from nose.tools import *
+
+from pixiepatch.metrics import Metrics, RecordingMetrics, ProfilingMetrics, timed_iter
+
+
+def work():
+    return sum(i * i for i in range(10000))
+
+
+class TestMetrics(object):
+    def test_null(self):
+        metrics = Metrics()
+        with metrics.phase('a'):
+            metrics.count('b')
+            metrics.event('c', file='d')
+        assert_equal(list(timed_iter(metrics, 'e', [1, 2])), [1, 2])
+
+    def test_recording(self):
+        metrics = RecordingMetrics()
+        with metrics.phase('a'):
+            with metrics.phase('b'):
+                work()
+        with metrics.phase('b'):
+            pass
+        metrics.count('build.bytes_in', 100)
+        metrics.count('build.bytes_out', 25)
+        metrics.event('c', file='d')
+        assert_equal(list(timed_iter(metrics, 'e', [1, 2])), [1, 2])
+
+        summary = metrics.summary()
+        assert_equal(summary['phases']['a']['calls'], 1)
+        assert_equal(summary['phases']['b']['calls'], 2)
+        assert_equal(summary['phases']['e']['calls'], 3)
+        assert summary['phases']['a']['wall'] >= summary['phases']['b']['wall'] > 0
+        assert_equal(summary['ratios'], {'build.compression': 0.25})
+        assert_equal([(name, fields) for when, name, fields in metrics.events], [('c', {'file': 'd'})])
+        assert 'build.bytes_in' in metrics.report()
+
+        # failed phases are still timed
+        try:
+            with metrics.phase('f'):
+                raise ValueError()
+        except ValueError:
+            pass
+        assert_equal(metrics.summary()['phases']['f']['calls'], 1)
+
+    def test_profiling(self):
+        metrics = ProfilingMetrics()
+        def run():
+            with metrics.phase('a'):
+                work()
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        run()
+        assert_equal(metrics.summary()['phases']['a']['calls'], 5)
+        assert 'work' in metrics.stats()
+        assert metrics.owner is None
@@ -8,16 +8,37 @@ import sys
 import hashlib
 import bz2
 import difflib
-from zipfile import ZipFile
+import random
+import pickle
+import tarfile
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+from io import BytesIO
 from subprocess import Popen, PIPE
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
 from nose.tools import *
 import unittest
 
 from pixiepatch import *
 from pixiepatch.bz2compressor import BZ2Compressor
-from pixiepatch.ziphandler import ZIPHandler
+from pixiepatch.ziphandler import ZIPHandler, ZIPMember
+from pixiepatch import tarhandler
+from pixiepatch.tarhandler import TARHandler, compression
 from pixiepatch.reader import URLReader
+from pixiepatch.binarydiffer import BinaryDiffer
+from pixiepatch.chunker import Chunker
+from pixiepatch.adaptivecompressor import AdaptiveCompressor
+from pixiepatch.hashcache import HashCache, stat_fingerprint
+from pixiepatch.manifestcache import ManifestCache
+from pixiepatch.shardedmanifest import tree_hashes
+from pixiepatch.metrics import RecordingMetrics
+from pixiepatch.costmodel import DeltaCostModel
+from pixiepatch.asyncpatch import AsyncPatcher
+from pixiepatch.pixiepatch import choose_delta_bases
 
 
 class Base(unittest.TestCase):
@@ -46,9 +67,12 @@ class TextDiffer(Differ):
 
 
 class TestPatch(Base):
+    compressor = Compressor
+    differ = TextDiffer
+
     def setUp(self):
         Base.setUp(self)
-        self.pp = PixiePatch(differ=TextDiffer(), reader=URLReader('file://' + self.dir + '/dist-'))
+        self.pp = PixiePatch(compressor=self.compressor(), differ=self.differ(), reader=URLReader('file://' + self.dir + '/dist-'))
         self.pp.register_ignore_pattern('^ignore$')
 
         with open(join(self.sources[0], 'a'), 'w') as f:
@@ -91,9 +115,12 @@ class TestPatch(Base):
         with open(join(self.sources[2], 'f'), 'w') as f:
             f.write('test\n' * 100)
 
-        self.pp.make_distribution('1', self.sources[0], self.dists[0])
-        self.pp.make_distribution('2', self.sources[1], self.dists[1], self.dists[0])
-        self.pp.make_distribution('3', self.sources[2], self.dists[2], self.dists[1])
+        self.build('1', self.sources[0], self.dists[0])
+        self.build('2', self.sources[1], self.dists[1], self.dists[0])
+        self.build('3', self.sources[2], self.dists[2], self.dists[1])
+
+    def build(self, version, source, target, previous=None):
+        self.pp.make_distribution(version, source, target, previous)
 
     def test_plans(self):
         # version 1 -> 2
@@ -155,6 +182,25 @@ class TestPatch(Base):
         diff = Popen(['diff', '-ru', self.sources[0], self.sources[2]], stdout=PIPE).communicate()[0]
         self.assertEqual(diff, '')
 
+    def check_non_ascii(self):
+        '''Builds and plans with non-ASCII names, which are UTF-8 byte strings
+        when read from disk.'''
+        name = 'caf\xc3\xa9'
+        for i, source in enumerate(self.sources[:2]):
+            mkdir(join(source, 'd\xc3\xaer'))
+            for path in [name, join('d\xc3\xaer', name)]:
+                with open(join(source, path), 'w') as f:
+                    f.write('v%i\n' % i)
+        self.build('1', self.sources[0], self.dists[0])
+        self.build('2', self.sources[1], self.dists[1], self.dists[0])
+        files = self.pp.read_manifest(join(self.dists[1], 'manifest'))['files']
+        assert name.decode('utf-8') in set(files)
+        self.assertEqual(files[name], files[name.decode('utf-8')])
+        client_manifest = self.pp.create_client_manifest('1', self.sources[0])
+        plan = self.pp.get_patch_plan(client_manifest, '2')
+        self.assertEqual(set(plan['download']) | set(p[0] for p in plan['patch']),
+                         set(['b', 'c', 'e', 'f', name.decode('utf-8'), ('d\xc3\xaer/' + name).decode('utf-8')]))
+
     def test_mode(self):
         # version 1 -> 2
         client_manifest = self.pp.create_client_manifest('1', self.sources[0])
@@ -164,6 +210,513 @@ class TestPatch(Base):
         assert stats.st_mode & 0777 == stat.S_IREAD
 
 
+class TestBinaryPatch(TestPatch):
+    differ = BinaryDiffer
+
+
+class TestAdaptivePatch(TestPatch):
+    compressor = AdaptiveCompressor
+
+    def test_plans(self):
+        # whether patching pays off depends on the codecs chosen
+        client_manifest = self.pp.create_client_manifest('1', self.sources[0])
+        plan = self.pp.get_patch_plan(client_manifest, '3')
+        assert set(plan['download']) | set([p[0] for p in plan['patch']]) == set(['b', 'c', 'e', 'f'])
+        assert set(plan['delete']) == set(['d'])
+
+
+class TestParallelBuild(TestPatch):
+    def test_identical_manifests(self):
+        parallel = [join(self.dir, 'parallel-%i' % i) for i in range(1, 4)]
+        self.pp.make_distribution('1', self.sources[0], parallel[0], jobs=2)
+        self.pp.make_distribution('2', self.sources[1], parallel[1], parallel[0], jobs=2)
+        self.pp.make_distribution('3', self.sources[2], parallel[2], parallel[1], jobs=2)
+        for serial_dir, parallel_dir in zip(self.dists, parallel):
+            with open(join(serial_dir, 'manifest'), 'rb') as f:
+                serial_manifest = f.read()
+            with open(join(parallel_dir, 'manifest'), 'rb') as f:
+                self.assertEqual(f.read(), serial_manifest)
+            assert exists(join(parallel_dir, 'c.patch')) == exists(join(serial_dir, 'c.patch'))
+
+
+class TestParallelPatch(TestPatch):
+    def setUp(self):
+        TestPatch.setUp(self)
+        patch = self.pp.patch
+        self.pp.patch = lambda directory, plan: patch(directory, plan, jobs=4)
+
+    def test_verification(self):
+        with open(join(self.dists[1], 'b'), 'w') as f:
+            f.write('corrupt\n')
+        client_manifest = self.pp.create_client_manifest('1', self.sources[0])
+        plan = self.pp.get_patch_plan(client_manifest, '2')
+        self.assertRaises(VerificationError, self.pp.patch, self.sources[0], plan)
+
+
+class TestMetrics(TestPatch):
+    def test_patch(self):
+        metrics = self.pp.metrics = RecordingMetrics()
+        client_manifest = self.pp.create_client_manifest('1', self.sources[0])
+        plan = self.pp.get_patch_plan(client_manifest, '2')
+        self.pp.patch(self.sources[0], plan)
+        summary = metrics.summary()
+        for phase in ['scan', 'hash', 'manifest.fetch', 'manifest.parse', 'download', 'patch', 'write']:
+            assert phase in summary['phases'], phase
+        # b changes completely, so it is downloaded rather than patched
+        self.assertEqual(summary['counters']['plan.changed'], 3)
+        self.assertEqual(summary['counters']['plan.deltas'], 2)
+        self.assertAlmostEqual(summary['ratios']['plan.delta_hit_rate'], 2 / 3.0)
+        self.assertEqual(summary['counters']['patch.files'], 4)
+        self.assertEqual(sorted((fields['file'], fields['action']) for when, name, fields in metrics.events),
+                         [('b', 'download'), ('c', 'patch'), ('d', 'delete'), ('e', 'patch'), ('f', 'download')])
+
+    def test_build(self):
+        metrics = self.pp.metrics = RecordingMetrics()
+        target = join(self.dir, 'metrics')
+        self.pp.make_distribution('2', self.sources[1], target, self.dists[0])
+        counters = metrics.summary()['counters']
+        self.assertEqual(counters['build.files'], 5)
+        self.assertEqual(counters['build.bytes_in'], sum(os.path.getsize(join(self.sources[1], name)) for name in 'abcef'))
+        self.assertEqual(counters['build.changed'], 3)
+        self.assertEqual(counters['build.deltas'], 2)
+        assert 'diff' in metrics.summary()['phases']
+
+        # worker processes do not report phases, but files are still counted
+        metrics = self.pp.metrics = RecordingMetrics()
+        self.pp.make_distribution('2', self.sources[1], join(self.dir, 'parallel'), self.dists[0], jobs=2)
+        self.assertEqual(metrics.summary()['counters'], counters)
+
+
+class TestCostModel(TestPatch):
+    differ = BinaryDiffer
+
+    def build(self, version, source, target, previous=None):
+        self.pp.cost_model = DeltaCostModel(samples=4)
+        self.pp.make_distribution(version, source, target, previous)
+
+    def test_skipped(self):
+        rand = random.Random(1)
+        for source in self.sources[:2]:
+            with open(join(source, 'g'), 'wb') as f:
+                f.write(''.join(chr(rand.randrange(256)) for i in range(4096)))
+        self.pp.metrics = RecordingMetrics()
+        self.build('1', self.sources[0], join(self.dir, 'skipped-1'))
+        self.build('2', self.sources[1], join(self.dir, 'skipped-2'), join(self.dir, 'skipped-1'))
+        # b and g were rewritten, so they were not diffed, but c and e still were
+        self.assertEqual(self.pp.metrics.summary()['counters']['diff.skipped'], 2)
+        assert not exists(join(self.dir, 'skipped-2', 'b.bdiff'))
+        assert not exists(join(self.dir, 'skipped-2', 'g.bdiff'))
+        assert exists(join(self.dir, 'skipped-2', 'c.bdiff'))
+
+        # nothing is diffed once the budget is spent
+        self.pp.cost_model = DeltaCostModel(budget=0)
+        self.pp.make_distribution('2', self.sources[1], join(self.dir, 'spent'), join(self.dir, 'skipped-1'))
+        assert not exists(join(self.dir, 'spent', 'c.bdiff'))
+
+    def test_budget_reset(self):
+        # each build starts with the whole budget
+        self.pp.cost_model = DeltaCostModel(budget=60)
+        self.pp.cost_model.spent.value = 60
+        self.pp.make_distribution('2', self.sources[1], join(self.dir, 'again'), self.dists[0])
+        assert exists(join(self.dir, 'again', 'c.bdiff'))
+        assert self.pp.cost_model.spent.value < 60
+
+    def test_parallel_budget(self):
+        # only the workers diff, and their time is counted here
+        self.pp.cost_model = DeltaCostModel(budget=60)
+        self.pp.make_distribution('2', self.sources[1], join(self.dir, 'parallel'), self.dists[0], jobs=2)
+        assert exists(join(self.dir, 'parallel', 'c.bdiff'))
+        assert self.pp.cost_model.spent.value > 0
+
+
+class TestAsyncPatch(TestPatch):
+    def setUp(self):
+        TestPatch.setUp(self)
+        self.patcher = AsyncPatcher(self.pp, workers=3)
+
+    def tearDown(self):
+        self.patcher.shutdown()
+        TestPatch.tearDown(self)
+
+    def assertSame(self, a, b):
+        diff = Popen(['diff', '-ru', a, b], stdout=PIPE).communicate()[0]
+        self.assertEqual(diff, '')
+
+    def test_steps(self):
+        manifest = self.patcher.create_client_manifest('1', self.sources[0]).result(10)
+        plan = self.patcher.get_patch_plan(manifest, '2').result(10)
+        self.assertEqual(self.patcher.patch(self.sources[0], plan).result(10), None)
+        self.assertSame(self.sources[0], self.sources[1])
+        self.assertEqual(self.patcher.reader.get('2', 'version').result(10), '2\n')
+
+    def test_concurrent(self):
+        # several installations are updated at once, sharing a hash cache
+        self.pp.hash_cache = HashCache(join(self.dir, 'hashes'))
+        installs = []
+        for i, version in enumerate(['1', '2', '1', '2', '3']):
+            install = join(self.dir, 'install-%i' % i)
+            shutil.copytree(self.sources[int(version) - 1], install)
+            installs.append((install, version))
+        futures = [self.patcher.update(install, version, '3', jobs=2) for install, version in installs]
+        for (install, version), future in zip(installs, futures):
+            plan = future.result(30)
+            self.assertEqual(plan is None, version == '3')
+            self.assertSame(install, self.sources[2])
+
+    def test_errors(self):
+        with open(join(self.dists[1], 'b'), 'w') as f:
+            f.write('corrupt\n')
+        future = self.patcher.update(self.sources[0], '1', '2')
+        self.assertRaises(VerificationError, future.result, 10)
+        assert isinstance(future.exception(), VerificationError)
+
+
+class TestHashCache(TestPatch):
+    def setUp(self):
+        TestPatch.setUp(self)
+        self.cache_file = join(self.dir, 'hashes')
+        self.pp.hash_cache = HashCache(self.cache_file)
+
+    def test_reuse(self):
+        client_manifest = self.pp.create_client_manifest('1', self.sources[0])
+        assert exists(self.cache_file)
+
+        # a cached hash is trusted while the file's stat is unchanged
+        cache = HashCache(self.cache_file)
+        name = join(self.sources[0], 'a')
+        st = os.stat(name)
+        cache.update(name, stat_fingerprint(st), 'cached', st.st_mode)
+        cache.save()
+        self.pp.hash_cache = HashCache(self.cache_file)
+        self.assertEqual(self.pp.create_client_manifest('1', self.sources[0])['files']['a']['hash'], 'cached')
+
+        # but not once the file changes
+        with open(name, 'a') as f:
+            f.write('more\n')
+        client_manifest = self.pp.create_client_manifest('1', self.sources[0])
+        self.assertEqual(client_manifest['files']['a']['hash'], hashlib.sha256('test\n' * 100 + 'more\n').hexdigest())
+
+    def test_patch_updates_cache(self):
+        client_manifest = self.pp.create_client_manifest('1', self.sources[0])
+        plan = self.pp.get_patch_plan(client_manifest, '2')
+        self.pp.patch(self.sources[0], plan)
+
+        cache = HashCache(self.cache_file)
+        name = join(self.sources[0], 'c')
+        cached = cache.lookup(name, stat_fingerprint(os.stat(name)))
+        self.assertEqual(cached[0], plan['manifest']['files']['c']['hash'])
+        assert cache.lookup(join(self.sources[0], 'd'), (0, 0, 0)) is None
+        self.assertEqual(self.pp.create_client_manifest('2', self.sources[0]),
+                         self.pp.create_client_manifest('2', self.sources[1]))
+
+
+class TestBlobStore(TestPatch):
+    def build(self, version, source, target, previous=None):
+        self.blobs = join(self.dir, 'dist-blobs')
+        self.pp.make_distribution(version, source, target, previous, blob_dir=self.blobs)
+
+    def test_plans(self):
+        client_manifest = self.pp.create_client_manifest('1', self.sources[0])
+        plan = self.pp.get_patch_plan(client_manifest, '3')
+        assert set(plan['download']) == set(['b', 'f'])
+        assert set(plan['delete']) == set(['d'])
+        for name, chain in plan['patch']:
+            if name == 'c':
+                assert [step['version'] for step in chain] == ['2', '3']
+            else:
+                assert [step['version'] for step in chain] == ['2']
+
+    def test_dedup(self):
+        # only the manifest and version are stored per version
+        self.assertEqual(sorted(os.listdir(self.dists[2])), ['manifest', 'version'])
+
+        # a and f have the same contents, and nothing is stored twice
+        manifest = self.pp.read_manifest(join(self.dists[2], 'manifest'))
+        self.assertEqual(manifest['files']['a']['blob'], manifest['files']['f']['blob'])
+        hashes = set()
+        for dist in self.dists:
+            for entry in self.pp.read_manifest(join(dist, 'manifest'))['files'].values():
+                hashes.add(entry['hash'])
+        blobs = [name for root, dirs, files in os.walk(self.blobs) for name in files]
+        self.assertEqual(len([name for name in blobs if not name.endswith('.patch')]), len(hashes))
+
+
+class TestDeltaBases(TestPatch):
+    def build(self, version, source, target, previous=None):
+        bases = choose_delta_bases(self.dists[:self.dists.index(target)][::-1], 2)
+        self.pp.make_distribution(version, source, target, previous, delta_bases=bases)
+
+    def test_plans(self):
+        # version 1 -> 3 in one step
+        client_manifest = self.pp.create_client_manifest('1', self.sources[0])
+        plan = self.pp.get_patch_plan(client_manifest, '3')
+        assert set(plan['download']) == set(['b', 'f'])
+        assert set(plan['delete']) == set(['d'])
+        chains = dict(plan['patch'])
+        self.assertEqual(len(chains['c']), 1)
+        self.assertEqual(chains['c'][0]['version'], '3')
+        self.assertEqual(chains['e'], ['2'])
+
+    def test_choose(self):
+        history = [str(i) for i in range(10, 0, -1)]
+        self.assertEqual(choose_delta_bases(history, 3), ['10', '9', '8'])
+        self.assertEqual(choose_delta_bases(history, 5, exponential=True), ['10', '9', '7', '3'])
+
+
+class TestBinaryManifest(TestPatch):
+    def build(self, version, source, target, previous=None):
+        self.pp.make_distribution(version, source, target, previous, manifest_format='binary')
+
+    def test_format(self):
+        # the binary manifest decodes to the same entries as the JSON one
+        json_dir = join(self.dir, 'dist-json')
+        mkdir(json_dir)
+        self.pp.make_distribution('2', self.sources[1], json_dir, self.dists[0])
+        binary = self.pp.read_manifest(join(self.dists[1], 'manifest'))
+        json = self.pp.read_manifest(join(json_dir, 'manifest'))
+        self.assertEqual(binary['version'], '2')
+        self.assertEqual(sorted(binary['files']), sorted(json['files']))
+        self.assertEqual(dict(binary['files'].items()), json['files'])
+        assert 'missing' not in binary['files']
+        assert binary['files'].get('missing') is None
+        self.assertRaises(KeyError, lambda: binary['files']['missing'])
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, self.pp.make_distribution, '1', self.sources[0], self.dists[0],
+                          manifest_format='xml')
+
+    def test_non_ascii(self):
+        self.check_non_ascii()
+
+
+class CountingReader(URLReader):
+    def __init__(self, *args, **kwargs):
+        URLReader.__init__(self, *args, **kwargs)
+        self.requests = []
+
+    def get(self, version, name):
+        self.requests.append((version, name))
+        return URLReader.get(self, version, name)
+
+
+class TestPackFiles(TestPatch):
+    def setUp(self):
+        TestPatch.setUp(self)
+        # file URLs read ranges with get
+        self.pp.reader = CountingReader('file://' + self.dir + '/dist-')
+
+    def build(self, version, source, target, previous=None):
+        self.pp.make_distribution(version, source, target, previous, pack_threshold=1 << 20)
+
+    def test_plans(self):
+        client_manifest = self.pp.create_client_manifest('1', self.sources[0])
+        plan = self.pp.get_patch_plan(client_manifest, '3')
+        assert set(plan['download']) == set(['b', 'f'])
+        assert set(plan['delete']) == set(['d'])
+        for name, chain in plan['patch']:
+            if name == 'c':
+                assert [step['version'] for step in chain] == ['2', '3']
+            else:
+                assert [step['version'] for step in chain] == ['2']
+            assert all(step['pack'][0] == 'pack-000' for step in chain)
+
+    def test_requests(self):
+        client_manifest = self.pp.create_client_manifest('1', self.sources[0])
+        plan = self.pp.get_patch_plan(client_manifest, '3')
+        del self.pp.reader.requests[:]
+        self.pp.patch(self.sources[0], plan)
+        # two new files and three deltas from two versions' packs
+        self.assertEqual(sorted(self.pp.reader.requests), [('2', 'pack-000'), ('3', 'pack-000')])
+
+    def test_unpacked(self):
+        # files over the threshold are fetched on their own
+        self.pp.make_distribution('4', self.sources[2], join(self.dir, 'dist-4'), self.dists[2], pack_threshold=0)
+        manifest = self.pp.read_manifest(join(self.dir, 'dist-4', 'manifest'))
+        assert not any('pack' in entry for entry in manifest['files'].values())
+        assert not exists(join(self.dir, 'dist-4', 'pack-000'))
+
+
+class TestShardedManifest(TestPatch):
+    def build(self, version, source, target, previous=None):
+        self.pp.make_distribution(version, source, target, previous, manifest_format='sharded')
+
+    def test_subtrees(self):
+        files = {'lib/x': 'x', 'lib/y': 'y', 'data/z': 'z', 'data/deep/w': 'w1', 'data/deep/v': 'v', 'top': 'top'}
+        for version in ('t1', 't2'):
+            if version == 't2':
+                files['data/deep/w'] = 'w2'
+                del files['data/deep/v']
+            source = join(self.dir, 'tree-' + version)
+            for name, contents in files.items():
+                if not exists(join(source, os.path.dirname(name))):
+                    os.makedirs(join(source, os.path.dirname(name)))
+                with open(join(source, name), 'w') as f:
+                    f.write(contents)
+            mkdir(join(self.dir, 'dist-' + version))
+            self.build(version, source, join(self.dir, 'dist-' + version))
+
+        # the whole manifest reads back the same as an unsharded one
+        manifest = self.pp.read_manifest(join(self.dir, 'dist-t2', 'manifest'))
+        self.assertEqual(sorted(manifest['files']), sorted(files))
+        self.assertEqual(manifest['files']['data/deep/w']['hash'], hashlib.sha256('w2').hexdigest())
+        assert 'lib/missing/x' not in manifest['files']
+
+        # only the root, data and data/deep shards are read
+        reader = CountingReader('file://' + self.dir + '/dist-')
+        pp = PixiePatch(compressor=self.compressor(), differ=self.differ(), reader=reader)
+        client_manifest = pp.create_client_manifest('t1', join(self.dir, 'tree-t1'))
+        plan = pp.get_patch_plan(client_manifest, 't2')
+        self.assertEqual(plan['download'], ['data/deep/w'])
+        self.assertEqual(plan['delete'], ['data/deep/v'])
+        shards = [name for version, name in reader.requests if name.startswith('manifest.d/')]
+        self.assertEqual(len(shards), 3)
+
+        pp.patch(join(self.dir, 'tree-t1'), plan)
+        self.assertEqual(pp.create_client_manifest('t2', join(self.dir, 'tree-t1')),
+                         pp.create_client_manifest('t2', join(self.dir, 'tree-t2')))
+
+    def test_missing_shard(self):
+        # without version 2's shards, c cannot be patched through it
+        shutil.rmtree(join(self.dists[1], 'manifest.d'))
+        client_manifest = self.pp.create_client_manifest('1', self.sources[0])
+        plan = self.pp.get_patch_plan(client_manifest, '3')
+        assert 'c' in plan['download']
+        self.pp.patch(self.sources[0], plan)
+        diff = Popen(['diff', '-ru', self.sources[0], self.sources[2]], stdout=PIPE).communicate()[0]
+        self.assertEqual(diff, '')
+
+    def test_non_ascii(self):
+        self.check_non_ascii()
+        hash = hashlib.sha256('').hexdigest()
+        # clients hash byte string names, which must match the unicode ones
+        self.assertEqual(tree_hashes({'d\xc3\xaer/caf\xc3\xa9': hash})[''],
+                         tree_hashes({u'd\xeer/caf\xe9': unicode(hash)})[''])
+
+
+class TestManifestCache(TestPatch):
+    def setUp(self):
+        TestPatch.setUp(self)
+        self.reader = CountingReader('file://' + self.dir + '/dist-')
+        self.cache = ManifestCache(join(self.dir, 'manifests'))
+        self.pp = PixiePatch(compressor=self.compressor(), differ=self.differ(), reader=self.reader,
+                             manifest_cache=self.cache)
+        self.pp.register_ignore_pattern('^ignore$')
+
+    def test_history(self):
+        manifest = self.pp.read_manifest(join(self.dists[2], 'manifest'))
+        self.assertEqual(manifest['history'], ['2', '1'])
+        assert 'history' not in self.pp.read_manifest(join(self.dists[0], 'manifest'))
+
+    def test_cache(self):
+        client_manifest = self.pp.create_client_manifest('1', self.sources[0])
+        plan = self.pp.get_patch_plan(client_manifest, '3')
+        self.assertEqual(sorted(name for version, name in self.reader.requests), ['manifest', 'manifest'])
+
+        # the second plan is made without reading any manifests
+        del self.reader.requests[:]
+        self.assertEqual(self.pp.get_patch_plan(client_manifest, '3')['patch'], plan['patch'])
+        self.assertEqual(self.reader.requests, [])
+
+    def test_evict(self):
+        cache = ManifestCache(join(self.dir, 'small'), max_bytes=25)
+        cache.put('1', '1' * 10)
+        cache.put('2', '2' * 10)
+        os.utime(cache.filename('1'), (0, 0))
+        os.utime(cache.filename('2'), (1, 1))
+        self.assertEqual(cache.get('1'), '1' * 10)
+        cache.put('3', '3' * 10)
+        self.assertEqual(cache.get('2'), None)
+        self.assertEqual(cache.get('1'), '1' * 10)
+        self.assertEqual(cache.get('3'), '3' * 10)
+
+
+class TestChunked(Base):
+    def setUp(self):
+        Base.setUp(self)
+        self.blobs = join(self.dir, 'dist-blobs')
+        self.reader = CountingReader('file://' + self.dir + '/dist-')
+        chunker = Chunker(min_size=64, avg_size=256, max_size=1024, min_file_size=1000)
+        self.pp = PixiePatch(compressor=BZ2Compressor(), reader=self.reader, chunker=chunker)
+
+        rand = random.Random(1)
+        data = ''.join(chr(rand.randrange(256)) for i in range(50000))
+        versions = [data, data[:20000] + 'inserted' + data[20000:], data[:20000] + 'inserted' + data[20000:40000] + data[41000:]]
+        for source, contents in zip(self.sources, versions):
+            with open(join(source, 'big'), 'wb') as f:
+                f.write(contents)
+            with open(join(source, 'small'), 'wb') as f:
+                f.write(contents[:100])
+
+        self.pp.make_distribution('1', self.sources[0], self.dists[0], blob_dir=self.blobs)
+        self.pp.make_distribution('2', self.sources[1], self.dists[1], self.dists[0], blob_dir=self.blobs)
+        self.pp.make_distribution('3', self.sources[2], self.dists[2], self.dists[1], blob_dir=self.blobs)
+
+    def test_manifest(self):
+        manifest = self.pp.read_manifest(join(self.dists[0], 'manifest.bz2'))
+        assert 'chunks' in manifest['files']['big']
+        assert 'chunks' not in manifest['files']['small']
+        self.assertEqual(sum(chunk[1] for chunk in manifest['files']['big']['chunks']), 50000)
+
+    def test_patch(self):
+        for old, new in [(0, 1), (1, 2), (0, 2)]:
+            directory = join(self.dir, 'client-%i-%i' % (old, new))
+            shutil.copytree(self.sources[old], directory)
+            client_manifest = self.pp.create_client_manifest(str(old + 1), directory)
+            plan = self.pp.get_patch_plan(client_manifest, str(new + 1))
+            self.assertEqual(plan['chunked'], ['big'])
+            chunks = len(plan['manifest']['files']['big']['chunks'])
+
+            del self.reader.requests[:]
+            self.pp.patch(directory, plan)
+            with open(join(directory, 'big'), 'rb') as f:
+                with open(join(self.sources[new], 'big'), 'rb') as g:
+                    assert f.read() == g.read()
+            # the unchanged chunks came from the old file
+            assert len(self.reader.requests) < chunks / 4
+
+    def test_cached_chunks(self):
+        metrics = RecordingMetrics()
+        self.pp.metrics = metrics
+        self.pp.hash_cache = HashCache(join(self.dir, 'hashes'))
+        manifest = self.pp.create_client_manifest('1', self.sources[0])
+        self.assertEqual(metrics.phases['chunk'][0], 1)
+        # the chunks are kept with the hash, so the file is not read again
+        self.assertEqual(self.pp.create_client_manifest('1', self.sources[0]), manifest)
+        self.assertEqual(metrics.phases['chunk'][0], 1)
+        self.assertEqual(metrics.counters['hash.cached'], 2)
+        # unless the chunker changes
+        self.pp.chunker = Chunker(min_size=64, avg_size=512, max_size=1024, min_file_size=1000)
+        assert self.pp.create_client_manifest('1', self.sources[0]) != manifest
+        self.assertEqual(metrics.phases['chunk'][0], 2)
+
+    def test_repeated_chunks(self):
+        # chunks which are downloaded once are read back from the new file
+        rand = random.Random(2)
+        block = ''.join(chr(rand.randrange(256)) for i in range(20000))
+        source = join(self.dir, 'source-4')
+        mkdir(source)
+        mkdir(join(self.dir, 'dist-4'))
+        with open(join(source, 'big'), 'wb') as f:
+            f.write(block * 4)
+        self.pp.make_distribution('4', source, join(self.dir, 'dist-4'), self.dists[2], blob_dir=self.blobs)
+        client_manifest = self.pp.create_client_manifest('3', self.sources[2])
+        plan = self.pp.get_patch_plan(client_manifest, '4')
+        del self.reader.requests[:]
+        self.pp.patch(self.sources[2], plan)
+        with open(join(self.sources[2], 'big'), 'rb') as f:
+            assert f.read() == block * 4
+        chunks = [chunk[0] for chunk in plan['manifest']['files']['big']['chunks']]
+        assert len(set(chunks)) < len(chunks)
+        self.assertEqual(len(self.reader.requests), len(set(chunks)))
+
+    def test_new_client(self):
+        directory = join(self.dir, 'client')
+        mkdir(directory)
+        plan = self.pp.get_patch_plan({'version': '0', 'files': {}}, '3')
+        self.pp.patch(directory, plan)
+        self.assertEqual(self.pp.create_client_manifest('3', directory), self.pp.create_client_manifest('3', self.sources[2]))
+
+
 class TestZipPatch(Base):
     def setUp(self):
         Base.setUp(self)
@@ -203,6 +756,33 @@ class TestZipPatch(Base):
                 entries.add((name, info.CRC))
         return entries
 
+    def test_many_members(self):
+        # batched members wait in closed files, so changing more members than
+        # there are file descriptors still works
+        if resource is None or not exists('/proc/self/fd'):
+            return
+        members = 300
+        for version in ('m1', 'm2'):
+            source = join(self.dir, 'source-' + version)
+            mkdir(source)
+            mkdir(join(self.dir, 'dist-' + version))
+            with ZipFile(join(source, 'many.zip'), 'w') as f:
+                for i in range(members):
+                    f.writestr('member-%i' % i, '%s %i\n' % (version, i) * 20)
+        self.pp.make_distribution('m1', join(self.dir, 'source-m1'), join(self.dir, 'dist-m1'))
+        self.pp.make_distribution('m2', join(self.dir, 'source-m2'), join(self.dir, 'dist-m2'), join(self.dir, 'dist-m1'))
+        client_manifest = self.pp.create_client_manifest('m1', join(self.dir, 'source-m1'))
+        plan = self.pp.get_patch_plan(client_manifest, 'm2')
+
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (len(os.listdir('/proc/self/fd')) + members // 3, hard))
+        try:
+            self.pp.patch(join(self.dir, 'source-m1'), plan)
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        self.assertEqual(self.read_zip(join(self.dir, 'source-m1', 'many.zip')),
+                         self.read_zip(join(self.dir, 'source-m2', 'many.zip')))
+
     def test_plans(self):
         # version 1 -> 2
         client_manifest = self.pp.create_client_manifest('1', self.sources[0])
@@ -255,3 +835,167 @@ class TestZipPatch(Base):
         patched = self.read_zip(join(self.sources[0], 'a.zip'))
         target = self.read_zip(join(self.sources[2], 'a.zip'))
         self.assertEqual(patched, target)
+
+    def test_parallel(self):
+        client_manifest = self.pp.create_client_manifest('1', self.sources[0])
+        plan = self.pp.get_patch_plan(client_manifest, '3')
+        self.pp.patch(self.sources[0], plan, jobs=4)
+        patched = self.read_zip(join(self.sources[0], 'a.zip'))
+        target = self.read_zip(join(self.sources[2], 'a.zip'))
+        self.assertEqual(patched, target)
+
+    def test_batched(self):
+        # all the changes to an archive are applied at once
+        updates = []
+        handler = ZIPHandler()
+        update = handler.update
+        def counting_update(archive, changes, modes=None):
+            updates.append(sorted(changes))
+            update(archive, changes, modes)
+        handler.update = counting_update
+        self.pp.register_archive_handler('.zip', handler)
+
+        client_manifest = self.pp.create_client_manifest('1', self.sources[0])
+        plan = self.pp.get_patch_plan(client_manifest, '3')
+        self.pp.patch(self.sources[0], plan, jobs=2)
+        self.assertEqual(updates, [['b', 'c', 'd', 'e', 'f']])
+        patched = self.read_zip(join(self.sources[0], 'a.zip'))
+        target = self.read_zip(join(self.sources[2], 'a.zip'))
+        self.assertEqual(patched, target)
+
+    def test_update(self):
+        archive = join(self.dir, 'deflated.zip')
+        with ZipFile(archive, 'w', ZIP_DEFLATED) as f:
+            f.writestr('keep', 'keep\n' * 100)
+            info = ZipInfo('replace')
+            info.external_attr = 0644 << 16
+            info.compress_type = ZIP_DEFLATED
+            f.writestr(info, 'old\n' * 100)
+            f.writestr('gone', 'gone\n' * 100)
+        with ZipFile(archive, 'r') as f:
+            kept = f.getinfo('keep')
+
+        ZIPHandler().update(archive, {'replace': BytesIO('new\n' * 100), 'gone': None, 'added': BytesIO('added')})
+        with ZipFile(archive, 'r') as f:
+            self.assertEqual(f.testzip(), None)
+            self.assertEqual(f.namelist(), ['keep', 'replace', 'added'])
+            info = f.getinfo('keep')
+            self.assertEqual((info.compress_type, info.compress_size, info.CRC, info.date_time),
+                             (kept.compress_type, kept.compress_size, kept.CRC, kept.date_time))
+            info = f.getinfo('replace')
+            self.assertEqual((info.compress_type, info.external_attr), (ZIP_DEFLATED, 0644 << 16))
+            self.assertEqual(f.read('replace'), 'new\n' * 100)
+            self.assertEqual(f.read('added'), 'added')
+
+    def test_hash_cache(self):
+        # unchanged members are not decompressed on later scans
+        self.pp.hash_cache = HashCache(join(self.dir, 'hashes'))
+        first = self.pp.create_client_manifest('1', self.sources[0])
+        opened = []
+        open_member = ZIPMember.open
+        def counting_open(member):
+            opened.append(member.name)
+            return open_member(member)
+        ZIPMember.open = counting_open
+        try:
+            self.assertEqual(self.pp.create_client_manifest('1', self.sources[0]), first)
+            self.assertEqual(opened, [])
+
+            # a changed member is hashed again
+            ZIPHandler().set(join(self.sources[0], 'a.zip'), 'b', 'changed\n')
+            manifest = self.pp.create_client_manifest('1', self.sources[0])
+            self.assertEqual(opened, ['b'])
+            self.assertEqual(manifest['files']['a.zip/b']['hash'], hashlib.sha256('changed\n').hexdigest())
+        finally:
+            ZIPMember.open = open_member
+
+
+class TestTarPatch(Base):
+    extension = '.tar'
+
+    def setUp(self):
+        Base.setUp(self)
+        self.handler = TARHandler()
+        self.pp = PixiePatch(differ=TextDiffer(), reader=URLReader('file://' + self.dir + '/dist-'))
+        self.pp.register_archive_handler(self.extension, self.handler)
+        self.archive = 'a' + self.extension
+
+        versions = [
+            {'a': 'test\n' * 100, 'b': 'v1\n' * 100, 'c': ''.join(['test %i\n' % i for i in range(100)]) + 'v1\n',
+             'd': 'test\n' * 100},
+            {'a': 'test\n' * 100, 'b': 'v2\n' * 100, 'c': ''.join(['test %i\n' % i for i in range(100)]) + 'v2\n',
+             'f': 'test\n' * 100},
+            {'a': 'test\n' * 100, 'b': 'v2\n' * 100, 'c': ''.join(['test %i\n' % i for i in range(100)]) + 'v3\n',
+             'f': 'test\n' * 100},
+        ]
+        for source, members in zip(self.sources, versions):
+            with tarfile.open(join(source, self.archive), 'w:' + compression(self.archive)) as tar:
+                for name, contents in sorted(members.items()):
+                    info = tarfile.TarInfo(name)
+                    info.size = len(contents)
+                    info.mode = 0755 if name == 'f' else 0644
+                    tar.addfile(info, BytesIO(contents))
+
+        self.pp.make_distribution('1', self.sources[0], self.dists[0])
+        self.pp.make_distribution('2', self.sources[1], self.dists[1], self.dists[0])
+        self.pp.make_distribution('3', self.sources[2], self.dists[2], self.dists[1])
+
+    def read_tar(self, archive):
+        with tarfile.open(archive, 'r:' + compression(archive)) as tar:
+            return set((info.name, info.mode, tar.extractfile(info).read()) for info in tar)
+
+    def test_plans(self):
+        client_manifest = self.pp.create_client_manifest('1', self.sources[0])
+        plan = self.pp.get_patch_plan(client_manifest, '3')
+        self.assertEqual(set(plan['download']), set([self.archive + '/b', self.archive + '/f']))
+        self.assertEqual(plan['delete'], [self.archive + '/d'])
+        self.assertEqual(plan['patch'], [(self.archive + '/c', ['2', '3'])])
+
+    def test_patch_1_to_3(self):
+        client_manifest = self.pp.create_client_manifest('1', self.sources[0])
+        plan = self.pp.get_patch_plan(client_manifest, '3')
+        self.pp.patch(self.sources[0], plan, jobs=2)
+        self.assertEqual(self.read_tar(join(self.sources[0], self.archive)),
+                         self.read_tar(join(self.sources[2], self.archive)))
+
+    def test_index(self):
+        archive = join(self.sources[0], self.archive)
+        index = self.handler.index(archive)
+        self.assertEqual(self.handler.get(archive, 'b'), 'v1\n' * 100)
+        assert self.handler.index(archive) is index
+        self.assertRaises(KeyError, self.handler.get, archive, 'missing')
+
+        # changing the archive rebuilds the index
+        self.handler.set(archive, 'b', 'changed\n')
+        assert self.handler.index(archive) is not index
+        self.assertEqual(self.handler.get(archive, 'b'), 'changed\n')
+        self.handler.delete(archive, 'b')
+        self.assertEqual(sorted(self.handler.index(archive)), ['a', 'c', 'd'])
+
+
+class TestTarGzPatch(TestTarPatch):
+    extension = '.tar.gz'
+
+    def test_walk(self):
+        archive = join(self.sources[0], self.archive)
+        self.handler.indexes.clear()
+        tarhandler.SPOOL_SIZE, spool_size = 100, tarhandler.SPOOL_SIZE
+        try:
+            members = dict((name, source) for name, source, mode in self.handler.walk(archive))
+        finally:
+            tarhandler.SPOOL_SIZE = spool_size
+        # the walk indexes the archive, and members over SPOOL_SIZE can be
+        # read again and again, in other processes too
+        self.assertEqual(sorted(self.handler.indexes[archive][1]), ['a', 'b', 'c', 'd'])
+        source = members['c']
+        assert isinstance(source, tarhandler.SpooledMember)
+        with source.open() as f, source.open() as g:
+            self.assertEqual(f.read(10) + f.read(), g.read())
+        copy = pickle.loads(pickle.dumps(source, 2))
+        with copy.open() as f:
+            self.assertEqual(f.read(), self.handler.get(archive, 'c'))
+
+    def test_parallel_build(self):
+        self.pp.make_distribution('3', self.sources[2], join(self.dir, 'parallel'), self.dists[1], jobs=2)
+        self.assertEqual(self.pp.read_manifest(join(self.dir, 'parallel', 'manifest'))['files'],
+                         self.pp.read_manifest(join(self.dists[2], 'manifest'))['files'])
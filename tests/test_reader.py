@@ -0,0 +1,231 @@
+import os
+import threading
+import tempfile
+import shutil
+import hashlib
+import re
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from nose.tools import *
+
+from pixiepatch.reader import Reader, URLReader
+from pixiepatch.metrics import RecordingMetrics
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send each response in one piece
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        failures = self.server.failures.get(self.path, 0)
+        if failures:
+            self.server.failures[self.path] = failures - 1
+            self.reply(503, 'unavailable')
+        elif self.path in self.server.files:
+            body = self.server.files[self.path]
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+            spans = re.findall(r'(\d+)-(\d+)', self.headers.get('Range', ''))
+            if len(spans) > 1:
+                self.server.ranges.append([int(start) for start, end in spans])
+            else:
+                self.server.ranges.append(match and int(match.group(1)))
+            if spans and self.server.partial and (len(spans) == 1 or not self.server.multipart):
+                # some servers only send the first range
+                start, end = int(spans[0][0]), int(spans[0][1]) + 1
+                self.reply(206, body[start:end], etag, 'bytes %i-%i/%i' % (start, end - 1, len(body)))
+            elif spans and self.server.partial:
+                parts = []
+                for start, end in spans:
+                    start, end = int(start), int(end) + 1
+                    parts.append('--BOUNDARY\r\nContent-Type: application/octet-stream\r\n'
+                                 'Content-Range: bytes %i-%i/%i\r\n\r\n%s\r\n' % (start, end - 1, len(body), body[start:end]))
+                self.reply(206, ''.join(parts) + '--BOUNDARY--\r\n', etag,
+                           content_type='multipart/byteranges; boundary=BOUNDARY')
+            elif match and not match.group(2) and self.headers.get('If-Range') == etag:
+                start = int(match.group(1))
+                self.reply(206, body[start:], etag, 'bytes %i-%i/%i' % (start, len(body) - 1, len(body)))
+            else:
+                self.reply(200, body, etag)
+        else:
+            self.reply(404, 'not found')
+
+    def reply(self, status, body, etag=None, content_range=None, content_type=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        if etag:
+            self.send_header('ETag', etag)
+        if content_range:
+            self.send_header('Content-Range', content_range)
+        self.end_headers()
+        # drop the connection part way through if asked to
+        drop = self.server.drops.pop(self.path, None)
+        if drop is not None:
+            self.wfile.write(body[:drop])
+            self.close_connection = 1
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestURLReader(object):
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.connections = 0
+        self.server.requests = []
+        self.server.failures = {}
+        self.server.drops = {}
+        self.server.ranges = []
+        self.server.partial = True
+        self.server.multipart = True
+        self.server.files = {'/1/a': 'a' * 1000, '/1/b': 'b' * 1000, '/2/a': 'A' * 1000}
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.reader = URLReader('http://127.0.0.1:%i/' % self.server.server_address[1], backoff=0.01)
+
+    def tearDown(self):
+        self.reader.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        for i in range(5):
+            assert_equal(self.reader.get('1', 'a'), 'a' * 1000)
+            assert_equal(self.reader.get('1', 'b'), 'b' * 1000)
+            assert_equal(self.reader.get('2', 'a'), 'A' * 1000)
+        assert_equal(self.server.connections, 1)
+
+    def test_open(self):
+        with self.reader.open('1', 'a') as f:
+            assert_equal(f.read(10), 'a' * 10)
+            assert_equal(f.read(), 'a' * 990)
+        assert_raises(IOError, self.reader.open, '1', 'missing')
+
+    def test_default_open(self):
+        class StringReader(Reader):
+            def get(self, version, name):
+                return version + name
+        assert_equal(StringReader().open('1', 'a').read(), '1a')
+
+    def test_missing(self):
+        assert_raises(IOError, self.reader.get, '1', 'missing')
+        # the connection is still usable after an error
+        assert_equal(self.reader.get('1', 'a'), 'a' * 1000)
+        assert_equal(self.server.connections, 1)
+
+    def test_retry(self):
+        self.server.failures['/1/a'] = 2
+        assert_equal(self.reader.get('1', 'a'), 'a' * 1000)
+        assert_equal(self.server.requests, ['/1/a'] * 3)
+
+        self.server.failures['/1/a'] = 4
+        assert_raises(IOError, self.reader.get, '1', 'a')
+
+    def test_metrics(self):
+        metrics = RecordingMetrics()
+        reader = URLReader('http://127.0.0.1:%i/' % self.server.server_address[1], backoff=0.01, metrics=metrics)
+        self.server.failures['/1/a'] = 1
+        assert_equal(reader.get('1', 'a'), 'a' * 1000)
+        assert_equal(reader.get('1', 'b'), 'b' * 1000)
+        counters = metrics.summary()['counters']
+        assert_equal(counters['http.requests'], 3)
+        assert_equal(counters['http.retries'], 1)
+        assert_equal(counters['reader.bytes'], 2000)
+        assert_equal([name for when, name, fields in metrics.events], ['http.retry'])
+        reader.pool.close()
+
+    def test_get_range(self):
+        self.server.files['/1/pack'] = ''.join(chr(i % 256) for i in range(300000))
+        ranges = [(10, 5), (20, 0), (100, 100), (5000, 20), (250000, 10), (0, 3)]
+        expected = [self.server.files['/1/pack'][offset:offset + size] for offset, size in ranges]
+        assert_equal(self.reader.get_range('1', 'pack', ranges), expected)
+        # nearby ranges are fetched as one, and all of them in one request
+        assert_equal(self.server.ranges, [[0, 5000, 250000]])
+
+        # servers which send one range at a time are asked again
+        del self.server.ranges[:]
+        self.server.multipart = False
+        assert_equal(self.reader.get_range('1', 'pack', ranges), expected)
+        assert_equal(self.server.ranges, [[0, 5000, 250000], [5000, 250000], 250000])
+
+        # servers which ignore ranges send the whole file
+        self.server.partial = False
+        assert_equal(self.reader.get_range('1', 'pack', ranges), expected)
+        assert_equal(Reader.get_range(self.reader, '1', 'pack', ranges), expected)
+
+    def test_progress(self):
+        reported = []
+        reader = URLReader('http://127.0.0.1:%i/' % self.server.server_address[1],
+                           chunk_size=300, report_callback=reported.append)
+        assert_equal(reader.get('1', 'a'), 'a' * 1000)
+        assert_equal(reported, [300, 300, 300, 100])
+        reader.pool.close()
+
+    def test_threads(self):
+        results = []
+        def fetch():
+            for i in range(10):
+                results.append(self.reader.get('1', 'a'))
+        threads = [threading.Thread(target=fetch) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal(results, ['a' * 1000] * 80)
+        assert self.server.connections <= 4
+
+
+class TestResume(TestURLReader):
+    def setUp(self):
+        TestURLReader.setUp(self)
+        self.partial_dir = tempfile.mkdtemp()
+        self.reader = URLReader('http://127.0.0.1:%i/' % self.server.server_address[1], backoff=0.01,
+                                partial_dir=self.partial_dir)
+
+    def tearDown(self):
+        TestURLReader.tearDown(self)
+        shutil.rmtree(self.partial_dir)
+
+    def test_resume(self):
+        # a dropped download continues from where it stopped
+        self.server.drops['/1/a'] = 600
+        assert_equal(self.reader.get('1', 'a'), 'a' * 1000)
+        assert_equal(self.server.ranges, [None, 600])
+        assert_equal(os.listdir(self.partial_dir), [])
+
+    def test_later(self):
+        # a failed download is kept for the next attempt
+        reader = URLReader('http://127.0.0.1:%i/' % self.server.server_address[1], retries=0,
+                           partial_dir=self.partial_dir)
+        self.server.drops['/1/b'] = 300
+        assert_raises(IOError, reader.get, '1', 'b')
+        assert_equal(reader.get('1', 'b'), 'b' * 1000)
+        assert_equal(self.server.ranges, [None, 300])
+        reader.pool.close()
+
+    def test_changed(self):
+        # the partial file is discarded if the file changed on the server
+        reader = URLReader('http://127.0.0.1:%i/' % self.server.server_address[1], retries=0,
+                           partial_dir=self.partial_dir)
+        self.server.drops['/1/b'] = 300
+        assert_raises(IOError, reader.get, '1', 'b')
+        self.server.files['/1/b'] = 'B' * 1000
+        assert_equal(reader.get('1', 'b'), 'B' * 1000)
+        assert_equal(self.server.ranges, [None, 300])
+        reader.pool.close()
@@ -0,0 +1,118 @@
+import os
+from os.path import join
+import re
+import tempfile
+import shutil
+
+from nose.tools import *
+
+from pixiepatch import scanner
+from pixiepatch.scanner import IgnoreMatcher, HandlerIndex, scan
+
+
+class TestIgnoreMatcher(object):
+    def test_combined(self):
+        matcher = IgnoreMatcher([re.compile(r'^build'), re.compile(r'.*\.pyc$')])
+        assert_equal(len(matcher.combined), 1)
+        assert matcher.match('build/x')
+        assert matcher.match(join('src', 'x.pyc'))
+        assert not matcher.match(join('src', 'x.py'))
+
+    def test_separate(self):
+        # backreferences and differing flags stop patterns being combined
+        matcher = IgnoreMatcher([re.compile(r'^(a)\1'), re.compile(r'^b')])
+        assert_equal(len(matcher.combined), 2)
+        assert matcher.match('aa')
+        assert not matcher.match('ab')
+        matcher = IgnoreMatcher([re.compile(r'^a', re.I), re.compile(r'^b')])
+        assert_equal(len(matcher.combined), 2)
+        assert matcher.match('A')
+        assert not matcher.match('B')
+
+    def test_prunes(self):
+        matcher = IgnoreMatcher([re.compile(r'^build'), re.compile(r'^cache$'), re.compile(r'.*\.o$'),
+                                 re.compile(r'^tmp' + re.escape(os.sep) + '(?!keep)')])
+        assert matcher.prunes('build')
+        assert matcher.prunes(join('build', 'sub'))
+        assert not matcher.prunes('cache')
+        assert not matcher.prunes('src')
+        assert not matcher.prunes('x.o')
+        assert not matcher.prunes('tmp')
+
+
+class TestHandlerIndex(object):
+    def test_longest(self):
+        index = HandlerIndex({'.gz': 'gz', '.tar.gz': 'tar.gz', '.zip': 'zip'})
+        assert_equal(index.find('a.tar.gz'), 'tar.gz')
+        assert_equal(index.find('a.gz'), 'gz')
+        assert_equal(index.find('a.zip'), 'zip')
+        assert_equal(index.find('a.txt'), None)
+        assert_equal(HandlerIndex({}).find('a.zip'), None)
+
+
+class TestScan(object):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for name in ['a', join('src', 'b'), join('src', 'deep', 'c'), join('build', 'd'), join('build', 'sub', 'e')]:
+            if not os.path.exists(os.path.dirname(join(self.dir, name))):
+                os.makedirs(os.path.dirname(join(self.dir, name)))
+            with open(join(self.dir, name), 'w') as f:
+                f.write(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def scan(self, patterns):
+        listed = []
+        entries = scanner.entries
+        def recording_entries(directory):
+            listed.append(os.path.relpath(directory, self.dir))
+            return entries(directory)
+        scanner.entries = recording_entries
+        try:
+            files = dict((name, source.open().read()) for name, source, mode in
+                         scan(self.dir, HandlerIndex({}), IgnoreMatcher([re.compile(p) for p in patterns])))
+        finally:
+            scanner.entries = entries
+        return files, listed
+
+    def test_scan(self):
+        files, listed = self.scan([])
+        assert_equal(sorted(files), sorted(['a', join('src', 'b'), join('src', 'deep', 'c'), join('build', 'd'),
+                                            join('build', 'sub', 'e')]))
+        assert_equal(files['a'], 'a')
+
+    def test_pruned(self):
+        files, listed = self.scan(['^build'])
+        assert_equal(sorted(files), sorted(['a', join('src', 'b'), join('src', 'deep', 'c')]))
+        assert 'build' not in listed
+
+        # a pattern which may not match everything in the directory
+        files, listed = self.scan([r'^build.*d$'])
+        assert_equal(sorted(files), sorted(['a', join('src', 'b'), join('src', 'deep', 'c'), join('build', 'sub', 'e')]))
+        assert 'build' in listed
+
+    def test_listdir(self):
+        scandir = scanner.scandir
+        scanner.scandir = None
+        try:
+            assert_equal(self.scan(['^src']), self.scan(['^src']))
+            files, listed = self.scan(['^src'])
+        finally:
+            scanner.scandir = scandir
+        assert_equal(sorted(files), sorted(['a', join('build', 'd'), join('build', 'sub', 'e')]))
+
+    def test_symlinks(self):
+        if not hasattr(os, 'symlink'):
+            return
+        os.symlink(join(self.dir, 'src'), join(self.dir, 'linked'))
+        os.symlink(join(self.dir, 'a'), join(self.dir, 'link'))
+        for scandir in (scanner.scandir, None):
+            scanner.scandir, old_scandir = scandir, scanner.scandir
+            try:
+                files, listed = self.scan([])
+            finally:
+                scanner.scandir = old_scandir
+            # links to directories are neither followed nor read as files
+            assert 'linked' not in files and 'linked' not in listed
+            assert_equal(files['link'], 'a')
@@ -1,46 +1,187 @@
 import os
 import tempfile
 import shutil
-from zipfile import ZipFile
+import struct
+import copy
+import zipfile
+from zipfile import ZipFile, ZIP_STORED
+from io import BytesIO
 from pixiepatch import netpath
+from compressor import CHUNK_SIZE
 
 
 class ZIPHandler(object):
     def walk(self, archive):
         with ZipFile(archive, 'r') as zip:
-            for name in zip.namelist():
-                if not name.endswith('/'):
-                    contents = zip.read(name)
-                    yield name, contents, None
+            for info in zip.infolist():
+                if not info.filename.endswith('/'):
+                    yield info.filename, ZIPMember(archive, info.filename, zip, info.file_size, member_fingerprint(info)), None
 
     def get(self, archive, name):
         with ZipFile(archive, 'r') as zip:
             return zip.read(netpath(name))
 
+    def open(self, archive, name):
+        '''Returns a file object which decompresses a member as it is read.'''
+        return ZIPMember(archive, netpath(name)).open()
+
     def set(self, archive, name, contents, mode=None):
+        self.update(archive, {name: BytesIO(str(contents))})
+
+    def set_file(self, archive, name, f, mode=None):
+        '''Like set, but streams the contents from a file object.'''
+        self.update(archive, {name: f})
+
+    def delete(self, archive, name):
+        self.update(archive, {name: None})
+
+    def update(self, archive, changes, modes=None):
+        '''Applies several changes to an archive in one rewrite.
+
+        changes maps member names to file objects with their new contents, or
+        to None to delete them. Zip members have no modes, so modes is
+        ignored. Other members are copied as they are, without
+        being decompressed, and replaced members keep their compression and
+        attributes.'''
+        changes = dict((netpath(name), f) for name, f in changes.items())
         d = os.path.dirname(archive)
         if d and not os.path.exists(d):
             os.makedirs(d)
 
-        if os.path.exists(archive):
-            with ZipFile(archive, 'r') as zip:
-                delete = netpath(name) in zip.namelist()
-            if delete:
-                self.delete(archive, name)
+        fd, tmp = tempfile.mkstemp(dir=d or None)
+        os.close(fd)
+        try:
+            with ZipFile(tmp, 'w', allowZip64=True) as new_zip:
+                if os.path.exists(archive):
+                    with ZipFile(archive, 'r') as old_zip:
+                        for info in old_zip.infolist():
+                            if info.filename not in changes:
+                                copy_member(old_zip, new_zip, info)
+                            elif changes[info.filename] is not None:
+                                write_member(new_zip, info.filename, changes.pop(info.filename), info)
+                for name, f in sorted(changes.items()):
+                    if f is not None:
+                        write_member(new_zip, name, f)
+            if os.name == 'nt' and os.path.exists(archive):
+                os.unlink(archive)
+            os.rename(tmp, archive)
+        except:
+            os.unlink(tmp)
+            raise
+
 
-        with ZipFile(archive, 'a') as zip:
-            zip.writestr(netpath(name), str(contents))
+def member_fingerprint(info):
+    '''Returns the hash cache fingerprint of a member from the central
+    directory, so unchanged members are never decompressed.'''
+    return (info.CRC, info.compress_size, info.file_size) + tuple(info.date_time)
 
-    def delete(self, archive, name):
-        name = netpath(name)
-        fd, tmp = tempfile.mkstemp()
+
+def copy_member(old_zip, new_zip, info):
+    '''Copies a member's compressed data from one archive to another.'''
+    fp = old_zip.fp
+    fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, fp.read(zipfile.sizeFileHeader))
+    fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+
+    new_info = copy.copy(info)
+    # the sizes go in the new header rather than a trailing data descriptor,
+    # and the ZIP64 fields are added again when needed
+    new_info.flag_bits &= ~0x08
+    new_info.extra = strip_zip64(info.extra)
+    new_info.header_offset = new_zip.fp.tell()
+    new_zip.fp.write(new_info.FileHeader())
+    remaining = info.compress_size
+    while remaining:
+        data = fp.read(min(remaining, CHUNK_SIZE))
+        if not data:
+            raise zipfile.BadZipfile('truncated member %s' % info.filename)
+        new_zip.fp.write(data)
+        remaining -= len(data)
+    new_zip.filelist.append(new_info)
+    new_zip.NameToInfo[new_info.filename] = new_info
+    new_zip._didModify = True
+
+
+def write_member(zip, name, f, old_info=None):
+    '''Adds a member from a file object, keeping the compression and
+    attributes of the member it replaces.'''
+    fd, tmp = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            shutil.copyfileobj(f, out, CHUNK_SIZE)
+        if old_info is None:
+            zip.write(tmp, name, ZIP_STORED)
+        else:
+            zip.write(tmp, name, old_info.compress_type)
+            info = zip.filelist[-1]
+            info.external_attr = old_info.external_attr
+            info.create_system = old_info.create_system
+            info.comment = old_info.comment
+    finally:
+        os.unlink(tmp)
+
+
+def strip_zip64(extra):
+    '''Removes the ZIP64 extended information from a member's extra field.'''
+    out = []
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, size = struct.unpack('<HH', extra[pos:pos + 4])
+        if tag != 1:
+            out.append(extra[pos:pos + 4 + size])
+        pos += 4 + size
+    return ''.join(out)
+
+
+class ZIPMember(object):
+    '''An archive member which is decompressed as it is read.
+
+    During a walk the already open archive is shared, copies sent to other
+    processes open the archive themselves.'''
+
+    def __init__(self, archive, name, zip=None, size=None, fingerprint=None):
+        self.archive = archive
+        self.name = name
+        self.zip = zip
+        self.size = size
+        self.fingerprint = fingerprint
+
+    @property
+    def cache_name(self):
+        '''The name the member's hash is cached under.'''
+        return os.path.join(os.path.abspath(self.archive), self.name)
+
+    def open(self):
+        if self.zip is not None:
+            return self.zip.open(self.name)
+        zip = ZipFile(self.archive, 'r')
         try:
-            shutil.copy(archive, tmp)
-            with ZipFile(tmp, 'r') as old_zip:
-                with ZipFile(archive, 'w') as new_zip:
-                    for member in old_zip.namelist():
-                        if member != name:
-                            new_zip.writestr(member, old_zip.read(member))
-        finally:
-            os.close(fd)
-            os.unlink(tmp)
+            return ClosingMember(zip.open(self.name), zip)
+        except:
+            zip.close()
+            raise
+
+    def __getstate__(self):
+        return {'archive': self.archive, 'name': self.name, 'zip': None, 'size': self.size,
+                'fingerprint': self.fingerprint}
+
+
+class ClosingMember(object):
+    '''An open member which also closes its archive.'''
+
+    def __init__(self, member, zip):
+        self.member = member
+        self.zip = zip
+
+    def read(self, size=-1):
+        return self.member.read(size)
+
+    def close(self):
+        self.member.close()
+        self.zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
@@ -0,0 +1,21 @@
+import zlib
+
+from compressor import Compressor
+
+class ZlibCompressor(Compressor):
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, contents):
+        return zlib.compress(contents, self.level)
+
+    def decompress(self, contents):
+        return zlib.decompress(contents)
+
+    def compressobj(self):
+        return zlib.compressobj(self.level)
+
+    def decompressobj(self):
+        return zlib.decompressobj()
+
+    compressed_extension = '.zlib'